@@ -0,0 +1,176 @@
+import asyncio
+import http
+
+# Minimal HTTP/1.1 server on asyncio, for serving many connections (Chromecast fetches, image previews, event streams
+# from the website) from a single thread. Requests are passed to request_handler(HTTPRequest), a coroutine that
+# returns an HTTPResponse. Connections are kept alive between requests for up to keep_alive_seconds, and at most
+# max_connections are served at once; any more are turned away with 503 Service Unavailable.
+
+# Requests bigger than this are refused, we only expect small commands from the website
+max_request_line_bytes= 64 * 1024
+max_header_count= 100
+max_body_bytes= 1024 * 1024
+
+# Case-insensitive header lookup, like the headers of http.server.BaseHTTPRequestHandler
+class HTTPHeaders:
+	def __init__(self):
+		self.values= {} # lower case name -> value
+
+	def get(self, name, default= None):
+		return self.values.get(name.lower(), default)
+
+	def set(self, name, value):
+		self.values[name.lower()]= value
+
+class HTTPRequest:
+	def __init__(self, method, path, version, headers, body):
+		self.method= method
+		self.path= path # Including the query string, like BaseHTTPRequestHandler.path
+		self.version= version # e.g. "HTTP/1.1"
+		self.headers= headers # HTTPHeaders
+		self.body= body # bytes
+
+# Exactly one of body, file or stream is used: body is bytes; file is an open binary file object, of which count
+# bytes from offset are sent (and then it's closed); stream is an async iterator of bytes, sent until it's exhausted,
+# after which the connection is closed.
+class HTTPResponse:
+	def __init__(self, status, headers= None, body= b"", file= None, offset= 0, count= 0, stream= None):
+		self.status= status # http.HTTPStatus
+		self.headers= headers if headers is not None else [] # list of (name, value)
+		self.body= body
+		self.file= file
+		self.offset= offset
+		self.count= count
+		self.stream= stream
+
+class AsyncHTTPServer:
+	def __init__(self, request_handler, max_connections, keep_alive_seconds):
+		self.request_handler= request_handler
+		self.max_connections= max_connections
+		self.keep_alive_seconds= keep_alive_seconds
+		self.connection_tasks= set()
+		self.server= None
+
+	async def start(self, host, port):
+		self.server= await asyncio.start_server(self.handle_connection, host, port, limit= max_request_line_bytes)
+
+	# Stop listening and drop every open connection
+	async def close(self):
+		if self.server is not None:
+			self.server.close()
+
+		for connection_task in list(self.connection_tasks):
+			connection_task.cancel()
+		if len(self.connection_tasks) > 0:
+			await asyncio.gather(*self.connection_tasks, return_exceptions= True)
+
+		if self.server is not None:
+			# Only after dropping the connections, newer versions of Python wait for them here
+			await self.server.wait_closed()
+
+	async def handle_connection(self, reader, writer):
+		connection_task= asyncio.current_task()
+		try:
+			if len(self.connection_tasks) >= self.max_connections:
+				await self.write_response(writer, HTTPResponse(http.HTTPStatus.SERVICE_UNAVAILABLE,
+					[("Retry-After", "1")], b"Too many connections"), False)
+				return
+
+			self.connection_tasks.add(connection_task)
+
+			keep_alive= True
+			while keep_alive:
+				try:
+					request= await asyncio.wait_for(self.read_request(reader), self.keep_alive_seconds)
+				except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+					break # Idle for too long, or the client went away
+				except ValueError as e:
+					await self.write_response(writer, HTTPResponse(http.HTTPStatus.BAD_REQUEST, body= str(e).encode("utf-8")), False)
+					break
+
+				if request is None:
+					break # Closed cleanly between requests
+
+				connection_header= (request.headers.get("Connection") or "").lower()
+				if request.version == "HTTP/1.1":
+					keep_alive= connection_header != "close"
+				else:
+					keep_alive= connection_header == "keep-alive"
+
+				try:
+					response= await self.request_handler(request)
+				except Exception as e:
+					response= HTTPResponse(http.HTTPStatus.INTERNAL_SERVER_ERROR, body= ("Error: '%s'" % e).encode("utf-8"))
+
+				if response.stream is not None:
+					keep_alive= False # There's no Content-Length, the stream ends when the connection does
+
+				await self.write_response(writer, response, keep_alive)
+		except ConnectionError:
+			pass
+		except asyncio.CancelledError:
+			pass # close() is dropping the connection, finish quietly rather than leave asyncio a cancelled task to report
+		finally:
+			self.connection_tasks.discard(connection_task)
+			writer.close()
+
+	# Returns: HTTPRequest, or None if the connection was closed before a new request started
+	# Raises ValueError if the request is malformed
+	async def read_request(self, reader):
+		request_line= await reader.readline()
+		if request_line == b"":
+			return None
+
+		request_line_parts= request_line.decode("iso-8859-1").split()
+		if len(request_line_parts) != 3 or not request_line_parts[2].startswith("HTTP/"):
+			raise ValueError("Bad request line '%s'" % request_line.decode("iso-8859-1").strip())
+		method, path, version= request_line_parts
+
+		headers= HTTPHeaders()
+		for _header_index in range(max_header_count + 1):
+			header_line= (await reader.readline()).decode("iso-8859-1")
+			if header_line in ("\r\n", "\n", ""):
+				break
+			name, separator, value= header_line.partition(":")
+			if separator != ":":
+				raise ValueError("Bad header line '%s'" % header_line.strip())
+			headers.set(name.strip(), value.strip())
+		else:
+			raise ValueError("Too many headers")
+
+		content_length= int(headers.get("Content-Length", "0"))
+		if content_length < 0 or content_length > max_body_bytes:
+			raise ValueError("Bad Content-Length [%d]" % content_length)
+		body= await reader.readexactly(content_length) if content_length > 0 else b""
+
+		return HTTPRequest(method, path, version, headers, body)
+
+	async def write_response(self, writer, response, keep_alive):
+		try:
+			header_lines= ["HTTP/1.1 %d %s" % (response.status, response.status.phrase)]
+			header_lines.extend("%s: %s" % (name, value) for name, value in response.headers)
+			if response.stream is None and not response.status in (http.HTTPStatus.NOT_MODIFIED, http.HTTPStatus.NO_CONTENT):
+				content_length= response.count if response.file is not None else len(response.body)
+				header_lines.append("Content-Length: %d" % content_length)
+			header_lines.append("Connection: %s" % ("keep-alive" if keep_alive else "close"))
+			writer.write(("\r\n".join(header_lines) + "\r\n\r\n").encode("iso-8859-1"))
+
+			if response.file is not None:
+				await writer.drain()
+				if response.count > 0:
+					# Uses os.sendfile when it can, otherwise reads and writes chunks without blocking the loop
+					await asyncio.get_running_loop().sendfile(writer.transport, response.file, response.offset, response.count)
+			elif response.stream is not None:
+				await writer.drain()
+				async for chunk in response.stream:
+					writer.write(chunk)
+					# Wait for slow clients rather than buffering without limit
+					await writer.drain()
+			else:
+				writer.write(response.body)
+				await writer.drain()
+		finally:
+			if response.file is not None:
+				response.file.close()
+			if response.stream is not None and hasattr(response.stream, "aclose"):
+				await response.stream.aclose()
@@ -0,0 +1,32 @@
+import json
+import sys
+
+# Compare two results files from run_benchmarks.py, e.g. from before and after a change:
+# python3 benchmarks/compare_benchmarks.py before.json after.json
+
+# Returns: list of lines comparing the median time of every benchmark in both baseline_results and results
+def compare_results(baseline_results, results):
+	lines= ["%-60s %12s %12s %8s" % ("benchmark", "baseline", "current", "ratio")]
+	for name, result in results["results"].items():
+		baseline_result= baseline_results["results"].get(name)
+		if baseline_result is None:
+			lines.append("%-60s %12s %12.6f %8s" % (name, "-", result["median_seconds"], "new"))
+			continue
+		ratio= result["median_seconds"] / baseline_result["median_seconds"] if baseline_result["median_seconds"] > 0 else float("inf")
+		lines.append("%-60s %12.6f %12.6f %7.2fx" % (name, baseline_result["median_seconds"], result["median_seconds"], ratio))
+	return lines
+
+def load_results(file_path):
+	with open(file_path, "r") as results_file:
+		return json.load(results_file)
+
+if __name__ == "__main__":
+	if len(sys.argv) != 3:
+		print("Usage: python3 compare_benchmarks.py <baseline results.json> <results.json>")
+		sys.exit(1)
+
+	baseline_results= load_results(sys.argv[1])
+	results= load_results(sys.argv[2])
+	print("baseline: %s, current: %s" % (baseline_results["metadata"].get("commit"), results["metadata"].get("commit")))
+	for line in compare_results(baseline_results, results):
+		print(line)
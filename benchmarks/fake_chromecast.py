@@ -0,0 +1,435 @@
+import pychromecast
+import pychromecast.controllers.media
+import pychromecast.discovery
+import pychromecast.error
+import zeroconf
+import threading
+import time
+import urllib.request
+import uuid
+
+# Stands in for Chromecasts on the network, for running pycastblaster end to end without a TV. FakeCastNetwork.install()
+# replaces pychromecast's discovery and connection with fakes that behave like the parts of pychromecast that
+# pycastblaster uses: devices are discovered, can be connected to, launch the Default Media Receiver, and fetch each
+# frame they're told to play over HTTP, like a real receiver. They also keep a media queue (see cast_queue): queued
+# frames are fetched in the background and shown instantly when they're jumped to. Interruptions (another app casting, a device turning off)
+# can be injected while it runs. Everything happens in this process, nothing goes out on the network.
+
+media_namespace= "urn:x-cast:com.google.cast.media"
+
+# Some other app to interrupt us with (YouTube)
+other_app_id= "233637DE"
+other_app_display_name= "YouTube"
+
+# A frame a device was told to play
+class FrameRecord:
+	def __init__(self, url, requested_time, interruption_count):
+		self.url= url
+		self.requested_time= requested_time # time.monotonic() when play_media was called, or the queue jumped to it
+		self.displayed_time= None # time.monotonic() when it finished downloading, so the screen stopped being black
+		self.preloaded= False # Already downloaded when it was requested, through the queue
+		self.byte_count= 0
+		self.content_type= None
+		self.error= None # Why it couldn't be fetched, or None
+		# FakeCastDevice.interruption_count when it was requested, frames from either side of an interruption aren't
+		# expected to be slideshow_duration_seconds apart
+		self.interruption_count= interruption_count
+
+# An item in a FakeCastDevice's queue, fetched as soon as it's added
+class FakeQueueItem:
+	def __init__(self, item_id, url, content_type):
+		self.item_id= item_id
+		self.url= url
+		self.content_type= content_type
+		self.lock= threading.Lock()
+		self.fetched= False
+		self.byte_count= 0
+		self.response_content_type= None
+		self.error= None
+		self.frame= None # FrameRecord once it's shown
+
+	def fetch(self, fetch_timeout_seconds):
+		byte_count= 0
+		response_content_type= None
+		error= None
+		try:
+			with urllib.request.urlopen(self.url, timeout= fetch_timeout_seconds) as response:
+				byte_count= len(response.read())
+				response_content_type= response.headers.get("Content-type")
+			if response_content_type != self.content_type:
+				error= "Content-type '%s', expected '%s'" % (response_content_type, self.content_type)
+		except Exception as e:
+			error= str(e)
+
+		with self.lock:
+			self.fetched= True
+			self.byte_count= byte_count
+			self.response_content_type= response_content_type
+			self.error= error
+			if self.frame is not None:
+				self.finish_frame()
+
+	# Put it on screen, as soon as it's fetched
+	def show(self, frame):
+		with self.lock:
+			self.frame= frame
+			if self.fetched:
+				frame.preloaded= True
+				self.finish_frame()
+
+	# Must hold self.lock
+	def finish_frame(self):
+		self.frame.byte_count= self.byte_count
+		self.frame.content_type= self.response_content_type
+		self.frame.error= self.error
+		if self.error is None:
+			self.frame.displayed_time= time.monotonic()
+
+class FakeCastInfo:
+	def __init__(self, device):
+		self.uuid= device.uuid
+		self.friendly_name= device.friendly_name
+		self.model_name= "Fake Chromecast"
+		self.manufacturer= "pycastblaster"
+		self.cast_type= "cast"
+		self.host= "127.0.0.1"
+		self.port= 8009
+		self.services= set()
+
+class FakeReceiverController:
+	def __init__(self, device):
+		self.device= device
+
+	@property
+	def app_id(self):
+		return self.device.app_id
+
+class FakeSocketClient:
+	def __init__(self, device):
+		self.device= device
+		self.receiver_controller= FakeReceiverController(device)
+		self.handlers= []
+
+	@property
+	def is_connected(self):
+		return self.device.connected
+
+	@property
+	def app_namespaces(self):
+		if self.device.connected and self.device.app_id == pychromecast.APP_MEDIA_RECEIVER:
+			return [media_namespace]
+		return []
+
+	def register_handler(self, handler):
+		self.handlers.append(handler)
+		handler.registered(self)
+
+	def unregister_handler(self, handler):
+		if handler in self.handlers:
+			self.handlers.remove(handler)
+		handler.unregistered()
+
+	# What pychromecast.controllers.BaseController.send_message() sends with
+	def send_app_message(self, namespace, message, inc_session_id= False, callback_function_param= False, no_add_request_id= False):
+		if not namespace in self.app_namespaces:
+			raise pychromecast.error.UnsupportedNamespace("Namespace %s is not supported by current app" % namespace)
+
+		reply= self.device.receive_media_message(message)
+		# Like the real socket client, reply from its own thread: handlers see the reply first, then the callback
+		def send_reply():
+			for handler in list(self.handlers):
+				handler.receive_message(None, reply)
+			if callback_function_param:
+				callback_function_param(reply)
+		threading.Thread(target= send_reply, daemon= True, name= "fake_socket_client").start()
+
+class FakeCastStatus:
+	def __init__(self, device):
+		self.app_id= device.app_id
+		self.display_name= device.app_display_name
+		self.is_active_input= True
+		self.is_stand_by= False
+
+class FakeMediaController:
+	def __init__(self, device):
+		self.device= device
+		# Set while our app (the Default Media Receiver) is running
+		self.session_active_event= threading.Event()
+
+	def launch(self, callback_function= None):
+		self.device.launch_app(pychromecast.APP_MEDIA_RECEIVER, "Default Media Receiver")
+		if callback_function:
+			callback_function()
+
+	def block_until_active(self, timeout= None):
+		self.session_active_event.wait(timeout)
+
+	def play_media(self, url, content_type, **_kwargs):
+		if not self.device.connected:
+			raise pychromecast.error.NotConnected("Fake Chromecast '%s' is turned off" % self.device.friendly_name)
+		self.device.load_media(url, content_type)
+
+# What get_chromecast_from_cast_info() returns: a connection to a FakeCastDevice
+class FakeChromecast:
+	def __init__(self, device):
+		self.device= device
+		self.cast_info= FakeCastInfo(device)
+		self.uuid= device.uuid
+		self.name= device.friendly_name
+		self.socket_client= FakeSocketClient(device)
+		self.media_controller= device.media_controller
+		self.register_handler= self.socket_client.register_handler
+		self.unregister_handler= self.socket_client.unregister_handler
+
+	@property
+	def status(self):
+		return FakeCastStatus(self.device) if self.device.connected else None
+
+	@property
+	def app_id(self):
+		return self.device.app_id if self.device.connected else None
+
+	@property
+	def app_display_name(self):
+		return self.device.app_display_name if self.device.connected else None
+
+	def wait(self, timeout= None):
+		pass # Connecting is instant
+
+	def quit_app(self):
+		self.device.quit_app()
+
+	def disconnect(self, timeout= None):
+		pass
+
+# The state of one pretend device, and everything it was told to play
+class FakeCastDevice:
+	def __init__(self, friendly_name, fetch_timeout_seconds= 10.0, supports_queue= True):
+		self.friendly_name= friendly_name
+		self.uuid= uuid.uuid4()
+		self.fetch_timeout_seconds= fetch_timeout_seconds
+		self.supports_queue= supports_queue # False: reject queue messages, like a receiver that can't queue images
+
+		self.lock= threading.Lock()
+		self.connected= False
+		self.app_id= pychromecast.IDLE_APP_ID
+		self.app_display_name= "Backdrop"
+		self.media_controller= FakeMediaController(self)
+		self.frames= [] # FrameRecord, in the order they were requested
+		self.interruption_count= 0
+
+		# The media queue, while our app is running
+		self.media_session_id= None
+		self.queue_items= [] # FakeQueueItem
+		self.current_item_index= None
+		self.next_item_id= 1
+
+	def launch_app(self, app_id, app_display_name):
+		with self.lock:
+			self.app_id= app_id
+			self.app_display_name= app_display_name
+			self.media_session_id= None
+			self.queue_items= []
+			self.current_item_index= None
+			if app_id == pychromecast.APP_MEDIA_RECEIVER:
+				self.media_controller.session_active_event.set()
+			else:
+				self.media_controller.session_active_event.clear()
+
+	def quit_app(self):
+		self.launch_app(pychromecast.IDLE_APP_ID, "Backdrop")
+
+	# Somebody starts casting something else, which takes over from us
+	def start_other_app(self):
+		with self.lock:
+			self.interruption_count= self.interruption_count + 1
+		self.launch_app(other_app_id, other_app_display_name)
+
+	# ...and then stops, leaving the device idle
+	def stop_other_app(self):
+		self.quit_app()
+
+	# Loading media replaces the queue with just that media
+	def load_media(self, url, content_type):
+		with self.lock:
+			self.media_session_id= (self.media_session_id or 0) + 1
+			self.queue_items= []
+			queue_items= self.add_queue_items([(url, content_type)])
+			self.show_queue_item(0)
+			self.start_fetching(queue_items)
+
+	# Must hold self.lock
+	# Returns: the new FakeQueueItems, call start_fetching() with them
+	def add_queue_items(self, urls_and_content_types):
+		queue_items= []
+		for url, content_type in urls_and_content_types:
+			queue_items.append(FakeQueueItem(self.next_item_id, url, content_type))
+			self.next_item_id= self.next_item_id + 1
+		self.queue_items.extend(queue_items)
+		return queue_items
+
+	# Like a real receiver, fetch items in the background. After showing the current item, so that it's not mistaken
+	# for a preloaded one.
+	def start_fetching(self, queue_items):
+		for queue_item in queue_items:
+			threading.Thread(target= queue_item.fetch, args= (self.fetch_timeout_seconds,), daemon= True,
+				name= "fake_chromecast_fetch").start()
+
+	# Must hold self.lock
+	def show_queue_item(self, item_index):
+		self.current_item_index= item_index
+		queue_item= self.queue_items[item_index]
+		frame= FrameRecord(queue_item.url, time.monotonic(), self.interruption_count)
+		self.frames.append(frame)
+		queue_item.show(frame)
+
+	# Handle a message sent to the media namespace by a controller other than the media controller (cast_queue)
+	# Returns: the reply
+	def receive_media_message(self, message):
+		message_type= message.get(pychromecast.controllers.media.MESSAGE_TYPE)
+		with self.lock:
+			if not self.supports_queue and message_type.startswith("QUEUE_"):
+				return { "type" : "INVALID_REQUEST", "reason" : "INVALID_COMMAND" }
+
+			if message_type == "QUEUE_LOAD":
+				self.media_session_id= (self.media_session_id or 0) + 1
+				self.queue_items= []
+				queue_items= self.add_queue_items([(item["media"]["contentId"], item["media"]["contentType"]) for item in message["items"]])
+				self.show_queue_item(message.get("startIndex", 0))
+				self.start_fetching(queue_items)
+			elif message.get("mediaSessionId") is None or message["mediaSessionId"] != self.media_session_id:
+				return { "type" : "INVALID_REQUEST", "reason" : "INVALID_MEDIA_SESSION_ID" }
+			elif message_type == "QUEUE_INSERT":
+				self.start_fetching(self.add_queue_items([(item["media"]["contentId"], item["media"]["contentType"]) for item in message["items"]]))
+			elif message_type == pychromecast.controllers.media.TYPE_QUEUE_UPDATE:
+				item_index= self.current_item_index + message.get("jump", 0)
+				if item_index < 0 or item_index >= len(self.queue_items):
+					# Off the end of the queue, which finishes it
+					self.media_session_id= None
+					self.queue_items= []
+					self.current_item_index= None
+					return { "type" : pychromecast.controllers.media.TYPE_MEDIA_STATUS, "status" : [] }
+				self.show_queue_item(item_index)
+			elif message_type == "QUEUE_REMOVE":
+				current_item= self.queue_items[self.current_item_index]
+				self.queue_items= [queue_item for queue_item in self.queue_items if not queue_item.item_id in message["itemIds"] or
+					queue_item is current_item]
+				self.current_item_index= self.queue_items.index(current_item)
+			elif message_type != pychromecast.controllers.media.TYPE_GET_STATUS:
+				return { "type" : "INVALID_REQUEST", "reason" : "INVALID_COMMAND" }
+
+			return self.get_media_status()
+
+	# Must hold self.lock
+	def get_media_status(self):
+		if self.media_session_id is None:
+			return { "type" : pychromecast.controllers.media.TYPE_MEDIA_STATUS, "status" : [] }
+		return { "type" : pychromecast.controllers.media.TYPE_MEDIA_STATUS, "status" : [{
+			"mediaSessionId" : self.media_session_id,
+			"currentItemId" : self.queue_items[self.current_item_index].item_id,
+			"playerState" : pychromecast.controllers.media.MEDIA_PLAYER_STATE_PLAYING,
+			"items" : [{ "itemId" : queue_item.item_id } for queue_item in self.queue_items] }] }
+
+	# Returns: number of items in the queue, to check that it doesn't grow forever
+	def get_queue_length(self):
+		with self.lock:
+			return len(self.queue_items)
+
+	# Returns: copy of the frames requested so far
+	def get_frames(self):
+		with self.lock:
+			return list(self.frames)
+
+class FakeZeroconf:
+	def close(self):
+		pass
+
+# Stands in for pychromecast.discovery.CastBrowser, finds the devices on its FakeCastNetwork
+class FakeCastBrowser:
+	def __init__(self, network, cast_listener, zeroconf_instance= None, known_hosts= None):
+		self.network= network
+		self.cast_listener= cast_listener
+		self.zc= zeroconf_instance
+		# Like the real CastBrowser, devices stay in here after they're removed
+		self.devices= {} # uuid -> FakeCastInfo
+		self.discovering= False
+
+	def start_discovery(self):
+		self.discovering= True
+		for device in self.network.get_devices():
+			self.device_added(device)
+
+	def stop_discovery(self):
+		self.discovering= False
+
+	# Called by FakeCastNetwork, from its own thread, like zeroconf's callbacks
+	def device_added(self, device):
+		if not self.discovering:
+			return
+		self.devices[device.uuid]= FakeCastInfo(device)
+		threading.Thread(target= self.cast_listener.add_cast, args= (device.uuid, "fake._googlecast._tcp.local."),
+			daemon= True, name= "fake_zeroconf").start()
+
+	def device_removed(self, device):
+		if not self.discovering or not device.uuid in self.devices:
+			return
+		threading.Thread(target= self.cast_listener.remove_cast,
+			args= (device.uuid, "fake._googlecast._tcp.local.", self.devices[device.uuid]), daemon= True, name= "fake_zeroconf").start()
+
+# The pretend network: the devices on it, and the browsers looking for them
+class FakeCastNetwork:
+	def __init__(self):
+		self.lock= threading.Lock()
+		self.devices= {} # uuid -> FakeCastDevice
+		self.browsers= []
+		self.originals= None
+
+	# Replace pychromecast's discovery and connection (and zeroconf, so that nothing is sent on the real network)
+	def install(self):
+		self.originals= (pychromecast.discovery.CastBrowser, pychromecast.get_chromecast_from_cast_info, zeroconf.Zeroconf)
+
+		def create_browser(cast_listener, zeroconf_instance= None, known_hosts= None):
+			browser= FakeCastBrowser(self, cast_listener, zeroconf_instance, known_hosts)
+			with self.lock:
+				self.browsers.append(browser)
+			return browser
+
+		def get_chromecast_from_cast_info(cast_info, zconf= None, tries= None, retry_wait= None, timeout= None):
+			with self.lock:
+				device= self.devices.get(cast_info.uuid)
+			if device is None:
+				raise pychromecast.error.ChromecastConnectionError("Fake Chromecast '%s' isn't on the network" % cast_info.friendly_name)
+			return FakeChromecast(device)
+
+		pychromecast.discovery.CastBrowser= create_browser
+		pychromecast.get_chromecast_from_cast_info= get_chromecast_from_cast_info
+		zeroconf.Zeroconf= FakeZeroconf
+
+	def uninstall(self):
+		if self.originals:
+			pychromecast.discovery.CastBrowser, pychromecast.get_chromecast_from_cast_info, zeroconf.Zeroconf= self.originals
+			self.originals= None
+
+	def get_devices(self):
+		with self.lock:
+			return list(self.devices.values())
+
+	# Turn a device on
+	def add_device(self, device):
+		with self.lock:
+			device.connected= True
+			self.devices[device.uuid]= device
+			browsers= list(self.browsers)
+		for browser in browsers:
+			browser.device_added(device)
+
+	# Turn a device off
+	def remove_device(self, device):
+		with self.lock:
+			device.connected= False
+			device.interruption_count= device.interruption_count + 1
+			self.devices.pop(device.uuid, None)
+			browsers= list(self.browsers)
+		device.quit_app()
+		for browser in browsers:
+			browser.device_removed(device)
@@ -0,0 +1,356 @@
+import PIL
+import PIL.Image
+import pillow_heif
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+benchmarks_directory_path= os.path.dirname(os.path.abspath(__file__))
+repository_path= os.path.dirname(benchmarks_directory_path)
+sys.path.insert(0, repository_path)
+
+import image_index
+import image_processing
+import log_buffer
+import playlist
+import pycastblaster
+
+import compare_benchmarks
+import synthetic_library
+
+# Times the hot paths of image processing, scanning and merging against a synthetic library, and writes the results as
+# JSON so that they can be compared between commits (see compare_benchmarks.py). E.g.:
+# python3 benchmarks/run_benchmarks.py --output before.json
+# (make changes)
+# python3 benchmarks/run_benchmarks.py --output after.json --compare before.json
+
+benchmark_groups= ("process_image", "splice", "probe", "encode", "scan", "merge")
+
+# (name, image_processing.EncoderSettings) for the encode benchmark
+encoder_benchmark_settings= (
+	("jpeg_q75", image_processing.EncoderSettings("jpeg", 75)),
+	("jpeg_q85_444", image_processing.EncoderSettings("jpeg", 85, "4:4:4")),
+	("progressive_jpeg_q75", image_processing.EncoderSettings("progressive_jpeg", 75)),
+	("webp_q75", image_processing.EncoderSettings("webp", 75)),
+	("jpeg_q90_budget_100kb", image_processing.EncoderSettings("jpeg", 90, max_bytes= 100 * 1024)))
+
+# Call function repeat_count times, after calling it once to warm up caches. setup (if given) is called before each
+# call, and isn't timed.
+# Returns: list of seconds taken by each call
+def time_calls(function, repeat_count, setup= None, warm_up= True):
+	if warm_up:
+		if setup:
+			setup()
+		function()
+
+	seconds= []
+	for _repeat_index in range(repeat_count):
+		if setup:
+			setup()
+		gc.collect()
+		start_time= time.perf_counter()
+		function()
+		seconds.append(time.perf_counter() - start_time)
+	return seconds
+
+class BenchmarkResults:
+	def __init__(self):
+		self.results= {} # name -> dictionary of statistics, in the order they were run
+
+	# Returns: the result
+	def add(self, name, seconds, **details):
+		result= {
+			"samples" : len(seconds),
+			"min_seconds" : min(seconds),
+			"median_seconds" : statistics.median(seconds),
+			"mean_seconds" : statistics.mean(seconds),
+			"max_seconds" : max(seconds) }
+		result.update(details)
+		self.results[name]= result
+		print("%-60s median %10.6fs  min %10.6fs" % (name, result["median_seconds"], result["min_seconds"]), flush= True)
+		return result
+
+# Times process_image, and (if compare_full_resolution) process_image_full_resolution for comparison, checking that
+# process_image's output is within image_processing's tolerance of the full resolution output.
+# Returns: list of descriptions of the images that were outside the tolerance
+def benchmark_process_image(results, images, repeat_count, compare_full_resolution):
+	process_functions= [("process_image", image_processing.process_image)]
+	if compare_full_resolution:
+		process_functions.append(("process_image_full_resolution", image_processing.process_image_full_resolution))
+
+	tolerance_failures= []
+	original_processing_modes= (image_processing.landscape_processing_mode, image_processing.portrait_processing_mode)
+	for processing_mode in image_processing.ImageProcessing:
+		image_processing.landscape_processing_mode= processing_mode
+		image_processing.portrait_processing_mode= processing_mode
+
+		for image in images:
+			function_results= []
+			for function_name, process_function in process_functions:
+				def process(file_path= image["file_path"], process_function= process_function):
+					with PIL.Image.open(file_path, "r") as pil_image:
+						process_function(pil_image)
+
+				function_results.append(results.add(
+					"%s/%s/%s%s" % (function_name, processing_mode.name.lower(), image["kind"], image["extension"]),
+					time_calls(process, repeat_count),
+					width= image["width"], height= image["height"], exif_orientation= image["exif_orientation"]))
+
+			if len(function_results) == 2:
+				# How much faster process_image is than the reference implementation
+				function_results[0]["speedup_over_full_resolution"]= function_results[1]["median_seconds"] / function_results[0]["median_seconds"]
+
+				# And how close it is
+				processed_images= []
+				for _function_name, process_function in process_functions:
+					with PIL.Image.open(image["file_path"], "r") as pil_image:
+						processed_images.append(process_function(pil_image))
+				mean_difference, large_difference_fraction= image_processing.measure_difference(*processed_images)
+				function_results[0]["mean_difference_levels"]= mean_difference
+				function_results[0]["large_difference_fraction"]= large_difference_fraction
+				if not image_processing.is_difference_within_tolerance(mean_difference, large_difference_fraction):
+					tolerance_failures.append("%s/%s%s: mean difference %.2f levels, %.2f%% differ by %d levels or more" % (
+						processing_mode.name.lower(), image["kind"], image["extension"], mean_difference,
+						large_difference_fraction * 100, image_processing.large_difference_levels))
+
+	image_processing.landscape_processing_mode, image_processing.portrait_processing_mode= original_processing_modes
+	return tolerance_failures
+
+def benchmark_splice(results, images, work_path, repeat_count):
+	image_paths= { (image["kind"], image["extension"]) : image["file_path"] for image in images }
+	# 2-up pairs, then 3-up and 2x2 (see image_processing.splice_layouts)
+	splice_image_keys= (
+		(("portrait", ".jpg"), ("portrait", ".heic")),
+		(("portrait", ".png"), ("tall_screenshot", ".jpg")),
+		(("tall_screenshot", ".heic"), ("portrait", ".jpg")),
+		(("tall_screenshot", ".jpg"), ("tall_screenshot", ".heic"), ("tall_screenshot", ".png")),
+		(("portrait", ".jpg"), ("portrait", ".heic"), ("portrait", ".png"), ("tall_screenshot", ".jpg")))
+
+	spliced_image_path= os.path.join(work_path, "spliced.jpg")
+	for image_keys in splice_image_keys:
+		splice_image_paths= [image_paths[image_key] for image_key in image_keys]
+		results.add("splice_images/" + "+".join(kind + extension for kind, extension in image_keys),
+			time_calls(lambda: image_processing.splice_images(splice_image_paths, spliced_image_path), repeat_count))
+
+def benchmark_probe(results, images, repeat_count):
+	for image in images:
+		results.add("image_is_portait/%s%s" % (image["kind"], image["extension"]),
+			time_calls(lambda: image_processing.image_is_portait(image["file_path"]), repeat_count * 10))
+
+# Encoding rendered frames (as they'd be sent to the Chromecast) with different settings, and how big they come out
+def benchmark_encode(results, images, repeat_count):
+	for image in images:
+		if image["extension"] != ".jpg":
+			continue # The frame is the same whatever the source format
+
+		with PIL.Image.open(image["file_path"], "r") as pil_image:
+			frame= image_processing.process_image(pil_image)
+
+		for settings_name, encoder_settings in encoder_benchmark_settings:
+			frame_bytes= image_processing.encode_image(frame, encoder_settings)
+			results.add("encode_image/%s/%s" % (settings_name, image["kind"]),
+				time_calls(lambda: image_processing.encode_image(frame, encoder_settings), repeat_count),
+				frame_bytes= len(frame_bytes))
+
+# Stands in for ImageServerThread, the scanner only hands it changes
+class NullImageServer:
+	def __init__(self):
+		self.added_image_count= 0
+
+	def add_image_references(self, new_image_references):
+		self.added_image_count= self.added_image_count + len(new_image_references)
+
+	def remove_image_references(self, removed_image_paths):
+		pass
+
+def benchmark_scan(results, library, work_path, repeat_count):
+	index_file_path= os.path.join(work_path, "index.db")
+	tree_details= { "images" : library["tree_image_count"], "directories" : library["tree_directory_count"] }
+	scanner= None
+
+	def open_new_index():
+		if pycastblaster.g_globals.image_index:
+			pycastblaster.g_globals.image_index.close()
+		for file_name in os.listdir(work_path):
+			if file_name.startswith("index.db"):
+				os.remove(os.path.join(work_path, file_name))
+		pycastblaster.g_globals.image_index= image_index.ImageIndex(index_file_path)
+
+	def start_scanner():
+		nonlocal scanner
+		scanner= pycastblaster.ImageScanningThread([NullImageServer()])
+
+	def scan():
+		scanner.scan_directory_tree(library["tree_path"], -1)
+
+	# First run: nothing in the image index, every image is probed
+	def start_cold():
+		open_new_index()
+		start_scanner()
+	results.add("scan/cold", time_calls(scan, repeat_count, setup= start_cold), **tree_details)
+
+	# Restarting: the image index has every directory, but the scanner starts out knowing nothing
+	results.add("scan/restart", time_calls(scan, repeat_count, setup= start_scanner), **tree_details)
+
+	# Periodic rescan with nothing changed
+	start_scanner()
+	scan()
+	results.add("scan/rescan", time_calls(scan, repeat_count), **tree_details)
+
+	pycastblaster.g_globals.image_index.close()
+	pycastblaster.g_globals.image_index= None
+
+def create_image_references(first_image_number, image_count):
+	return [pycastblaster.ImageReference("/benchmark/images/img%08d.jpg" % image_number, "",
+		pycastblaster.ImageLayout.Portrait if image_number % 3 == 0 else pycastblaster.ImageLayout.Landscape, 1000, 0)
+		for image_number in range(first_image_number, first_image_number + image_count)]
+
+def benchmark_merge(results, playlist_sizes, batch_size, repeat_count):
+	rng= random.Random(1)
+	for playlist_size in playlist_sizes:
+		pycastblaster.g_globals.playlist= playlist.Playlist()
+		image_server= pycastblaster.ImageServerThread(pycastblaster.g_config.get_devices()[0], None, pycastblaster.g_globals.playlist,
+			None, None, None)
+		next_image_number= 0
+
+		def add_batch(image_count):
+			nonlocal next_image_number
+			image_server.add_image_references(create_image_references(next_image_number, image_count))
+			next_image_number= next_image_number + image_count
+
+		# The first scan of a big library
+		results.add("merge_pending_image_references/initial/%d" % playlist_size,
+			time_calls(image_server.merge_pending_image_references, 1, setup= lambda: add_batch(playlist_size), warm_up= False),
+			playlist_size= playlist_size)
+
+		# Halfway through the slideshow, new images turn up
+		image_server.next_image_index= playlist_size // 2
+		image_server.plan_image_index= playlist_size // 2
+		image_server.portrait_scheduler.reset(image_server.plan_image_index)
+		results.add("merge_pending_image_references/add_%d/%d" % (batch_size, playlist_size),
+			time_calls(image_server.merge_pending_image_references, repeat_count, setup= lambda: add_batch(batch_size)),
+			playlist_size= playlist_size)
+
+		# ...and some are deleted
+		def remove_batch():
+			image_paths= set(image_server.playlist[image_index].local_image_path
+				for image_index in rng.sample(range(len(image_server.playlist)), batch_size))
+			image_server.remove_image_references(image_paths)
+		results.add("merge_pending_image_references/remove_%d/%d" % (batch_size, playlist_size),
+			time_calls(image_server.merge_pending_image_references, repeat_count, setup= remove_batch),
+			playlist_size= playlist_size)
+
+		image_server.portrait_scheduler.shutdown()
+		pycastblaster.g_globals.playlist= playlist.Playlist()
+
+# Returns: (commit hash, True if there are uncommitted changes), or (None, None) if this isn't a git checkout
+def get_commit():
+	try:
+		commit= subprocess.run(["git", "-C", repository_path, "rev-parse", "HEAD"], capture_output= True, text= True, check= True).stdout.strip()
+		status= subprocess.run(["git", "-C", repository_path, "status", "--porcelain", "--untracked-files=no"], capture_output= True, text= True, check= True).stdout
+		return (commit, len(status.strip()) > 0)
+	except (OSError, subprocess.CalledProcessError):
+		return (None, None)
+
+def main():
+	parser= argparse.ArgumentParser(description= "Benchmark image processing, scanning and merging against a synthetic library.")
+	parser.add_argument("--output", default= "benchmark_results.json", help= "File to write the results to, as JSON")
+	parser.add_argument("--compare", help= "Results file from an earlier run to compare against")
+	parser.add_argument("--library-path", default= os.path.join(tempfile.gettempdir(), "pycastblaster_benchmark_library"),
+		help= "Where to create the synthetic library, it's reused by later runs with the same settings")
+	parser.add_argument("--groups", default= ",".join(benchmark_groups), help= "Comma separated benchmarks to run: %s" % ", ".join(benchmark_groups))
+	parser.add_argument("--repeat", type= int, default= 5, help= "Times to run each benchmark")
+	parser.add_argument("--seed", type= int, default= 1)
+	parser.add_argument("--image-scale", type= float, default= 1.0, help= "Size of the synthetic images, 1.0 is 12MP for photos")
+	parser.add_argument("--max-image-height", type= int, default= 720, help= "max_image_height_pixels to render at")
+	parser.add_argument("--no-full-resolution", action= "store_true", help= "Don't compare process_image with process_image_full_resolution")
+	parser.add_argument("--tree-images", type= int, default= 20000, help= "Images in the directory tree to scan")
+	parser.add_argument("--tree-depth", type= int, default= 4)
+	parser.add_argument("--tree-fanout", type= int, default= 4)
+	parser.add_argument("--merge-sizes", default= "10000,100000,1000000", help= "Comma separated playlist sizes to merge into")
+	parser.add_argument("--merge-batch", type= int, default= 1000, help= "Images added or removed at a time")
+	parser.add_argument("--quick", action= "store_true", help= "Smaller images, library and playlists, for a quick check")
+	args= parser.parse_args()
+
+	if args.quick:
+		args.repeat= min(args.repeat, 2)
+		args.image_scale= min(args.image_scale, 0.25)
+		args.tree_images= min(args.tree_images, 2000)
+		args.merge_sizes= "10000,100000"
+
+	groups= [group.strip() for group in args.groups.split(",") if group.strip()]
+	for group in groups:
+		if not group in benchmark_groups:
+			parser.error("Unknown benchmark '%s'" % group)
+
+	# The scanner and image server expect the globals to be set up, like pycastblaster.initialize() does
+	pycastblaster.g_config= pycastblaster.Config()
+	pycastblaster.g_globals= pycastblaster.Globals()
+	pycastblaster.g_config.log_level= log_buffer.LogLevel.Warning
+	pycastblaster.g_config.local_images_path= "/benchmark/images"
+	image_processing.set_max_image_height(args.max_image_height)
+
+	print("Creating synthetic library in '%s'..." % args.library_path, flush= True)
+	library= synthetic_library.create_library(args.library_path, args.seed, args.image_scale, args.tree_images, args.tree_depth,
+		args.tree_fanout)
+
+	commit, has_uncommitted_changes= get_commit()
+	output= {
+		"metadata" : {
+			"commit" : commit,
+			"uncommitted_changes" : has_uncommitted_changes,
+			"timestamp" : time.time(),
+			"python" : platform.python_version(),
+			"pillow" : PIL.__version__,
+			"pillow_heif" : pillow_heif.__version__,
+			"platform" : platform.platform(),
+			"cpu_count" : os.cpu_count(),
+			"arguments" : vars(args) },
+		"results" : {} }
+
+	results= BenchmarkResults()
+	tolerance_failures= []
+	work_path= tempfile.mkdtemp(prefix= "pycastblaster_benchmark_")
+	pycastblaster.g_config.local_temp_path= work_path
+	try:
+		if "process_image" in groups:
+			tolerance_failures= benchmark_process_image(results, library["images"], args.repeat, not args.no_full_resolution)
+		if "splice" in groups:
+			benchmark_splice(results, library["images"], work_path, args.repeat)
+		if "probe" in groups:
+			benchmark_probe(results, library["images"], args.repeat)
+		if "encode" in groups:
+			benchmark_encode(results, library["images"], args.repeat)
+		if "scan" in groups:
+			benchmark_scan(results, library, work_path, args.repeat)
+		if "merge" in groups:
+			benchmark_merge(results, [int(size) for size in args.merge_sizes.split(",")], args.merge_batch, args.repeat)
+	finally:
+		shutil.rmtree(work_path, ignore_errors= True)
+
+	output["results"]= results.results
+	with open(args.output, "w") as output_file:
+		json.dump(output, output_file, indent= 1)
+	print("Results written to '%s'" % args.output)
+
+	if args.compare:
+		for line in compare_benchmarks.compare_results(compare_benchmarks.load_results(args.compare), output):
+			print(line)
+
+	if len(tolerance_failures) > 0:
+		print("process_image is outside the tolerance of process_image_full_resolution for:")
+		for tolerance_failure in tolerance_failures:
+			print("  " + tolerance_failure)
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()
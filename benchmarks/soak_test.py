@@ -0,0 +1,306 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+benchmarks_directory_path= os.path.dirname(os.path.abspath(__file__))
+repository_path= os.path.dirname(benchmarks_directory_path)
+sys.path.insert(0, repository_path)
+
+import pycastblaster
+
+import fake_chromecast
+import synthetic_library
+
+# Runs the whole of pycastblaster (poller, image server, scanner, render workers, web server) against a fake
+# Chromecast and a synthetic library, for as long as you like at an accelerated slideshow speed, and reports how well
+# it kept up: how late frames were, how long the screen was black while frames loaded, and whether memory, threads,
+# open files or temp files grow over time. Interruptions (another app casting, the Chromecast turning off) can be
+# injected to exercise the interruption_idle_seconds paths under load. E.g.:
+# python3 benchmarks/soak_test.py --minutes 120 --slideshow-seconds 0.5 --interrupt-every-minutes 5
+
+interruption_kinds= ("other_app", "removed")
+
+def read_proc_status_kilobytes(pid, field_name):
+	try:
+		with open("/proc/%d/status" % pid, "r") as status_file:
+			for line in status_file:
+				if line.startswith(field_name + ":"):
+					return int(line.split()[1])
+	except (OSError, ValueError):
+		pass
+	return 0
+
+# Returns: resident memory of this process and the render workers, in kilobytes
+def get_resident_kilobytes():
+	return read_proc_status_kilobytes(os.getpid(), "VmRSS") + sum(
+		read_proc_status_kilobytes(child_process.pid, "VmRSS") for child_process in multiprocessing.active_children())
+
+def get_open_file_count():
+	return len(os.listdir("/proc/self/fd"))
+
+# Returns: (number of files, total bytes) under directory_path
+def get_directory_usage(directory_path):
+	file_count= 0
+	byte_count= 0
+	for parent_path, _directory_names, file_names in os.walk(directory_path):
+		for file_name in file_names:
+			try:
+				byte_count= byte_count + os.stat(os.path.join(parent_path, file_name)).st_size
+				file_count= file_count + 1
+			except OSError:
+				pass # Evicted while we were looking
+	return (file_count, byte_count)
+
+# Returns: dictionary of count, mean, median, p90, p99 and max of values
+def summarize(values):
+	if len(values) == 0:
+		return { "count" : 0 }
+	sorted_values= sorted(values)
+	def percentile(fraction):
+		return sorted_values[min(int(fraction * len(sorted_values)), len(sorted_values) - 1)]
+	return {
+		"count" : len(sorted_values),
+		"mean" : sum(sorted_values) / len(sorted_values),
+		"median" : percentile(0.5),
+		"p90" : percentile(0.9),
+		"p99" : percentile(0.99),
+		"max" : sorted_values[-1] }
+
+class Interruption:
+	def __init__(self, kind, start_time):
+		self.kind= kind # one of interruption_kinds
+		self.start_time= start_time
+		self.end_time= None
+
+class SoakTest:
+	def __init__(self, args):
+		self.args= args
+		self.work_path= args.work_path or tempfile.mkdtemp(prefix= "pycastblaster_soak_")
+		self.temp_path= os.path.join(self.work_path, "temp")
+		self.config_file_path= os.path.join(self.work_path, "soak_config.yaml")
+
+		self.network= fake_chromecast.FakeCastNetwork()
+		self.device= fake_chromecast.FakeCastDevice("Soak Test TV", supports_queue= not args.no_receiver_queue)
+		self.interruptions= []
+		self.samples= []
+		self.start_time= None
+
+	def write_config(self, images_path):
+		config_lines= [
+			"images_path: \"%s\"" % images_path,
+			"temp_path: \"%s\"" % self.temp_path,
+			"http_server_port: %d" % self.args.port,
+			"http_server_mode: %s" % self.args.http_server_mode,
+			"chromecast_name: \"%s\"" % self.device.friendly_name,
+			"cast_transport: %s" % self.args.cast_transport,
+			"slideshow_duration_seconds: %f" % self.args.slideshow_seconds,
+			"interruption_idle_seconds: %d" % self.args.interruption_idle_seconds,
+			"image_scanning_frequency_minutes: 1",
+			"render_cache_megabytes: %d" % self.args.render_cache_megabytes,
+			"log_level: %s" % self.args.log_level,
+			"log_file_path: \"%s\"" % os.path.join(self.work_path, "pycastblaster.log")]
+		with open(self.config_file_path, "w") as config_file:
+			config_file.write("\n".join(config_lines) + "\n")
+
+	def run_daemon(self):
+		# pycastblaster reads the config file named on the command line, and index.html from the working directory
+		sys.argv= [os.path.join(repository_path, "pycastblaster.py"), self.config_file_path]
+		os.chdir(repository_path)
+		pycastblaster.initialize()
+		pycastblaster.main()
+
+	def take_sample(self):
+		temp_file_count, temp_byte_count= get_directory_usage(self.temp_path)
+		frames= self.device.get_frames()
+		sample= {
+			"seconds" : time.monotonic() - self.start_time,
+			"resident_kilobytes" : get_resident_kilobytes(),
+			"thread_count" : threading.active_count(),
+			"open_file_count" : get_open_file_count(),
+			"temp_file_count" : temp_file_count,
+			"temp_bytes" : temp_byte_count,
+			"frames_requested" : len(frames),
+			"frames_displayed" : sum(1 for frame in frames if frame.displayed_time is not None),
+			"queue_length" : self.device.get_queue_length() }
+		self.samples.append(sample)
+		print("[%7.0fs] frames %6d  rss %8d kB  threads %3d  files %4d  temp %5d files %8d kB  queue %3d" % (
+			sample["seconds"], sample["frames_displayed"], sample["resident_kilobytes"], sample["thread_count"],
+			sample["open_file_count"], sample["temp_file_count"], sample["temp_bytes"] // 1024, sample["queue_length"]), flush= True)
+
+	def start_interruption(self, kind):
+		print("Interrupting: %s" % kind, flush= True)
+		self.interruptions.append(Interruption(kind, time.monotonic()))
+		if kind == "other_app":
+			self.device.start_other_app()
+		else:
+			self.network.remove_device(self.device)
+
+	def end_interruption(self):
+		interruption= self.interruptions[-1]
+		print("Ending interruption: %s" % interruption.kind, flush= True)
+		interruption.end_time= time.monotonic()
+		if interruption.kind == "other_app":
+			self.device.stop_other_app()
+		else:
+			self.network.add_device(self.device)
+
+	def run(self):
+		print("Creating synthetic library...", flush= True)
+		library_path= os.path.join(self.work_path, "library")
+		synthetic_library.create_directory_tree(os.path.join(library_path, "images"), self.args.images, 3, 3, self.args.seed,
+			self.args.image_scale)
+		self.write_config(os.path.join(library_path, "images"))
+
+		self.network.install()
+		self.network.add_device(self.device)
+
+		daemon_thread= threading.Thread(target= self.run_daemon, name= "soak_daemon")
+		self.start_time= time.monotonic()
+		daemon_thread.start()
+
+		end_time= self.start_time + self.args.minutes * 60
+		next_sample_time= self.start_time + self.args.sample_seconds
+		interrupt_interval_seconds= self.args.interrupt_every_minutes * 60
+		next_interruption_time= self.start_time + interrupt_interval_seconds if interrupt_interval_seconds > 0 else None
+
+		try:
+			while time.monotonic() < end_time and daemon_thread.is_alive():
+				time.sleep(0.25)
+				now= time.monotonic()
+
+				if now >= next_sample_time:
+					self.take_sample()
+					next_sample_time= next_sample_time + self.args.sample_seconds
+
+				if next_interruption_time is not None:
+					if len(self.interruptions) > 0 and self.interruptions[-1].end_time is None:
+						if now >= self.interruptions[-1].start_time + self.args.interruption_seconds:
+							self.end_interruption()
+							next_interruption_time= now + interrupt_interval_seconds
+					elif now >= next_interruption_time:
+						self.start_interruption(interruption_kinds[len(self.interruptions) % len(interruption_kinds)])
+		except KeyboardInterrupt:
+			print("Stopping early", flush= True)
+		finally:
+			if len(self.interruptions) > 0 and self.interruptions[-1].end_time is None:
+				self.end_interruption()
+			self.take_sample()
+
+			if pycastblaster.g_globals:
+				pycastblaster.g_globals.exit_event.set()
+			daemon_thread.join()
+			self.network.uninstall()
+
+		return self.build_report()
+
+	def build_report(self):
+		frames= self.device.get_frames()
+		displayed_frames= [frame for frame in frames if frame.displayed_time is not None]
+
+		# How much longer than slideshow_duration_seconds each frame stayed up, not counting the frames either side of
+		# an interruption
+		frame_lateness_seconds= []
+		for previous_frame, frame in zip(displayed_frames, displayed_frames[1:]):
+			if previous_frame.interruption_count == frame.interruption_count:
+				frame_lateness_seconds.append(frame.displayed_time - previous_frame.displayed_time - self.args.slideshow_seconds)
+
+		interruption_reports= []
+		for interruption in self.interruptions:
+			resumed_frame= next((frame for frame in displayed_frames if frame.requested_time >= interruption.end_time), None)
+			interruption_reports.append({
+				"kind" : interruption.kind,
+				"start_seconds" : interruption.start_time - self.start_time,
+				"duration_seconds" : interruption.end_time - interruption.start_time,
+				# From the other app quitting (or the Chromecast coming back) to showing a frame again
+				"resume_seconds" : resumed_frame.displayed_time - interruption.end_time if resumed_frame else None })
+
+		resources= { "samples" : self.samples }
+		if len(self.samples) >= 3:
+			# Compare with the second sample, after caches and worker processes have warmed up
+			baseline_sample= self.samples[1]
+			last_sample= self.samples[-1]
+			elapsed_hours= max((last_sample["seconds"] - baseline_sample["seconds"]) / 3600, 1e-9)
+			resources["growth"]= { name : last_sample[name] - baseline_sample[name] for name in
+				("resident_kilobytes", "thread_count", "open_file_count", "temp_file_count", "temp_bytes") }
+			resources["resident_kilobytes_per_hour"]= resources["growth"]["resident_kilobytes"] / elapsed_hours
+			resources["max_thread_count"]= max(sample["thread_count"] for sample in self.samples)
+
+		return {
+			"arguments" : vars(self.args),
+			"duration_seconds" : time.monotonic() - self.start_time,
+			"frames_requested" : len(frames),
+			"frames_displayed" : len(displayed_frames),
+			# Already downloaded when they were due, through the Chromecast's queue
+			"frames_preloaded" : sum(1 for frame in displayed_frames if frame.preloaded),
+			"frame_errors" : [{ "url" : frame.url, "error" : frame.error } for frame in frames if frame.error is not None][:100],
+			"frame_error_count" : sum(1 for frame in frames if frame.error is not None),
+			"frame_lateness_seconds" : summarize(frame_lateness_seconds),
+			# From play_media to the frame having downloaded, while a real Chromecast shows a black screen
+			"black_screen_seconds" : summarize([frame.displayed_time - frame.requested_time for frame in displayed_frames]),
+			"frame_bytes" : summarize([frame.byte_count for frame in displayed_frames]),
+			"interruptions" : interruption_reports,
+			"resources" : resources }
+
+def print_report(report):
+	print("Frames: [%d] requested, [%d] displayed, [%d] preloaded, [%d] errors" % (report["frames_requested"], report["frames_displayed"],
+		report["frames_preloaded"], report["frame_error_count"]))
+	for name in ("frame_lateness_seconds", "black_screen_seconds"):
+		summary= report[name]
+		if summary["count"] > 0:
+			print("%-24s median %8.3f  p90 %8.3f  p99 %8.3f  max %8.3f" % (name, summary["median"], summary["p90"], summary["p99"], summary["max"]))
+	for interruption in report["interruptions"]:
+		print("Interruption %-10s at %7.0fs for %5.1fs, resumed after %s" % (interruption["kind"], interruption["start_seconds"],
+			interruption["duration_seconds"], "%.1fs" % interruption["resume_seconds"] if interruption["resume_seconds"] is not None else "never"))
+	if "growth" in report["resources"]:
+		growth= report["resources"]["growth"]
+		print("Growth since warm up: rss %+d kB (%+.0f kB/hour), threads %+d, open files %+d, temp files %+d (%+d kB)" % (
+			growth["resident_kilobytes"], report["resources"]["resident_kilobytes_per_hour"], growth["thread_count"],
+			growth["open_file_count"], growth["temp_file_count"], growth["temp_bytes"] // 1024))
+
+def main():
+	parser= argparse.ArgumentParser(description= "Run pycastblaster against a fake Chromecast and report how well it keeps up.")
+	parser.add_argument("--minutes", type= float, default= 60, help= "How long to run for")
+	parser.add_argument("--slideshow-seconds", type= float, default= 0.5, help= "slideshow_duration_seconds, short to speed things up")
+	parser.add_argument("--images", type= int, default= 2000, help= "Images in the synthetic library")
+	parser.add_argument("--image-scale", type= float, default= 0.25, help= "Size of the synthetic images, 1.0 is 12MP for photos")
+	parser.add_argument("--seed", type= int, default= 1)
+	parser.add_argument("--interrupt-every-minutes", type= float, default= 0, help= "Interrupt casting this often, alternating "
+		"between another app casting and the Chromecast turning off. 0 for no interruptions.")
+	parser.add_argument("--interruption-seconds", type= float, default= 15, help= "How long each interruption lasts")
+	parser.add_argument("--interruption-idle-seconds", type= int, default= 2, help= "interruption_idle_seconds")
+	parser.add_argument("--render-cache-megabytes", type= int, default= 64, help= "render_cache_megabytes")
+	parser.add_argument("--http-server-mode", default= "threaded", choices= ("threaded", "asyncio"))
+	parser.add_argument("--cast-transport", default= "load", choices= ("load", "queue"))
+	parser.add_argument("--no-receiver-queue", action= "store_true", help= "The fake Chromecast rejects queue messages, to test "
+		"falling back to loading each frame on its own")
+	parser.add_argument("--port", type= int, default= 18000, help= "http_server_port")
+	parser.add_argument("--log-level", default= "warning", help= "log_level, the full log is also written to the work directory")
+	parser.add_argument("--sample-seconds", type= float, default= 60, help= "How often to sample memory, threads and files")
+	parser.add_argument("--work-path", help= "Where to put the library, temp_path and logs (default: a new temp directory)")
+	parser.add_argument("--keep", action= "store_true", help= "Don't delete the work directory afterwards")
+	parser.add_argument("--output", default= "soak_results.json", help= "File to write the report to, as JSON")
+	args= parser.parse_args()
+	args.output= os.path.abspath(args.output)
+	if args.work_path:
+		args.work_path= os.path.abspath(args.work_path)
+
+	soak_test= SoakTest(args)
+	try:
+		report= soak_test.run()
+	finally:
+		if not args.keep:
+			shutil.rmtree(soak_test.work_path, ignore_errors= True)
+
+	with open(args.output, "w") as output_file:
+		json.dump(report, output_file, indent= 1)
+	print_report(report)
+	print("Report written to '%s'" % args.output)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,161 @@
+import PIL.Image, PIL.ImageDraw, PIL.ImageFilter, PIL.ExifTags
+import pillow_heif
+import json
+import os
+import random
+import shutil
+
+# Builds libraries of synthetic images on local disk for benchmarking, so that results don't depend on a network drive
+# or on somebody's photos. Everything is generated from a seed, so runs on different commits benchmark the same images.
+
+pillow_heif.register_heif_opener()
+
+# (kind, width, height) after EXIF orientation is applied, the shapes of image we see in real libraries
+image_shapes= (
+	("landscape", 4032, 3024), # 12MP phone camera
+	("portrait", 3024, 4032),
+	("panorama", 9000, 2000),
+	("tall_screenshot", 1170, 2532),
+	("square", 2048, 2048))
+
+image_extensions= (".jpg", ".png", ".heic")
+image_save_formats= { ".jpg" : "JPEG", ".png" : "PNG", ".heic" : "HEIF" }
+
+# Raw EXIF orientation tags: as shot, upside down, and the two 90 degree rotations (which swap width and height)
+exif_orientations= (1, 3, 6, 8)
+
+# Bump whenever the generated images change, so that cached libraries are rebuilt
+library_version= 1
+
+# Something shaped like a photo: smooth gradients and shapes (which compress well) under a little noise (which
+# doesn't), so that decoding costs roughly what it does for a real photo of the same size
+def create_image(width, height, rng):
+	small_width= max(width // 16, 1)
+	small_height= max(height // 16, 1)
+	image= PIL.Image.new("RGB", (small_width, small_height), tuple(rng.randrange(256) for _channel in range(3)))
+	image_drawer= PIL.ImageDraw.Draw(image)
+	for _shape_index in range(12):
+		x0= rng.randrange(small_width)
+		y0= rng.randrange(small_height)
+		x1= x0 + rng.randrange(1, small_width + 1)
+		y1= y0 + rng.randrange(1, small_height + 1)
+		image_drawer.ellipse((x0, y0, x1, y1), fill= tuple(rng.randrange(256) for _channel in range(3)))
+	image= image.filter(PIL.ImageFilter.GaussianBlur(4)).resize((width, height), PIL.Image.BICUBIC)
+
+	noise= PIL.Image.effect_noise((width, height), 24).convert("RGB")
+	return PIL.Image.blend(image, noise, 0.15)
+
+# Save an image that shows up as width x height once exif_orientation is applied, the way cameras do: the pixels are
+# stored as the sensor saw them, rotated back by the orientation tag.
+def save_image(file_path, width, height, exif_orientation, rng):
+	if exif_orientation in (6, 8):
+		image= create_image(height, width, rng)
+	else:
+		image= create_image(width, height, rng)
+
+	exif= PIL.Image.Exif()
+	exif[PIL.ExifTags.Base.Orientation]= exif_orientation
+
+	extension= os.path.splitext(file_path)[1]
+	save_options= { "exif" : exif.tobytes() }
+	if extension == ".jpg":
+		save_options["quality"]= 90
+	image.save(file_path, image_save_formats[extension], **save_options)
+
+# Every shape in every format, cycling through the EXIF orientations, at scale (1.0 is full size)
+# Returns: list of dictionaries: file_path, kind, extension, width, height (as displayed), exif_orientation
+def create_image_set(directory_path, seed, scale= 1.0):
+	rng= random.Random(seed)
+	os.makedirs(directory_path, exist_ok= True)
+
+	images= []
+	for shape_index, (kind, width, height) in enumerate(image_shapes):
+		for extension_index, extension in enumerate(image_extensions):
+			exif_orientation= exif_orientations[(shape_index + extension_index) % len(exif_orientations)]
+			scaled_width= max(int(width * scale), 16)
+			scaled_height= max(int(height * scale), 16)
+			file_path= os.path.join(directory_path, "%s%s" % (kind, extension))
+			save_image(file_path, scaled_width, scaled_height, exif_orientation, rng)
+			images.append({
+				"file_path" : file_path,
+				"kind" : kind,
+				"extension" : extension,
+				"width" : scaled_width,
+				"height" : scaled_height,
+				"exif_orientation" : exif_orientation })
+	return images
+
+# A deep tree of directory_fanout subdirectories per directory, directory_depth levels deep, with image_count images
+# spread over every directory. The images are hard links (or copies, if links aren't supported) of a few small
+# images (at source_scale, see create_image_set) in every format and orientation, since scanning only stats and
+# probes them.
+# Returns: number of directories in the tree, including root_path
+def create_directory_tree(root_path, image_count, directory_depth, directory_fanout, seed, source_scale= 0.1):
+	rng= random.Random(seed)
+
+	source_directory_path= root_path + "_sources"
+	source_images= create_image_set(source_directory_path, seed, source_scale)
+
+	directory_paths= [root_path]
+	level_directory_paths= [root_path]
+	for depth in range(directory_depth):
+		next_level_directory_paths= []
+		for directory_path in level_directory_paths:
+			for subdirectory_index in range(directory_fanout):
+				next_level_directory_paths.append(os.path.join(directory_path, "d%d_%d" % (depth, subdirectory_index)))
+		directory_paths.extend(next_level_directory_paths)
+		level_directory_paths= next_level_directory_paths
+
+	for directory_path in directory_paths:
+		os.makedirs(directory_path, exist_ok= True)
+
+	for image_index in range(image_count):
+		source_image= source_images[rng.randrange(len(source_images))]
+		directory_path= directory_paths[image_index % len(directory_paths)]
+		file_path= os.path.join(directory_path, "img%07d%s" % (image_index, source_image["extension"]))
+		try:
+			os.link(source_image["file_path"], file_path)
+		except OSError:
+			shutil.copyfile(source_image["file_path"], file_path)
+
+	return len(directory_paths)
+
+# Create a library in library_path (or reuse the one already there, if it was made with the same parameters):
+# library_path/images, every kind of image at full size, and library_path/tree, a deep directory tree for scanning.
+# Returns: dictionary: images (see create_image_set), tree_path, tree_image_count, tree_directory_count
+def create_library(library_path, seed, image_scale, tree_image_count, tree_depth, tree_fanout):
+	parameters= {
+		"library_version" : library_version,
+		"seed" : seed,
+		"image_scale" : image_scale,
+		"tree_image_count" : tree_image_count,
+		"tree_depth" : tree_depth,
+		"tree_fanout" : tree_fanout }
+
+	description_file_path= os.path.join(library_path, "library.json")
+	try:
+		with open(description_file_path, "r") as description_file:
+			description= json.load(description_file)
+		if description["parameters"] == parameters:
+			return description
+	except (OSError, ValueError, KeyError):
+		pass
+
+	shutil.rmtree(library_path, ignore_errors= True)
+	os.makedirs(library_path)
+
+	images= create_image_set(os.path.join(library_path, "images"), seed, image_scale)
+	tree_path= os.path.join(library_path, "tree")
+	tree_directory_count= create_directory_tree(tree_path, tree_image_count, tree_depth, tree_fanout, seed)
+
+	description= {
+		"parameters" : parameters,
+		"images" : images,
+		"tree_path" : tree_path,
+		"tree_image_count" : tree_image_count,
+		"tree_directory_count" : tree_directory_count }
+
+	# Written last, so that an interrupted build is started again next time
+	with open(description_file_path, "w") as description_file:
+		json.dump(description, description_file, indent= 1)
+	return description
@@ -0,0 +1,158 @@
+import pychromecast
+import pychromecast.controllers
+import pychromecast.controllers.media
+import pychromecast.error
+import threading
+
+# Sends frames to the Default Media Receiver through its queue, rather than loading each frame on its own. Loading a
+# frame replaces whatever is on screen with a black screen until the new frame has been fetched, but an item in the
+# queue is fetched in the background while the previous one is on screen, so moving on to it is instant.
+# pychromecast's MediaController only plays one item at a time, so QueueController sends the queue messages itself.
+# It's registered alongside the MediaController (the socket client passes media messages to both), and reads the queue's
+# state from the receiver's replies.
+
+media_namespace= "urn:x-cast:com.google.cast.media"
+
+# Shown frames are removed from the receiver's queue once there are more than this many, so that it doesn't grow forever
+max_shown_item_count= 8
+
+# Returns: a queue item for a frame
+def create_queue_item(url, content_type):
+	return {
+		"media" : {
+			"contentId" : url,
+			"contentType" : content_type,
+			"streamType" : pychromecast.controllers.media.STREAM_TYPE_BUFFERED,
+			"metadata" : { "metadataType" : pychromecast.controllers.media.METADATA_TYPE_PHOTO } },
+		"autoplay" : True }
+
+# Returns: True if a media status reply says the receiver is playing an item
+def is_playing_item(reply):
+	statuses= reply.get("status") or []
+	return (len(statuses) > 0 and statuses[0].get("currentItemId") is not None and
+		statuses[0].get("playerState") != pychromecast.controllers.media.MEDIA_PLAYER_STATE_IDLE)
+
+class QueueController(pychromecast.controllers.BaseController):
+	def __init__(self):
+		# No supporting app, the Chromecast poller launches the Default Media Receiver before we're used
+		pychromecast.controllers.BaseController.__init__(self, media_namespace)
+		self.lock= threading.Lock()
+		# From the receiver's latest media status
+		self.media_session_id= None
+		self.current_item_id= None
+
+		# Whether the queue on the receiver is ours, so that we can insert into it and jump through it
+		self.loaded= False
+		self.preloaded_url= None # The frame inserted after the one on screen, if any
+		self.shown_item_ids= [] # Items we've jumped to, oldest first, still in the receiver's queue
+
+	def receive_message(self, _message, data):
+		if data.get(pychromecast.controllers.media.MESSAGE_TYPE) != pychromecast.controllers.media.TYPE_MEDIA_STATUS:
+			return False
+
+		statuses= data.get("status") or []
+		with self.lock:
+			if len(statuses) == 0:
+				# The media session ended, e.g. another app took over
+				self.media_session_id= None
+				self.current_item_id= None
+				self.loaded= False
+			else:
+				self.media_session_id= statuses[0].get("mediaSessionId", self.media_session_id)
+				self.current_item_id= statuses[0].get("currentItemId", self.current_item_id)
+		# The MediaController handles it as well
+		return False
+
+	# Forget the queue, e.g. after our app was restarted. The next frame will start a new one.
+	def reset(self):
+		with self.lock:
+			self.loaded= False
+			self.preloaded_url= None
+			self.shown_item_ids= []
+
+	# Send a media message and wait for the receiver's reply.
+	# Returns: the reply if it was a media status (the receiver did what we asked), otherwise None
+	def request(self, data, timeout_seconds):
+		reply_event= threading.Event()
+		replies= []
+
+		def receive_reply(reply):
+			replies.append(reply)
+			reply_event.set()
+
+		try:
+			self.send_message(data, inc_session_id= True, callback_function= receive_reply)
+		except pychromecast.error.PyChromecastError:
+			return None
+
+		if not reply_event.wait(timeout_seconds):
+			return None
+		reply= replies[0]
+		if reply is None or reply.get(pychromecast.controllers.media.MESSAGE_TYPE) != pychromecast.controllers.media.TYPE_MEDIA_STATUS:
+			return None
+		return reply
+
+	# Put the frame after the one on screen, so that the receiver fetches it in the background.
+	# Returns: True if it was queued, False if there's no queue to add it to or the receiver wouldn't
+	def preload(self, url, content_type, timeout_seconds):
+		with self.lock:
+			if not self.loaded or self.preloaded_url is not None:
+				return False
+			media_session_id= self.media_session_id
+
+		reply= self.request({
+			pychromecast.controllers.media.MESSAGE_TYPE : "QUEUE_INSERT",
+			"mediaSessionId" : media_session_id,
+			"items" : [create_queue_item(url, content_type)] }, timeout_seconds)
+
+		with self.lock:
+			if reply is None:
+				# Start a new queue for the next frame rather than trusting this one
+				self.loaded= False
+				return False
+			self.preloaded_url= url
+			return True
+
+	# Show a frame: jump to it if it was preloaded, otherwise start a new queue with it.
+	# Returns: (True if the frame is on screen, True if it was preloaded)
+	def show(self, url, content_type, timeout_seconds):
+		with self.lock:
+			was_preloaded= self.loaded and self.preloaded_url == url
+			media_session_id= self.media_session_id
+			self.preloaded_url= None
+
+		if was_preloaded:
+			reply= self.request({
+				pychromecast.controllers.media.MESSAGE_TYPE : pychromecast.controllers.media.TYPE_QUEUE_UPDATE,
+				"mediaSessionId" : media_session_id,
+				"jump" : 1 }, timeout_seconds)
+		else:
+			# Nothing loaded yet, or the frame that's due isn't the one we preloaded (the playlist changed). Loading
+			# replaces the whole queue, including any frame we preloaded.
+			reply= self.request({
+				pychromecast.controllers.media.MESSAGE_TYPE : "QUEUE_LOAD",
+				"items" : [create_queue_item(url, content_type)],
+				"startIndex" : 0,
+				"repeatMode" : "REPEAT_OFF" }, timeout_seconds)
+
+		success= reply is not None and is_playing_item(reply)
+		removed_item_ids= []
+		with self.lock:
+			self.loaded= success
+			if not was_preloaded:
+				self.shown_item_ids= []
+			if success:
+				self.shown_item_ids.append(self.current_item_id)
+				if len(self.shown_item_ids) > max_shown_item_count:
+					removed_item_ids= self.shown_item_ids[:-1]
+					self.shown_item_ids= self.shown_item_ids[-1:]
+			media_session_id= self.media_session_id
+
+		if len(removed_item_ids) > 0:
+			# If this doesn't work the queue's just a little longer, nothing to worry about
+			self.request({
+				pychromecast.controllers.media.MESSAGE_TYPE : "QUEUE_REMOVE",
+				"mediaSessionId" : media_session_id,
+				"itemIds" : removed_item_ids }, timeout_seconds)
+
+		return (success, was_preloaded)
@@ -0,0 +1,100 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+
+# Minimal inotify wrapper (Linux only, like the rest of this program) so that the image scanner can find out about new
+# and deleted images without walking the whole images directory. inotify only reports changes made through this
+# machine's kernel, so changes made directly on a NAS are not reported for network mounts (SMB/NFS) - the image
+# scanner still rescans periodically to catch those.
+
+# inotify event flags, from <sys/inotify.h>
+IN_MOVED_FROM= 0x00000040
+IN_MOVED_TO= 0x00000080
+IN_CREATE= 0x00000100
+IN_DELETE= 0x00000200
+IN_DELETE_SELF= 0x00000400
+IN_MOVE_SELF= 0x00000800
+IN_Q_OVERFLOW= 0x00004000
+IN_IGNORED= 0x00008000
+IN_ONLYDIR= 0x01000000
+IN_NONBLOCK= 0x00000800
+IN_CLOEXEC= 0x00080000
+
+# Everything that changes which images are in a directory
+watch_mask= IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+event_header= struct.Struct("iIII") # wd, mask, cookie, len
+
+class DirectoryWatcher:
+	def __init__(self):
+		self.libc= ctypes.CDLL(ctypes.util.find_library("c"), use_errno= True)
+		self.fd= self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		if self.fd < 0:
+			errno= ctypes.get_errno()
+			raise OSError(errno, "inotify_init1: %s" % os.strerror(errno))
+
+		self.watch_descriptors= {} # watch descriptor -> directory path
+		self.watched_directories= {} # directory path -> watch descriptor
+
+	def close(self):
+		if self.fd >= 0:
+			os.close(self.fd)
+			self.fd= -1
+
+	def is_watching(self, directory_path):
+		return directory_path in self.watched_directories
+
+	# Raises OSError if the directory can't be watched, e.g. we've hit fs.inotify.max_user_watches
+	def watch(self, directory_path):
+		if directory_path in self.watched_directories:
+			return
+
+		watch_descriptor= self.libc.inotify_add_watch(self.fd, os.fsencode(directory_path), watch_mask)
+		if watch_descriptor < 0:
+			errno= ctypes.get_errno()
+			raise OSError(errno, "inotify_add_watch '%s': %s" % (directory_path, os.strerror(errno)))
+
+		self.watch_descriptors[watch_descriptor]= directory_path
+		self.watched_directories[directory_path]= watch_descriptor
+
+	# Wait up to timeout_seconds for changes.
+	# Returns: set of directory paths that changed, or None if events were lost (the queue overflowed) and the caller
+	# should assume that anything may have changed.
+	def wait_for_changes(self, timeout_seconds):
+		readable, _writable, _error= select.select([self.fd], [], [], timeout_seconds)
+		if len(readable) == 0:
+			return set()
+
+		changed_directories= set()
+		overflowed= False
+
+		while True:
+			try:
+				buffer= os.read(self.fd, 64 * 1024)
+			except BlockingIOError:
+				break
+
+			offset= 0
+			while offset < len(buffer):
+				watch_descriptor, mask, _cookie, name_length= event_header.unpack_from(buffer, offset)
+				offset= offset + event_header.size + name_length
+
+				if mask & IN_Q_OVERFLOW:
+					overflowed= True
+					continue
+
+				directory_path= self.watch_descriptors.get(watch_descriptor)
+				if directory_path is None:
+					continue
+
+				changed_directories.add(directory_path)
+
+				if mask & IN_IGNORED:
+					# The directory was deleted or unmounted, the kernel already removed the watch
+					del self.watch_descriptors[watch_descriptor]
+					if self.watched_directories.get(directory_path) == watch_descriptor:
+						del self.watched_directories[directory_path]
+
+		return None if overflowed else changed_directories
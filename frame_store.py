@@ -0,0 +1,61 @@
+import collections
+import threading
+
+# Rendered frames kept in memory, so that the web server can send them to the Chromecast without writing them to disk
+# and reading them back. Frames are looked up by the same key as the render cache (see render_engine.get_frame_key).
+# The least recently used frames are dropped once the store grows beyond max_bytes. Frames that are about to be cast
+# or were just cast are pinned, so they're never dropped before the Chromecast has fetched them.
+class FrameStore:
+	def __init__(self, max_bytes):
+		self.max_bytes= max_bytes
+		self.lock= threading.Lock()
+		self.frames= collections.OrderedDict() # key -> bytes, least recently used first
+		self.total_bytes= 0
+		self.pin_counts= {} # key -> number of times pinned
+
+	def __len__(self):
+		return len(self.frames)
+
+	# Returns: the frame's bytes, marking it as most recently used, or None if it isn't in the store
+	def get(self, key):
+		with self.lock:
+			frame_bytes= self.frames.get(key)
+			if frame_bytes is not None:
+				self.frames.move_to_end(key)
+			return frame_bytes
+
+	def put(self, key, frame_bytes):
+		with self.lock:
+			previous_frame_bytes= self.frames.pop(key, None)
+			if previous_frame_bytes is not None:
+				self.total_bytes= self.total_bytes - len(previous_frame_bytes)
+
+			self.frames[key]= frame_bytes
+			self.total_bytes= self.total_bytes + len(frame_bytes)
+			self.evict()
+
+	def pin(self, key):
+		with self.lock:
+			self.pin_counts[key]= self.pin_counts.get(key, 0) + 1
+
+	def unpin(self, key):
+		with self.lock:
+			pin_count= self.pin_counts[key] - 1
+			if pin_count > 0:
+				self.pin_counts[key]= pin_count
+			else:
+				del self.pin_counts[key]
+			self.evict()
+
+	# Must hold self.lock
+	def evict(self):
+		if self.total_bytes <= self.max_bytes:
+			return
+
+		for key in list(self.frames.keys()):
+			if self.total_bytes <= self.max_bytes:
+				break
+			if key in self.pin_counts:
+				continue
+
+			self.total_bytes= self.total_bytes - len(self.frames.pop(key))
@@ -0,0 +1,141 @@
+import json
+import sqlite3
+import threading
+
+# Persistent store of probe results (layout, dimensions, orientation) for every image we've scanned, so that a
+# restart or a "reload" doesn't need to open every image file again just to find out which ones are portraits.
+# Entries are keyed by path and are only trusted while the file's size and modification time still match.
+# Also stores a snapshot of each scanned directory, so that the image scanner only needs to list directories whose
+# modification time has changed.
+index_schema_version= 1
+
+class ImageMetadata:
+	def __init__(self, size, mtime_ns, layout, width, height, orientation):
+		self.size= size
+		self.mtime_ns= mtime_ns
+		self.layout= layout # int value of pycastblaster.ImageLayout
+		self.width= width # dimensions after applying EXIF orientation
+		self.height= height
+		self.orientation= orientation # raw EXIF orientation tag, 1 if missing
+
+class DirectorySnapshot:
+	def __init__(self, mtime_ns, subdirectory_names, image_file_names):
+		self.mtime_ns= mtime_ns
+		self.subdirectory_names= subdirectory_names
+		self.image_file_names= image_file_names
+
+class ImageIndex:
+	def __init__(self, index_file_path):
+		# Commit in batches, one transaction per probed image would be slower than probing on an SD card
+		self.commit_batch_size= 500
+		self.pending_write_count= 0
+
+		# Accessed by the image scanner, the image server and the web server
+		self.lock= threading.Lock()
+		self.connection= sqlite3.connect(index_file_path, check_same_thread= False)
+
+		user_version= self.connection.execute("PRAGMA user_version").fetchone()[0]
+		if user_version != index_schema_version:
+			# Probe results are cheap to regenerate compared to migrating them, just start over
+			self.connection.execute("DROP TABLE IF EXISTS images")
+			self.connection.execute("PRAGMA user_version = %d" % index_schema_version)
+
+		self.connection.execute(
+			"CREATE TABLE IF NOT EXISTS images ("
+			"path TEXT PRIMARY KEY, "
+			"size INTEGER NOT NULL, "
+			"mtime_ns INTEGER NOT NULL, "
+			"layout INTEGER NOT NULL, "
+			"width INTEGER NOT NULL, "
+			"height INTEGER NOT NULL, "
+			"orientation INTEGER NOT NULL)")
+		self.connection.execute(
+			"CREATE TABLE IF NOT EXISTS directories ("
+			"path TEXT PRIMARY KEY, "
+			"mtime_ns INTEGER NOT NULL, "
+			"subdirectory_names TEXT NOT NULL, " # JSON list
+			"image_file_names TEXT NOT NULL)") # JSON list
+		self.connection.commit()
+
+		# Keep the whole index in memory, lookups happen for every file on every scan. Even with a few hundred
+		# thousand images this is only tens of megabytes.
+		self.entries= {} # Dictionary: path -> ImageMetadata
+		for path, size, mtime_ns, layout, width, height, orientation in self.connection.execute("SELECT * FROM images"):
+			self.entries[path]= ImageMetadata(size, mtime_ns, layout, width, height, orientation)
+
+		self.directories= {} # Dictionary: path -> DirectorySnapshot
+		for path, mtime_ns, subdirectory_names, image_file_names in self.connection.execute("SELECT * FROM directories"):
+			self.directories[path]= DirectorySnapshot(mtime_ns, json.loads(subdirectory_names), json.loads(image_file_names))
+
+	def __len__(self):
+		return len(self.entries)
+
+	# Returns the ImageMetadata for path, or None if we don't have any or the file has changed since it was probed
+	def get(self, path, size, mtime_ns):
+		metadata= self.entries.get(path)
+		if metadata is None or metadata.size != size or metadata.mtime_ns != mtime_ns:
+			return None
+		return metadata
+
+	# Returns: the ImageMetadata for path without checking whether the file has changed since it was probed, or None.
+	# For when the caller knows the file's directory hasn't changed and would rather not stat the file.
+	def get_unverified(self, path):
+		return self.entries.get(path)
+
+	def put(self, path, metadata):
+		with self.lock:
+			self.entries[path]= metadata
+			self.connection.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?)", (
+				path,
+				metadata.size,
+				metadata.mtime_ns,
+				metadata.layout,
+				metadata.width,
+				metadata.height,
+				metadata.orientation))
+			self.pending_write_count= self.pending_write_count + 1
+
+			if self.pending_write_count >= self.commit_batch_size:
+				self.connection.commit()
+				self.pending_write_count= 0
+
+	def remove(self, paths):
+		with self.lock:
+			for path in paths:
+				if self.entries.pop(path, None) is not None:
+					self.connection.execute("DELETE FROM images WHERE path = ?", (path,))
+					self.pending_write_count= self.pending_write_count + 1
+
+	def get_directory(self, path):
+		return self.directories.get(path)
+
+	def get_directory_paths(self):
+		return list(self.directories.keys())
+
+	def put_directory(self, path, snapshot):
+		with self.lock:
+			self.directories[path]= snapshot
+			self.connection.execute("INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?)", (
+				path,
+				snapshot.mtime_ns,
+				json.dumps(snapshot.subdirectory_names),
+				json.dumps(snapshot.image_file_names)))
+			self.pending_write_count= self.pending_write_count + 1
+
+	def remove_directories(self, paths):
+		with self.lock:
+			for path in paths:
+				if self.directories.pop(path, None) is not None:
+					self.connection.execute("DELETE FROM directories WHERE path = ?", (path,))
+					self.pending_write_count= self.pending_write_count + 1
+
+	def flush(self):
+		with self.lock:
+			if self.pending_write_count > 0:
+				self.connection.commit()
+				self.pending_write_count= 0
+
+	def close(self):
+		self.flush()
+		with self.lock:
+			self.connection.close()
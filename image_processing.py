@@ -1,8 +1,19 @@
-import PIL.Image, PIL.ImageDraw, PIL.ImageOps, PIL.ImageFilter
+import PIL.Image, PIL.ImageChops, PIL.ImageDraw, PIL.ImageOps, PIL.ImageFilter, PIL.ExifTags
 import pillow_heif
+import collections
+import concurrent.futures
+import contextlib
+import io
+import logging
+import math
 import os.path
 import enum
 
+import metrics
+
+# Passed on to pycastblaster.log() in the main process, dropped in render worker processes
+logger= logging.getLogger(__name__)
+
 #test_image_file_name= "images/image_test/001.heic"
 image_processing_directory= "nas_mount/"
 aspect_ratio_720p= 1280 / 720 # 720p resolution
@@ -18,6 +29,56 @@ class ImageProcessing(enum.IntEnum):
 
 landscape_processing_mode= ImageProcessing.Blur
 portrait_processing_mode= ImageProcessing.Crop
+# Blur radius for ImageProcessing.Blur, relative to the image's full resolution
+blur_radius_pixels= 16
+
+# Spliced frames: number of images -> (columns, rows) of the grid they're laid out in, filling the same frame as a
+# landscape image
+splice_layouts= {
+	2 : (2, 1), # portraits side-by-side
+	3 : (3, 1), # tall images (e.g. phone screenshots) side-by-side, a third of the frame each
+	4 : (2, 2) } # portraits in a grid
+# Portraits this narrow (about 9:16 or narrower) lose less to cropping in a third of the frame than in half of it
+tall_aspect_ratio= 0.6
+# Black line between spliced images
+divider_half_width_px= 4
+
+# Formats frames can be encoded in: name -> (Pillow format, file extension). Progressive JPEGs are usually a little
+# smaller than baseline ones, WebP is smaller again but not every receiver can show it.
+frame_formats= {
+	"jpeg" : ("JPEG", ".jpg"),
+	"progressive_jpeg" : ("JPEG", ".jpg"),
+	"webp" : ("WEBP", ".webp") }
+chroma_subsamplings= ("4:4:4", "4:2:2", "4:2:0")
+# The byte budget search doesn't go below this quality, it's better to go over budget than to send a blocky frame
+min_budget_quality= 30
+
+# How frames are encoded for the Chromecast. Passed to render worker processes with each frame.
+class EncoderSettings:
+	def __init__(self, frame_format= "jpeg", quality= 75, chroma_subsampling= "4:2:0", max_bytes= 0):
+		self.frame_format= frame_format # key of frame_formats
+		self.quality= quality # 1 to 95
+		self.chroma_subsampling= chroma_subsampling # JPEG only, lossy WebP is always 4:2:0
+		self.max_bytes= max_bytes # 0: no limit, otherwise the quality is lowered until frames fit (see encode_image)
+
+	def get_file_extension(self):
+		return frame_formats[self.frame_format][1]
+
+	# Returns: everything that affects the encoded frame, for render_engine.get_frame_key()
+	def get_key_data(self):
+		return (self.frame_format, self.quality, self.chroma_subsampling, self.max_bytes)
+
+# Set to a metrics.StageTimer (in render worker processes) to time the stages of rendering
+stage_timer= None
+
+probe_seconds_histogram= metrics.registry.histogram("pycastblaster_probe_seconds",
+	"Time to read an image's dimensions and orientation from its header")
+
+# Returns: context manager that adds the time taken by the with block to stage_name in stage_timer, if there is one
+def timed_stage(stage_name):
+	if stage_timer is None:
+		return contextlib.nullcontext()
+	return stage_timer.stage(stage_name)
 
 # Support for HEIC image format since that is sometimes produced by iOS
 pillow_heif.register_avif_opener()
@@ -41,19 +102,122 @@ def crop_image_preserve_height(image, target_aspect_ratio):
 		horizontal_crop_half + target_width,
 		image.height))
 
+# Returns: (target aspect ratio, output width, output height, ImageProcessing) for an image of the given (rotated)
+# dimensions
+def get_frame_layout(width, height):
+	if width >= height: # landscape
+		target_aspect_ratio= aspect_ratio_720p
+		processing_mode= landscape_processing_mode
+	else: #portait
+		# We will try to fit two portrait images at a time so crop to half-screen
+		target_aspect_ratio= aspect_ratio_720p / 2
+		processing_mode= portrait_processing_mode
+
+	return (target_aspect_ratio, int(max_image_height_pixels * target_aspect_ratio), max_image_height_pixels, processing_mode)
+
+# Returns: (width, height, EXIF orientation) of an image after it's rotated by its EXIF orientation, from its header
+def get_rotated_size(image):
+	width, height= image.size
+	orientation= get_exif_orientation(image)
+	if orientation in transposed_orientations:
+		width, height= height, width
+	return (width, height, orientation)
+
 def process_image(image):
+	if max_image_height_pixels <= 0:
+		# Keeping the original resolution, nothing to be saved by decoding at a smaller size
+		return process_image_full_resolution(image)
+
+	# Work out the output size from the header before decoding anything
+	width, height, _orientation= get_rotated_size(image)
+	_target_aspect_ratio, output_width, output_height, processing_mode= get_frame_layout(width, height)
+	logger.debug("processing %s" % ("landscape" if width >= height else "portrait"))
+
+	return process_image_to_size(image, output_width, output_height, processing_mode)
+
+# Returns: the image (not decoded yet) rotated, cropped or blurred according to processing_mode, and scaled to exactly
+# output_width x output_height. Decodes at the smallest size that's still big enough, where the format allows it.
+def process_image_to_size(image, output_width, output_height, processing_mode):
+	width, height, orientation= get_rotated_size(image)
+	target_aspect_ratio= output_width / output_height
+
+	# How much the (full resolution) image is scaled to end up in the output: Crop fills the output, Blur fits the
+	# image inside of it.
+	if processing_mode == ImageProcessing.Crop:
+		scale= max(output_width / width, output_height / height)
+	else:
+		scale= min(output_width / width, output_height / height)
+
+	scaled_width= max(math.ceil(width * scale), 1)
+	scaled_height= max(math.ceil(height * scale), 1)
+
+	with timed_stage("decode"):
+		if scale < 1.0:
+			# JPEGs can be decoded at 1/2, 1/4 or 1/8 scale for a fraction of the time and memory of a full decode.
+			# Pillow picks the smallest scale that's still at least the requested size. No-op for other formats.
+			image.draft(None, (scaled_height, scaled_width) if orientation in transposed_orientations else (scaled_width, scaled_height))
+
+		# Images (jpegs only?) may be rotated with EXIF metadata, while the raw image is unrotated
+		# Pillow doesn't apply this rotation automatically so we do so manually if it exists. The
+		# resulting image has the rotation baked in and the EXIF metadata removed.
+		image_result= PIL.ImageOps.exif_transpose(image)
+
+		# Formats without draft support (HEIC, PNG) are decoded at full size, but we can still cheaply shrink them
+		# close to the output size before doing anything more expensive.
+		reduce_factor= min(image_result.width // scaled_width, image_result.height // scaled_height)
+		if reduce_factor > 1:
+			image_result= image_result.reduce(reduce_factor)
+
+	image_aspect_ratio= width / height
+
+	if processing_mode==ImageProcessing.Crop:
+		with timed_stage("resize"):
+			if image_aspect_ratio > target_aspect_ratio: # too wide
+				image_result= crop_image_preserve_height(image_result, target_aspect_ratio)
+			else: # too tall
+				image_result= crop_image_preserve_width(image_result, target_aspect_ratio)
+			image_result= image_result.resize((output_width, output_height))
+	elif processing_mode==ImageProcessing.Blur:
+		with timed_stage("resize"):
+			# Crop a copy to the output aspect ratio and stretch it to fill the output
+			if image_aspect_ratio > target_aspect_ratio: # too wide
+				blurred_copy= crop_image_preserve_height(image_result, target_aspect_ratio)
+			else: # too tall
+				blurred_copy= crop_image_preserve_width(image_result, target_aspect_ratio)
+			blurred_copy= blurred_copy.resize((output_width, output_height))
+
+		with timed_stage("blur"):
+			# blur copy, scaling the blur radius to match blurring at the image's full resolution
+			blurred_copy= blurred_copy.filter(filter= PIL.ImageFilter.BoxBlur(blur_radius_pixels * scale))
+
+		with timed_stage("resize"):
+			# paste the image, scaled to fit, centered in copy
+			image_result= image_result.resize((min(round(width * scale), output_width), min(round(height * scale), output_height)))
+			delta_width= blurred_copy.width - image_result.width
+			delta_height= blurred_copy.height - image_result.height
+			blurred_copy.paste(image_result, (int(delta_width / 2), int(delta_height / 2)))
+			image_result= blurred_copy
+
+	# Convert jpeg's to RGB only (they don't support alpha channels or palette mode)
+	with timed_stage("resize"):
+		return image_result.convert("RGB")
+
+# Process an image at its full resolution before resizing, much slower than process_image() for large images. Used
+# when max_image_height_pixels is disabled, and as the reference that process_image() is checked against.
+def process_image_full_resolution(image):
 	# Images (jpegs only?) may be rotated with EXIF metadata, while the raw image is unrotated
 	# Pillow doesn't apply this rotation automatically so we do so manually if it exists. The
 	# resulting image has the rotation baked in and the EXIF metadata removed.
-	image_result= PIL.ImageOps.exif_transpose(image)
+	with timed_stage("decode"):
+		image_result= PIL.ImageOps.exif_transpose(image)
 
 	if image_result.width >= image_result.height: # landscape
-		print("cropping landscape")
+		logger.debug("cropping landscape")
 		target_aspect_ratio= aspect_ratio_720p
 		max_image_width_pixels= int(max_image_height_pixels * aspect_ratio_720p)
 		processing_mode= landscape_processing_mode		
 	else: #portait
-		print("cropping portrait")
+		logger.debug("cropping portrait")
 		# We will try to fit two portrait images at a time so crop to half-screen
 		target_aspect_ratio= aspect_ratio_720p / 2
 		max_image_width_pixels= int(max_image_height_pixels * aspect_ratio_720p / 2)
@@ -78,7 +242,8 @@ def process_image(image):
 			blurred_copy= blurred_copy.resize((int(image_result.height * target_aspect_ratio), image_result.height))
 
 		# blur copy
-		blurred_copy= blurred_copy.filter(filter= PIL.ImageFilter.BoxBlur(16))
+		with timed_stage("blur"):
+			blurred_copy= blurred_copy.filter(filter= PIL.ImageFilter.BoxBlur(blur_radius_pixels))
 		# paste original centered in copy
 		delta_width= blurred_copy.width - image_result.width
 		delta_height= blurred_copy.height - image_result.height
@@ -94,53 +259,207 @@ def process_image(image):
 
 	return image_result
 
-# Processes an image file to be the right dimensions and saves it to output_image_file_name. If
-# output_image_file_name isn't a supported image type then the image is saved as a jpeg instead.
-# Returns: output_image_file_name, including modified extension if necessary.
-def process_image_file(input_image_file_name, output_image_file_name):
+# How far process_image() may be from process_image_full_resolution(), per channel, in levels (0-255). Decoding at a
+# reduced size and blurring at the output size shift things by a fraction of a pixel, which is invisible over most of
+# the image but can be a large difference along sharp edges (e.g. where the image meets the blurred background).
+max_mean_difference_levels= 2.0
+large_difference_levels= 32
+max_large_difference_fraction= 0.005 # Of the channel values, e.g. a column of pixels down each edge
+
+# Returns: (mean difference in levels, fraction of channel values that differ by large_difference_levels or more)
+# between two RGB images of the same size
+def measure_difference(image_1, image_2):
+	histogram= PIL.ImageChops.difference(image_1, image_2).histogram()
+	value_count= sum(histogram)
+	difference_sum= 0
+	large_difference_count= 0
+	for index, count in enumerate(histogram):
+		difference_sum= difference_sum + (index % 256) * count
+		if index % 256 >= large_difference_levels:
+			large_difference_count= large_difference_count + count
+	return (difference_sum / value_count, large_difference_count / value_count)
+
+# Returns: True if a difference from measure_difference() is within the tolerance for process_image()
+def is_difference_within_tolerance(mean_difference, large_difference_fraction):
+	return mean_difference <= max_mean_difference_levels and large_difference_fraction <= max_large_difference_fraction
+
+# Opens an image file and processes it to be the right dimensions
+def load_processed_image(input_image_file_name):
 	with PIL.Image.open(input_image_file_name, "r") as image:
-		print("opened image '%s'" % input_image_file_name)
-		image= process_image(image)
+		logger.debug("opened image '%s'" % input_image_file_name)
+		return process_image(image)
 
-		# Convert to jpeg if necessary
-		output_root, output_extension= os.path.splitext(output_image_file_name)
-		new_extension= output_extension if output_extension.lower() in supported_image_extensions else ".jpeg"
-		image.save(output_root + new_extension) 
+def encode_image_at_quality(image, encoder_settings, quality):
+	image_bytes= io.BytesIO()
+	pillow_format, _file_extension= frame_formats[encoder_settings.frame_format]
+	if pillow_format == "JPEG":
+		image.save(image_bytes, "JPEG", quality= quality, subsampling= encoder_settings.chroma_subsampling,
+			progressive= encoder_settings.frame_format == "progressive_jpeg")
+	else:
+		image.save(image_bytes, pillow_format, quality= quality)
+	return image_bytes.getvalue()
 
-		return output_root + new_extension
+# Returns: the image encoded with encoder_settings (or as a jpeg with Pillow's defaults if it's None), for serving
+# straight from memory. If it doesn't fit in encoder_settings.max_bytes, the highest quality that fits is found with a
+# binary search. Encoding a frame takes a few milliseconds, a small fraction of decoding and resizing the source
+# image, so the handful of extra encodes is cheap.
+def encode_image(image, encoder_settings= None):
+	with timed_stage("encode"):
+		if encoder_settings is None:
+			image_bytes= io.BytesIO()
+			image.save(image_bytes, "JPEG")
+			return image_bytes.getvalue()
 
-def image_is_portait(image_file_name):
+		image_bytes= encode_image_at_quality(image, encoder_settings, encoder_settings.quality)
+		if encoder_settings.max_bytes <= 0 or len(image_bytes) <= encoder_settings.max_bytes:
+			return image_bytes
+
+		# Smaller files at lower qualities, so search for the highest quality that's within budget. If none are,
+		# settle for the smallest we'll go (which is always the last one tried).
+		low_quality= min_budget_quality
+		high_quality= encoder_settings.quality - 1
+		within_budget_image_bytes= None
+		while low_quality <= high_quality:
+			quality= (low_quality + high_quality) // 2
+			image_bytes= encode_image_at_quality(image, encoder_settings, quality)
+			if len(image_bytes) <= encoder_settings.max_bytes:
+				within_budget_image_bytes= image_bytes
+				low_quality= quality + 1
+			else:
+				high_quality= quality - 1
+
+		return within_budget_image_bytes if within_budget_image_bytes is not None else image_bytes
+
+# Returns: the image in image_file_name scaled down to fit within max_size_pixels x max_size_pixels, encoded as a
+# jpeg, for previews in the web UI
+def load_thumbnail(image_file_name, max_size_pixels):
 	with PIL.Image.open(image_file_name, "r") as image:
-		# Images (jpegs only?) may be rotated with EXIF metadata, while the raw image is unrotated
-		# Pillow doesn't apply this rotation automatically so we do so manually if it exists. The
-		# resulting image has the rotation baked in and the EXIF metadata removed.
-		image= PIL.ImageOps.exif_transpose(image)
-		return image.width < image.height
-	return False
-
-# Splice two portait images side-by-side, assuming they are the same width and height
-def splice_images(image_file_name_1, image_file_name_2, spliced_image_file_name):
-	with PIL.Image.open(image_file_name_1) as image_1:
-		with PIL.Image.open(image_file_name_2) as image_2:
-			image_1= process_image(image_1)
-			image_2= process_image(image_2)
-
-			# Resize one image so that they're the same size. Always resize down to avoid stretching artifacts?
-			if image_1.width > image_2.width:
-				image_1= image_1.resize((image_2.width, image_2.height))
+		# Let the jpeg decoder do most of the scaling, draft() picks a size no smaller than the one we ask for
+		image.draft("RGB", (max_size_pixels, max_size_pixels))
+		image_result= PIL.ImageOps.exif_transpose(image)
+		image_result.thumbnail((max_size_pixels, max_size_pixels))
+		return encode_image(image_result.convert("RGB"))
+
+# Results of inspecting an image file, stored in the image index so that we don't need to open the file again
+class ImageProbe:
+	def __init__(self, width, height, orientation, size, mtime_ns):
+		self.width= width # dimensions after applying EXIF orientation
+		self.height= height
+		self.orientation= orientation # raw EXIF orientation tag, 1 if missing
+		# File size and modification time when it was probed, to tell if the file has changed since
+		self.size= size
+		self.mtime_ns= mtime_ns
+
+	def is_portait(self):
+		return self.width < self.height
+
+# EXIF orientations that rotate the image by 90 or 270 degrees, swapping width and height
+transposed_orientations= (5, 6, 7, 8)
+
+def get_exif_orientation(image):
+	# Pillow looks for PNG eXIf chunks after the image data by decoding the whole image, only use one if it was
+	# already found in the header
+	if image.format == "PNG" and not "exif" in image.info:
+		return 1
+	return image.getexif().get(PIL.ExifTags.Base.Orientation, 1)
+
+# Find an image's dimensions (after EXIF rotation) without decoding it. PIL.Image.open only reads the header, so
+# this is much cheaper than PIL.ImageOps.exif_transpose, which decodes and rotates the whole bitmap.
+def probe_image(image_file_name):
+	with probe_seconds_histogram.time():
+		stat_result= os.stat(image_file_name)
+
+		with PIL.Image.open(image_file_name, "r") as image:
+			width, height= image.size
+
+			if "original_orientation" in image.info:
+				# HEIC/AVIF: libheif already applies the rotation to the size, and pillow_heif resets the EXIF orientation
+				# tag so that it doesn't get applied twice.
+				orientation= image.info["original_orientation"] or 1
 			else:
-				image_2= image_2.resize((image_1.width, image_1.height))
-
-			# Pasting doesn't automatically resize an image so we have to crop it first
-			# (resize() doesn't do what we want because it stretches the original image to fit)
-			image_1= image_1.crop((0, 0, image_1.width * 2, image_1.height))
-			# Make sure to use image_2.width since image_1 has been resized.
-			# paste() operates in-place, unlike most PIL functions so no need to assign to image_1
-			image_1.paste(image_2, (image_2.width, 0))
-			image_drawer= PIL.ImageDraw.Draw(image_1)
-			divider_half_width_px= 4
-			image_drawer.rectangle((image_2.width - divider_half_width_px, 0, image_2.width + divider_half_width_px, image_2.height), fill="#000000")
-			image_1.save(spliced_image_file_name)
+				orientation= get_exif_orientation(image)
+				if orientation in transposed_orientations:
+					width, height= height, width
+
+			return ImageProbe(width, height, orientation, stat_result.st_size, stat_result.st_mtime_ns)
+
+# Probe many images at once. Probing is mostly waiting on file I/O (especially on network drives) so overlap it
+# with a few threads. Yields (image_file_name, ImageProbe or None, exception or None) in the same order as
+# image_file_names, so callers can stop early.
+def probe_images(image_file_names, max_workers= 8):
+	def probe_image_safe(image_file_name):
+		try:
+			return (image_file_name, probe_image(image_file_name), None)
+		except Exception as e:
+			return (image_file_name, None, e)
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers= max_workers) as executor:
+		# Only keep a few probes in flight so that stopping early doesn't leave thousands of queued probes
+		max_pending= max_workers * 4
+		pending= collections.deque()
+		try:
+			for image_file_name in image_file_names:
+				pending.append(executor.submit(probe_image_safe, image_file_name))
+				if len(pending) >= max_pending:
+					yield pending.popleft().result()
+
+			while len(pending) > 0:
+				yield pending.popleft().result()
+		finally:
+			for future in pending:
+				future.cancel()
+
+def image_is_portait(image_file_name):
+	return probe_image(image_file_name).is_portait()
+
+# Splice portrait images into one frame (see splice_layouts) and save it to spliced_image_file_name
+def splice_images(image_file_names, spliced_image_file_name):
+	spliced_image= compose_images(image_file_names)
+	with timed_stage("save"):
+		spliced_image.save(spliced_image_file_name)
+
+# Returns: the images in image_file_names laid out in a grid (see splice_layouts), in a frame the size of a landscape
+# image. The frame is allocated once, at its final size, and each image is decoded and processed straight to the size
+# of its slot, so there's no processing each image to a whole portrait frame and then resizing it again and growing
+# the canvas to fit the next one.
+def compose_images(image_file_names):
+	columns, rows= splice_layouts[len(image_file_names)]
+
+	if max_image_height_pixels > 0:
+		output_height= max_image_height_pixels
+	else:
+		# Keeping the original resolution, as far as the smallest image allows without stretching it
+		output_height= min(probe_image(image_file_name).height for image_file_name in image_file_names)
+	output_width= int(output_height * aspect_ratio_720p)
+
+	with timed_stage("splice"):
+		frame= PIL.Image.new("RGB", (output_width, output_height))
+
+	for slot_index, image_file_name in enumerate(image_file_names):
+		column= slot_index % columns
+		row= slot_index // columns
+		left= output_width * column // columns
+		top= output_height * row // rows
+		right= output_width * (column + 1) // columns
+		bottom= output_height * (row + 1) // rows
+
+		with PIL.Image.open(image_file_name, "r") as image:
+			logger.debug("opened image '%s'" % image_file_name)
+			slot_image= process_image_to_size(image, right - left, bottom - top, portrait_processing_mode)
+
+		with timed_stage("splice"):
+			frame.paste(slot_image, (left, top))
+
+	with timed_stage("splice"):
+		image_drawer= PIL.ImageDraw.Draw(frame)
+		for column in range(1, columns):
+			divider_x= output_width * column // columns
+			image_drawer.rectangle((divider_x - divider_half_width_px, 0, divider_x + divider_half_width_px, output_height), fill="#000000")
+		for row in range(1, rows):
+			divider_y= output_height * row // rows
+			image_drawer.rectangle((0, divider_y - divider_half_width_px, output_width, divider_y + divider_half_width_px), fill="#000000")
+
+	return frame
 
 def set_max_image_height(new_max_image_height_pixels):
 	global max_image_height_pixels
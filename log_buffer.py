@@ -0,0 +1,120 @@
+import collections
+import enum
+import logging
+import logging.handlers
+import threading
+import time
+
+# Same values as the standard logging module's levels, so that records from it can be passed straight through
+class LogLevel(enum.IntEnum):
+	Debug= logging.DEBUG
+	Info= logging.INFO
+	Warning= logging.WARNING
+	Error= logging.ERROR
+
+	# Returns: the LogLevel called level_name (any case), raises ValueError if there isn't one
+	@staticmethod
+	def from_name(level_name):
+		for level in LogLevel:
+			if level.name.lower() == level_name.lower():
+				return level
+		raise ValueError("Unknown log level '%s'" % level_name)
+
+class LogRecord:
+	def __init__(self, sequence, timestamp, level, component, message, fields):
+		self.sequence= sequence # Increases by one for every record, for asking for records since the last one seen
+		self.timestamp= timestamp # time.time()
+		self.level= level # LogLevel
+		self.component= component # What logged it, usually the name of the thread
+		self.message= message
+		self.fields= fields # dictionary of extra details, for filtering or graphing, may be empty
+
+	def format(self):
+		return "%s: %s" % (time.strftime("%m/%d/%Y %H:%M:%S", time.localtime(self.timestamp)), self.message)
+
+	# Like format(), plus the level, component and fields, for the log file
+	def format_detailed(self):
+		fields_string= "".join(" %s=%s" % (name, value) for name, value in self.fields.items())
+		return "%s %s [%s]: %s%s" % (
+			time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.timestamp)),
+			self.level.name.upper(),
+			self.component,
+			self.message,
+			fields_string)
+
+	def to_json(self):
+		return {
+			"sequence" : self.sequence,
+			"timestamp" : self.timestamp,
+			"level" : self.level.name.lower(),
+			"component" : self.component,
+			"message" : self.message,
+			"fields" : self.fields }
+
+# The most recent max_record_count log records, of every level, kept in memory so that they can be queried from the
+# web server. Appending is O(1), the oldest records drop off the end. Records can also be written to a rotating log
+# file (see open_file), to keep diagnostics for longer than the buffer does.
+class LogBuffer:
+	def __init__(self, max_record_count):
+		self.lock= threading.Lock()
+		self.records= collections.deque(maxlen= max_record_count)
+		self.next_sequence= 1
+
+		self.file_level= LogLevel.Info
+		self.file_handler= None
+
+	# Also write records at file_level and above to file_path. Once it grows beyond max_bytes it's renamed to
+	# file_path.1 (file_path.1 to file_path.2 and so on), keeping up to backup_count old files.
+	def open_file(self, file_path, max_bytes, backup_count, file_level):
+		with self.lock:
+			# Let the standard library deal with rotating the file
+			self.file_handler= logging.handlers.RotatingFileHandler(file_path, maxBytes= max_bytes, backupCount= backup_count,
+				encoding= "utf-8")
+			self.file_level= file_level
+
+	def close(self):
+		with self.lock:
+			if self.file_handler is not None:
+				self.file_handler.close()
+				self.file_handler= None
+
+	# Returns: the new LogRecord
+	def append(self, level, component, message, fields):
+		with self.lock:
+			record= LogRecord(self.next_sequence, time.time(), level, component, message, fields)
+			self.next_sequence= self.next_sequence + 1
+			self.records.append(record)
+
+			if self.file_handler is not None and level >= self.file_level:
+				self.file_handler.emit(logging.makeLogRecord({ "msg" : record.format_detailed() }))
+
+			return record
+
+	# Returns: list of the LogRecords after since_sequence at min_level or above, oldest first
+	def get_records(self, since_sequence, min_level):
+		with self.lock:
+			records= []
+			for record in reversed(self.records):
+				if record.sequence <= since_sequence:
+					break
+				if record.level >= min_level:
+					records.append(record)
+			records.reverse()
+			return records
+
+# Passes records from the standard logging module (as used by the modules that can't call pycastblaster.log()) on to
+# log_function(level, component, message)
+class LogFunctionHandler(logging.Handler):
+	def __init__(self, log_function):
+		logging.Handler.__init__(self)
+		self.log_function= log_function
+
+	def emit(self, record):
+		try:
+			level= LogLevel.Debug
+			for candidate_level in LogLevel:
+				if record.levelno >= candidate_level:
+					level= candidate_level
+			self.log_function(level, record.name, record.getMessage())
+		except Exception:
+			self.handleError(record)
@@ -0,0 +1,173 @@
+import bisect
+import contextlib
+import math
+import threading
+import time
+
+# Counters, gauges and histograms, served in the Prometheus text format from /metrics. Recording a value only takes a
+# lock and an addition (plus a bisect for histograms), everything else is left until somebody asks for the text.
+
+# Suits durations from a few milliseconds (probing a header) to tens of seconds (a slow NAS)
+default_buckets= (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def format_labels(labels, extra_label= None):
+	label_items= list(labels)
+	if extra_label is not None:
+		label_items.append(extra_label)
+	if len(label_items) == 0:
+		return ""
+	return "{" + ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"')) for name, value in label_items) + "}"
+
+def format_value(value):
+	if value == math.inf:
+		return "+Inf"
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+	type_name= "counter"
+
+	def __init__(self, name, labels):
+		self.name= name
+		self.labels= labels # tuple of (label name, value)
+		self.lock= threading.Lock()
+		self.value= 0
+
+	def inc(self, amount= 1):
+		with self.lock:
+			self.value= self.value + amount
+
+	def format_samples(self):
+		return ["%s%s %s" % (self.name, format_labels(self.labels), format_value(self.value))]
+
+# A value that goes up and down. Either set() it, or pass function, which is called whenever the value is needed, for
+# values that are cheaper to look at when asked than to keep up to date (queue lengths...)
+class Gauge:
+	type_name= "gauge"
+
+	def __init__(self, name, labels, function= None):
+		self.name= name
+		self.labels= labels
+		self.function= function
+		self.value= 0
+
+	def set(self, value):
+		self.value= value
+
+	def format_samples(self):
+		value= self.value
+		if self.function is not None:
+			try:
+				value= self.function()
+			except Exception:
+				return [] # Whatever it was looking at has gone away
+		return ["%s%s %s" % (self.name, format_labels(self.labels), format_value(value))]
+
+class Histogram:
+	type_name= "histogram"
+
+	def __init__(self, name, labels, buckets):
+		self.name= name
+		self.labels= labels
+		self.lock= threading.Lock()
+		self.upper_bounds= tuple(sorted(buckets))
+		self.bucket_counts= [0] * (len(self.upper_bounds) + 1) # Not cumulative, the last one is +Inf
+		self.sum= 0.0
+		self.count= 0
+
+	def observe(self, value):
+		bucket_index= bisect.bisect_left(self.upper_bounds, value)
+		with self.lock:
+			self.bucket_counts[bucket_index]= self.bucket_counts[bucket_index] + 1
+			self.sum= self.sum + value
+			self.count= self.count + 1
+
+	# Observe the number of seconds the with block takes
+	@contextlib.contextmanager
+	def time(self):
+		start_time= time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(time.perf_counter() - start_time)
+
+	def format_samples(self):
+		with self.lock:
+			bucket_counts= list(self.bucket_counts)
+			sum_value= self.sum
+			count= self.count
+
+		samples= []
+		cumulative_count= 0
+		for upper_bound, bucket_count in zip(self.upper_bounds + (math.inf,), bucket_counts):
+			cumulative_count= cumulative_count + bucket_count
+			samples.append("%s_bucket%s %d" % (self.name, format_labels(self.labels, ("le", format_value(upper_bound))), cumulative_count))
+		samples.append("%s_sum%s %s" % (self.name, format_labels(self.labels), format_value(sum_value)))
+		samples.append("%s_count%s %d" % (self.name, format_labels(self.labels), count))
+		return samples
+
+# Every metric, by name and labels. Asking for a metric that already exists returns the existing one, so modules can
+# look metrics up when they need them rather than having to share them.
+class MetricsRegistry:
+	def __init__(self):
+		self.lock= threading.Lock()
+		self.metrics= {} # (name, labels) -> metric, in the order they were first asked for
+		self.help_texts= {} # name -> help text
+
+	def get_metric(self, metric_class, name, help_text, labels, *args):
+		labels= tuple(sorted(labels.items())) if labels else ()
+		with self.lock:
+			metric= self.metrics.get((name, labels))
+			if metric is None:
+				metric= metric_class(name, labels, *args)
+				self.metrics[(name, labels)]= metric
+				self.help_texts.setdefault(name, help_text)
+			return metric
+
+	def counter(self, name, help_text, labels= None):
+		return self.get_metric(Counter, name, help_text, labels)
+
+	# function replaces the function of an existing gauge, so that whatever it was looking at can be replaced
+	def gauge(self, name, help_text, labels= None, function= None):
+		gauge= self.get_metric(Gauge, name, help_text, labels)
+		if function is not None:
+			gauge.function= function
+		return gauge
+
+	def histogram(self, name, help_text, labels= None, buckets= default_buckets):
+		return self.get_metric(Histogram, name, help_text, labels, buckets)
+
+	# Returns: every metric in the Prometheus text exposition format
+	def format_text(self):
+		with self.lock:
+			metrics= list(self.metrics.values())
+			help_texts= dict(self.help_texts)
+
+		# Metrics with the same name (and different labels) have to be listed together
+		metrics_by_name= {}
+		for metric in metrics:
+			metrics_by_name.setdefault(metric.name, []).append(metric)
+
+		lines= []
+		for name, named_metrics in metrics_by_name.items():
+			lines.append("# HELP %s %s" % (name, help_texts[name].replace("\\", "\\\\").replace("\n", "\\n")))
+			lines.append("# TYPE %s %s" % (name, named_metrics[0].type_name))
+			for metric in named_metrics:
+				lines.extend(metric.format_samples())
+		return "\n".join(lines) + "\n"
+
+# The registry served from /metrics
+registry= MetricsRegistry()
+
+# Adds up how long each stage of some work takes, for work done where the registry can't be reached directly (in a
+# render worker process), to be sent back and observed afterwards.
+class StageTimer:
+	def __init__(self):
+		self.stage_seconds= {} # stage name -> seconds
+
+	@contextlib.contextmanager
+	def stage(self, stage_name):
+		start_time= time.perf_counter()
+		try:
+			yield
+		finally:
+			self.stage_seconds[stage_name]= self.stage_seconds.get(stage_name, 0.0) + time.perf_counter() - start_time
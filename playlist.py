@@ -0,0 +1,76 @@
+import bisect
+import random
+import threading
+
+# The shuffled order that the image server shows images in. Written by the image server thread only, read by the web
+# server for the web UI, so reads that need a consistent view take the lock instead of copying the whole list.
+# Items before the unplayed_index given to insert_shuffled() are never moved, so indices the image server is tracking
+# for frames it has already planned stay valid when new items are inserted.
+class Playlist:
+	def __init__(self):
+		self.lock= threading.Lock()
+		self.items= []
+		self.current_index= -1 # Index of the item on screen, -1 if nothing has been shown yet
+
+	def __len__(self):
+		return len(self.items)
+
+	def __getitem__(self, index):
+		return self.items[index]
+
+	def set_current_index(self, current_index):
+		with self.lock:
+			self.current_index= current_index
+
+	# Insert new_items at random positions at or after unplayed_index, as if they had been shuffled in with the items
+	# already there. Each new item is appended and then swapped with a random item in the unplayed region (the
+	# "inside-out" Fisher-Yates shuffle), so this is O(len(new_items)) no matter how long the playlist is.
+	# Returns: list of the indices whose items changed (some may be listed twice)
+	def insert_shuffled(self, new_items, unplayed_index):
+		changed_indices= []
+		with self.lock:
+			items= self.items
+			for new_item in new_items:
+				items.append(new_item)
+				# random.randint is several times slower, which adds up for the first scan of a big library
+				swap_index= unplayed_index + int(random.random() * (len(items) - unplayed_index))
+				items[-1], items[swap_index]= items[swap_index], items[-1]
+				changed_indices.append(swap_index)
+				changed_indices.append(len(items) - 1)
+		return changed_indices
+
+	# Remove every item that should_remove(item) returns True for, keeping the rest in order. current_index is
+	# shifted to account for removed items before it.
+	# Returns: sorted list of the indices that were removed, for shifting any other indices the caller is tracking
+	def remove(self, should_remove):
+		with self.lock:
+			removed_indices= []
+			kept_count= 0
+			for index, item in enumerate(self.items):
+				if should_remove(item):
+					removed_indices.append(index)
+				else:
+					# Compact in place rather than building a second list
+					self.items[kept_count]= item
+					kept_count= kept_count + 1
+			del self.items[kept_count:]
+
+			if self.current_index >= 0:
+				self.current_index= get_shifted_index(self.current_index, removed_indices)
+			return removed_indices
+
+	def shuffle(self):
+		with self.lock:
+			random.shuffle(self.items)
+
+	# Returns: (index of the first item in the window, items in the window, current_index, number of items), all as of
+	# the same moment. The window is up to before_count items before current_index to after_count items after it.
+	def get_window(self, before_count, after_count):
+		with self.lock:
+			window_start_index= max(self.current_index - before_count, 0)
+			window_end_index= min(self.current_index + after_count, len(self.items) - 1)
+			return (window_start_index, self.items[window_start_index:window_end_index], self.current_index, len(self.items))
+
+# Returns: index, shifted down by the number of removed_indices (sorted) before it
+def get_shifted_index(index, removed_indices):
+	return index - bisect.bisect_left(removed_indices, index)
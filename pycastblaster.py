@@ -1,13 +1,25 @@
+import asyncio
+import collections
+import concurrent.futures
+import copy
+import email.utils
 import enum
+import heapq
 import http.server
 import json
+import logging
+import math
+import mimetypes
 import os
+import queue
 import random
+import re
 import shutil
 import socket
 import sys
 import threading
 import time
+import urllib.parse
 import uuid
 
 import pychromecast
@@ -15,7 +27,19 @@ import pychromecast.discovery
 import ruamel.yaml
 import zeroconf
 
+import async_http_server
+import cast_queue
+import frame_store
+import directory_watcher
+import image_index
 import image_processing
+import log_buffer
+import metrics
+import playlist
+import render_cache
+import render_engine
+import thumbnails
+import versioned_state
 
 class Config:
 	def __init__(self) -> None:
@@ -23,32 +47,84 @@ class Config:
 		self.local_images_path= "images/"
 		self.local_temp_path= "temp/"
 		self.http_server_port= 8000
+		self.http_server_mode= "threaded" # "threaded": a thread per connection, "asyncio": every connection on one thread
+		self.http_server_max_connections= 64 # asyncio mode only
+		self.http_server_keep_alive_seconds= 15 # asyncio mode only
 		# Resize generated images down to this scale, so that they can be loaded faster by chromecast.
 		# Adjust to max support resolution of your chromecast.
 		self.max_image_height_pixels= 720
+		self.portraits_per_frame= 2 # 2: side-by-side, 4: in a 2x2 grid (tall images are 3 to a frame either way)
+		# How frames are encoded for the Chromecast (format, quality, chroma subsampling and byte budget)
+		self.encoder_settings= image_processing.EncoderSettings()
 		self.chromecast_friendly_name= "Family Room TV"
+		self.cast_transport= "load" # "load": load each frame on its own, "queue": preload the next frame in the Chromecast's queue
+		# Chromecasts to cast to (DeviceConfig), empty to just cast to chromecast_friendly_name. See get_devices().
+		self.devices= []
 		self.slideshow_duration_seconds= 5
 		self.interruption_idle_seconds= 20
 		self.image_scanning_frequency_seconds= 10 * 60 # 10 minutes
+		self.image_scanning_use_inotify= True
+		self.image_scanning_concurrency= 8
+		self.image_scanning_warm_start= True # Start with the images from the last scan, rather than waiting for this one
+		self.render_ahead_frames= 2
+		self.render_worker_count= 0 # 0: one per CPU core
+		self.render_cache_bytes= 256 * 1024 * 1024
+		self.frame_store_bytes= 64 * 1024 * 1024
+		self.thumbnail_cache_bytes= 64 * 1024 * 1024
+		self.log_level= log_buffer.LogLevel.Info # Printed, shown on the website and written to log_file_path
+		self.log_file_path= "" # "": don't write a log file
+		self.log_file_bytes= 10 * 1024 * 1024
+		self.log_file_count= 5
 
 		# Not configurable (no need to expose additional complexity)
 		self.local_temp_image_list_file_name= "pycastblaster_temp_files.txt"
 		self.local_temp_image_list_file_path= os.path.join(self.local_temp_path, self.local_temp_image_list_file_name)
+		self.local_image_index_file_name= "pycastblaster_image_index.db"
+		self.local_image_index_file_path= os.path.join(self.local_temp_path, self.local_image_index_file_name)
+		self.local_render_cache_directory_name= "render_cache"
+		self.local_render_cache_path= os.path.join(self.local_temp_path, self.local_render_cache_directory_name)
+		self.local_thumbnail_cache_directory_name= "thumbnail_cache"
+		self.local_thumbnail_cache_path= os.path.join(self.local_temp_path, self.local_thumbnail_cache_directory_name)
 		self.server_url= "http://" + get_ip() + ":" + str(self.http_server_port)
 		image_processing.set_max_image_height(self.max_image_height_pixels)
 
+	# Returns: list of DeviceConfig, one per Chromecast to cast to
+	def get_devices(self):
+		if len(self.devices) > 0:
+			return self.devices
+		return [DeviceConfig(self.chromecast_friendly_name, self.max_image_height_pixels, self.encoder_settings)]
+
+# Settings for one of the Chromecasts we cast to
+class DeviceConfig:
+	def __init__(self, friendly_name, max_image_height_pixels, encoder_settings):
+		self.friendly_name= friendly_name
+		self.max_image_height_pixels= max_image_height_pixels
+		self.encoder_settings= encoder_settings # image_processing.EncoderSettings
+
 class Globals:
 	def __init__(self) -> None:
 		self.exit_event= threading.Event() # Quit gracefully (stops casting session)
 		self.reload_event= threading.Event() # Restart gracefully after quitting. Set *before* setting exit_event.
+		self.start_time= time.monotonic() # When we started up (or reloaded settings), for measuring time to first frame
 		self.paused= False
-		# State of the ImageServerThread, stored in globals so that it can be accessed by the HTTP Request Handlers
-		self.image_references= ()
-		self.current_image_reference_index= -1
-		self.image_reference_lock= threading.Lock()
+		# Playlist of the (first) ImageServerThread, stored in globals so that it can be shown by the web UI
+		self.playlist= playlist.Playlist()
 		
-		self.recent_logs= []
-		self.recent_logs_lock= threading.Lock()
+		# What the web UI shows, including recent logs, pushed to it as it changes
+		self.state= versioned_state.VersionedState()
+		# Recent logs of every level, for /logs
+		self.log_buffer= log_buffer.LogBuffer(10000)
+		# Commands from the website are run one at a time, whichever web server thread they come in on
+		self.command_lock= threading.Lock()
+		# One ImageServerThread per Chromecast (created in main()), for passing on commands from the website
+		self.image_servers= []
+
+		# Probe results for every scanned image, persisted in local_temp_path (opened in main())
+		self.image_index= None
+		# Rendered frames for the web server to send to the Chromecast, None if frames are served from files instead
+		self.frame_store= None
+		# Previews for the web UI (created in main())
+		self.thumbnail_generator= None
 
 g_config= None # Config
 g_globals= None # Globals()
@@ -56,6 +132,27 @@ g_globals= None # Globals()
 def get_config_file_path():
 	return "config.yaml" if (len(sys.argv) == 1) else sys.argv[1]
 
+# Returns: image_processing.EncoderSettings with the frame_ options in settings_yaml (the config file, or one of its
+# chromecasts) applied to a copy of default_encoder_settings
+def load_encoder_settings(settings_yaml, default_encoder_settings):
+	encoder_settings= copy.copy(default_encoder_settings)
+	if "frame_format" in settings_yaml:
+		frame_format= str(settings_yaml["frame_format"]).lower()
+		if frame_format in image_processing.frame_formats:
+			encoder_settings.frame_format= frame_format
+		else:
+			log("ERROR: Unknown frame_format '%s', using '%s'" % (frame_format, encoder_settings.frame_format))
+	if "frame_quality" in settings_yaml: encoder_settings.quality= min(max(int(settings_yaml["frame_quality"]), 1), 95)
+	if "frame_chroma_subsampling" in settings_yaml:
+		chroma_subsampling= str(settings_yaml["frame_chroma_subsampling"])
+		if chroma_subsampling in image_processing.chroma_subsamplings:
+			encoder_settings.chroma_subsampling= chroma_subsampling
+		else:
+			log("ERROR: Unknown frame_chroma_subsampling '%s', using '%s'" % (chroma_subsampling, encoder_settings.chroma_subsampling))
+	# User-facing config option is in kilobytes for convenience
+	if "frame_max_kilobytes" in settings_yaml: encoder_settings.max_bytes= int(float(settings_yaml["frame_max_kilobytes"]) * 1024)
+	return encoder_settings
+
 def load_config():
 	config_file_path= get_config_file_path()
 
@@ -74,18 +171,71 @@ def load_config():
 				g_config.local_temp_path= config_yaml["temp_path"]
 				# have the default local_temp_image_list_file_path be relative to local_temp_image_path
 				g_config.local_temp_image_list_file_path= os.path.join(g_config.local_temp_path, g_config.local_temp_image_list_file_name)
+				g_config.local_image_index_file_path= os.path.join(g_config.local_temp_path, g_config.local_image_index_file_name)
+				g_config.local_render_cache_path= os.path.join(g_config.local_temp_path, g_config.local_render_cache_directory_name)
+				g_config.local_thumbnail_cache_path= os.path.join(g_config.local_temp_path, g_config.local_thumbnail_cache_directory_name)
 			if "http_server_port" in config_yaml:
 				g_config.http_server_port= int(config_yaml["http_server_port"])
 				g_config.server_url= "http://" + get_ip() + ":" + str(g_config.http_server_port)
+			if "http_server_mode" in config_yaml:
+				g_config.http_server_mode= str(config_yaml["http_server_mode"]).lower()
+				if not g_config.http_server_mode in ("threaded", "asyncio"):
+					log("ERROR: Unknown http_server_mode '%s', using 'threaded'" % g_config.http_server_mode)
+					g_config.http_server_mode= "threaded"
+			if "http_server_max_connections" in config_yaml: g_config.http_server_max_connections= int(config_yaml["http_server_max_connections"])
+			if "http_server_keep_alive_seconds" in config_yaml: g_config.http_server_keep_alive_seconds= float(config_yaml["http_server_keep_alive_seconds"])
 			if "chromecast_name" in config_yaml: g_config.chromecast_friendly_name= config_yaml["chromecast_name"]
+			if "cast_transport" in config_yaml:
+				g_config.cast_transport= str(config_yaml["cast_transport"]).lower()
+				if not g_config.cast_transport in ("load", "queue"):
+					log("ERROR: Unknown cast_transport '%s', using 'load'" % g_config.cast_transport)
+					g_config.cast_transport= "load"
 			if "slideshow_duration_seconds" in config_yaml: g_config.slideshow_duration_seconds= float(config_yaml["slideshow_duration_seconds"])
 			if "max_image_height_pixels" in config_yaml:
 				g_config.max_image_height_pixels= int(config_yaml["max_image_height_pixels"])
 				image_processing.set_max_image_height(g_config.max_image_height_pixels)
+			if "portraits_per_frame" in config_yaml:
+				g_config.portraits_per_frame= int(config_yaml["portraits_per_frame"])
+				if not g_config.portraits_per_frame in (2, 4):
+					log("ERROR: Unsupported portraits_per_frame '%d', using 2" % g_config.portraits_per_frame)
+					g_config.portraits_per_frame= 2
+			g_config.encoder_settings= load_encoder_settings(config_yaml, g_config.encoder_settings)
+			# After max_image_height_pixels and the frame_ options, which are the defaults for each device
+			if "chromecasts" in config_yaml:
+				g_config.devices= []
+				for device_yaml in config_yaml["chromecasts"]:
+					# Either just the name, or the name and settings that are different for this Chromecast
+					if isinstance(device_yaml, str):
+						device_config= DeviceConfig(device_yaml, g_config.max_image_height_pixels, g_config.encoder_settings)
+					else:
+						device_config= DeviceConfig(str(device_yaml["name"]),
+							int(device_yaml.get("max_image_height_pixels", g_config.max_image_height_pixels)),
+							load_encoder_settings(device_yaml, g_config.encoder_settings))
+
+					if device_config.friendly_name in [existing_device_config.friendly_name for existing_device_config in g_config.devices]:
+						log("ERROR: Chromecast '%s' is listed more than once in chromecasts, ignoring it" % device_config.friendly_name)
+					else:
+						g_config.devices.append(device_config)
 			if "interruption_idle_seconds" in config_yaml: g_config.interruption_idle_seconds= int(config_yaml["interruption_idle_seconds"])
 			# User-facing config option is in minutes for convenience, but using seconds internally since that's what time.sleep() uses.
 			if "image_scanning_frequency_minutes" in config_yaml: g_config.image_scanning_frequency_seconds= \
 				60 * int(config_yaml["image_scanning_frequency_minutes"])
+			if "image_scanning_use_inotify" in config_yaml: g_config.image_scanning_use_inotify= bool(config_yaml["image_scanning_use_inotify"])
+			if "image_scanning_concurrency" in config_yaml: g_config.image_scanning_concurrency= int(config_yaml["image_scanning_concurrency"])
+			if "image_scanning_warm_start" in config_yaml: g_config.image_scanning_warm_start= bool(config_yaml["image_scanning_warm_start"])
+			if "render_ahead_frames" in config_yaml: g_config.render_ahead_frames= int(config_yaml["render_ahead_frames"])
+			if "render_worker_count" in config_yaml: g_config.render_worker_count= int(config_yaml["render_worker_count"])
+			# User-facing config option is in megabytes for convenience
+			if "render_cache_megabytes" in config_yaml: g_config.render_cache_bytes= \
+				int(float(config_yaml["render_cache_megabytes"]) * 1024 * 1024)
+			if "frame_store_megabytes" in config_yaml: g_config.frame_store_bytes= \
+				int(float(config_yaml["frame_store_megabytes"]) * 1024 * 1024)
+			if "log_level" in config_yaml: g_config.log_level= log_buffer.LogLevel.from_name(str(config_yaml["log_level"]))
+			if "log_file_path" in config_yaml: g_config.log_file_path= config_yaml["log_file_path"]
+			if "log_file_megabytes" in config_yaml: g_config.log_file_bytes= int(float(config_yaml["log_file_megabytes"]) * 1024 * 1024)
+			if "log_file_count" in config_yaml: g_config.log_file_count= int(config_yaml["log_file_count"])
+			if "thumbnail_cache_megabytes" in config_yaml: g_config.thumbnail_cache_bytes= \
+				int(float(config_yaml["thumbnail_cache_megabytes"]) * 1024 * 1024)
 
 # In Ubuntu, socket.gethostbyname(socket.gethostname()) returns '127.0.0.1', instead of 192.168.0.X
 # Per, https://stackoverflow.com/questions/166506/finding-local-ip-addresses-using-pythons-stdlib, this will return
@@ -103,22 +253,173 @@ def get_ip():
 			s.close()
 		return IP
 
+# Returns: thread_name, with the Chromecast's name after it when we're casting to more than one, to tell their threads apart
+def get_device_thread_name(thread_name, chromecast_friendly_name):
+	if len(g_config.get_devices()) > 1:
+		return "%s (%s)" % (thread_name, chromecast_friendly_name)
+	return thread_name
+
+# Prometheus text exposition format
+metrics_content_type= "text/plain; version=0.0.4; charset=utf-8"
+
+# Rendered frames in g_globals.frame_store are served from URLs starting with this
+frame_url_prefix= "/frame/"
+
+# Served from /metrics, see also image_processing and render_engine
+scan_seconds_histogram_buckets= (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+full_scan_seconds_histogram= metrics.registry.histogram("pycastblaster_scan_seconds", "Time to scan for new and deleted images",
+	{ "kind" : "full" }, scan_seconds_histogram_buckets)
+directory_scan_seconds_histogram= metrics.registry.histogram("pycastblaster_scan_seconds", "Time to scan for new and deleted images",
+	{ "kind" : "directory" }, scan_seconds_histogram_buckets)
+scanned_images_counter= metrics.registry.counter("pycastblaster_scanned_images_total", "Images seen while scanning, new or not")
+play_media_seconds_histogram= metrics.registry.histogram("pycastblaster_play_media_seconds", "Time to send a frame to the Chromecast")
+block_until_active_seconds_histogram= metrics.registry.histogram("pycastblaster_block_until_active_seconds",
+	"Time waiting for the Chromecast to start showing a frame after sending it")
+play_media_failures_counter= metrics.registry.counter("pycastblaster_play_media_failures_total", "Frames the Chromecast didn't show")
+render_wait_seconds_histogram= metrics.registry.histogram("pycastblaster_render_wait_seconds",
+	"Time spent waiting for a frame to finish rendering when it was time to show it")
+frame_lateness_seconds_histogram= metrics.registry.histogram("pycastblaster_frame_lateness_seconds",
+	"How long after slideshow_duration_seconds (plus time paused), or a next, previous or jump_to_index command, the Chromecast started showing each frame")
+frames_shown_counter= metrics.registry.counter("pycastblaster_frames_shown_total", "Frames shown on the Chromecast")
+def get_frames_sent_counter(transport):
+	return metrics.registry.counter("pycastblaster_frames_sent_total",
+		"Frames shown on the Chromecast, by how they were sent: queue_next (preloaded in its queue), queue_load (a new queue) or load",
+		{ "transport" : transport })
+frames_sent_queue_next_counter= get_frames_sent_counter("queue_next")
+frames_sent_queue_load_counter= get_frames_sent_counter("queue_load")
+frames_sent_load_counter= get_frames_sent_counter("load")
+def get_frame_cache_counter(result):
+	return metrics.registry.counter("pycastblaster_frame_cache_lookups_total",
+		"Frames looked up before rendering, by where they were found: memory (frame_store_megabytes), disk (render_cache_megabytes) or miss",
+		{ "result" : result })
+frame_cache_memory_counter= get_frame_cache_counter("memory")
+frame_cache_disk_counter= get_frame_cache_counter("disk")
+frame_cache_miss_counter= get_frame_cache_counter("miss")
+
 # file extension to MIME type
 content_type_dictionary= {
 	".jpg" :  "image/jpeg",
 	".jpeg" : "image/jpeg",
-	".png" : "image.png" }
+	".png" : "image/png",
+	".heic" : "image/heic",
+	".webp" : "image/webp" }
+# For frames served from files in local_temp_path, Python only knows WebP from the system's mime.types before 3.13
+mimetypes.add_type("image/webp", ".webp")
+
+# Returns: the MIME type to give the Chromecast for a frame URL
+def get_media_content_type(url):
+	extension= os.path.splitext(urllib.parse.urlsplit(url).path)[1].lower()
+	return content_type_dictionary[extension]
+
+# Returns: the path of image_path_rel within local_images_path, or None if image_path_rel would escape local_images_path
+# Returns: the image path relative to images_path from the rest of an /image/ or /thumb/ URL path, which has each path
+# segment percent-encoded
+def parse_image_path_rel(url_path_rel):
+	return urllib.parse.unquote(urllib.parse.urlsplit(url_path_rel).path)
+
+def get_local_image_path(image_path_rel):
+	# Make sure the requested image path is within the local image path - no extracurricular explorations!
+	local_image_path_abs= os.path.abspath(g_config.local_images_path)
+	image_path_abs= os.path.abspath(os.path.join(local_image_path_abs, image_path_rel))
+
+	if os.path.commonpath([local_image_path_abs]) != os.path.commonpath([local_image_path_abs, image_path_abs]):
+		return None
+	return os.path.join(g_config.local_images_path, image_path_rel)
+
+# Parse a single "bytes=first-last" Range header value, for a file of file_size bytes.
+# Returns: (first byte, last byte) inclusive, or None if the header should be ignored and the whole file sent (it's
+# malformed, or asks for multiple ranges which we don't bother supporting).
+# Raises ValueError if the range can't be satisfied.
+def parse_byte_range(range_header, file_size):
+	match= re.fullmatch(r"\s*bytes\s*=\s*(\d*)-(\d*)\s*", range_header)
+	if match is None or match.group(1) == match.group(2) == "":
+		return None
+
+	if match.group(1) == "":
+		# Suffix range: the last N bytes
+		suffix_length= int(match.group(2))
+		if suffix_length == 0 or file_size == 0:
+			raise ValueError("Unsatisfiable range '%s'" % range_header)
+		return (max(file_size - suffix_length, 0), file_size - 1)
+
+	first_byte= int(match.group(1))
+	last_byte= min(int(match.group(2)), file_size - 1) if match.group(2) != "" else file_size - 1
+	if first_byte >= file_size:
+		raise ValueError("Unsatisfiable range '%s'" % range_header)
+	if last_byte < first_byte:
+		return None
+	return (first_byte, last_byte)
 
 class ImageLayout(enum.IntEnum):
 	Unknown= 0
 	Landscape= 1
 	Portrait= 2
+	Tall= 3 # Very narrow portrait, e.g. a phone screenshot (see image_processing.tall_aspect_ratio)
+
+# Layouts that are spliced together with other images
+portrait_image_layouts= (ImageLayout.Portrait, ImageLayout.Tall)
+
+# Returns: the ImageLayout of an image with the given (rotated) dimensions
+def get_image_layout(width, height):
+	if width >= height:
+		return ImageLayout.Landscape
+	if width / height <= image_processing.tall_aspect_ratio:
+		return ImageLayout.Tall
+	return ImageLayout.Portrait
 
 class ImageReference:
-	def __init__(self, local_image_path, url_path, image_layout=ImageLayout.Unknown):
+	def __init__(self, local_image_path, url_path, image_layout=ImageLayout.Unknown, file_size=None, file_mtime_ns=None):
 		self.local_image_path= local_image_path
 		self.url_path= url_path
 		self.image_layout= image_layout
+		# As of when the image was scanned, None if unknown
+		self.file_size= file_size
+		self.file_mtime_ns= file_mtime_ns
+
+	# Returns: (path, size, mtime_ns), identifying this version of the image file for the render cache
+	def get_identity(self):
+		if self.file_size is None or self.file_mtime_ns is None:
+			stat_result= os.stat(self.local_image_path)
+			self.file_size= stat_result.st_size
+			self.file_mtime_ns= stat_result.st_mtime_ns
+		return (self.local_image_path, self.file_size, self.file_mtime_ns)
+
+# Build an ImageReference for a local image, loading its layout from the image index if the file hasn't changed since
+# it was last probed. Only stats the file (unless stat_result is given), never opens it. If verify is False then the
+# image index is trusted without even stating the file.
+def load_image_reference(local_image_path, verify= True, stat_result= None):
+	if not verify:
+		metadata= g_globals.image_index.get_unverified(local_image_path)
+		if metadata:
+			return ImageReference(local_image_path, "", get_image_layout(metadata.width, metadata.height), metadata.size, metadata.mtime_ns)
+
+	if stat_result is None:
+		stat_result= os.stat(local_image_path)
+	metadata= g_globals.image_index.get(local_image_path, stat_result.st_size, stat_result.st_mtime_ns)
+	# From the dimensions rather than the stored layout, which may be from before a layout was added
+	image_layout= get_image_layout(metadata.width, metadata.height) if metadata else ImageLayout.Unknown
+	return ImageReference(local_image_path, "", image_layout, stat_result.st_size, stat_result.st_mtime_ns)
+
+# Returns: True if path is directory_path or somewhere below it
+def is_path_within(path, directory_path):
+	return path == directory_path or path.startswith(os.path.join(directory_path, ""))
+
+# Open the image to find out its layout, and remember the result in the image index so that we don't need to open it
+# again, even after restarting.
+def classify_image_reference(image_reference):
+	apply_image_probe(image_reference, image_processing.probe_image(image_reference.local_image_path))
+
+def apply_image_probe(image_reference, probe):
+	image_reference.image_layout= get_image_layout(probe.width, probe.height)
+	image_reference.file_size= probe.size
+	image_reference.file_mtime_ns= probe.mtime_ns
+	g_globals.image_index.put(image_reference.local_image_path, image_index.ImageMetadata(
+		probe.size,
+		probe.mtime_ns,
+		int(image_reference.image_layout),
+		probe.width,
+		probe.height,
+		probe.orientation))
 
 # Build the URL path:
 # 1. include the root server URL
@@ -127,29 +428,258 @@ class ImageReference:
 def local_image_file_path_to_url(local_image_file_path):
 	return g_config.server_url + "/" + os.path.relpath(local_image_file_path, g_config.local_temp_path)
 
-def log(string_arg):
-	current_time = time.localtime()
-	string= "%s: %s" % (time.strftime("%m/%d/%Y %H:%M:%S", current_time), string_arg)
-	print(string)
+# Log a message. Messages starting with "ERROR" are logged at LogLevel.Error unless level says otherwise. fields are
+# extra details to keep with the message, see /logs. Messages below g_config.log_level are only kept in
+# g_globals.log_buffer, they aren't printed or shown on the website.
+def log(string_arg, level= None, component= None, **fields):
+	if level is None:
+		level= log_buffer.LogLevel.Error if string_arg.startswith("ERROR") else log_buffer.LogLevel.Info
+	if component is None:
+		component= threading.current_thread().name
 
 	global g_globals
 
 	if (g_globals):
-		g_globals.recent_logs_lock.acquire()
-		g_globals.recent_logs.append(string)
+		record= g_globals.log_buffer.append(level, component, string_arg, fields)
+	else:
+		record= log_buffer.LogRecord(0, time.time(), level, component, string_arg, fields)
+
+	if level >= (g_config.log_level if g_config else log_buffer.LogLevel.Info):
+		string= record.format()
+		print(string)
 
-		max_log_lines= 200
+		if (g_globals):
+			g_globals.state.append_log(string)
 
-		while (len(g_globals.recent_logs) > max_log_lines):
-			g_globals.recent_logs.pop(0)
+# Update the playlist part of g_globals.state for the web UI: the images around the current one
+def publish_playlist_state():
+	image_index_min, image_subset, current_image_index, image_count= g_globals.playlist.get_window(4, 10)
+
+	g_globals.state.update({
+		"images" : [os.path.relpath(image_reference.local_image_path, g_config.local_images_path) for image_reference in image_subset],
+		"current_image_index" : current_image_index,
+		"images_min_index" : image_index_min,
+		"image_count" : image_count })
+
+	# Get previews of the images in the list ready in the background, before anybody clicks on them
+	if g_globals.thumbnail_generator is not None:
+		for image_reference in image_subset:
+			try:
+				g_globals.thumbnail_generator.prefetch(image_reference.local_image_path, thumbnails.preview_thumbnail_size,
+					image_reference.get_identity())
+			except OSError:
+				pass # Deleted? The image scanner will catch up
+
+# Request handling shared by HTTPHandler and AsyncHTTPHandler
+
+# Returns: the whole of g_globals.state, including recent logs, as JSON
+def get_state_message():
+	_version, state_data, log_lines= g_globals.state.get_changes(0)
+	state_data["log_lines"]= log_lines
+	return json.dumps(state_data)
+
+# /logs?since=<sequence>&level=<debug|info|warning|error>: records after since (default: all of them) at level and
+# above (default: debug), oldest first. Pass the returned "sequence" as since next time to only get new records.
+# Returns: the records as JSON, raises ValueError if the query is invalid
+def get_logs_message(query_string):
+	query= urllib.parse.parse_qs(query_string)
+	since_sequence= int(query.get("since", ["0"])[0])
+	min_level= log_buffer.LogLevel.from_name(query.get("level", ["debug"])[0])
+
+	records= g_globals.log_buffer.get_records(since_sequence, min_level)
+	return json.dumps({
+		"sequence" : records[-1].sequence if len(records) > 0 else since_sequence,
+		"records" : [record.to_json() for record in records] })
+
+# Returns: the bytes of the frame for a /frame/ URL path, or None if it isn't in g_globals.frame_store
+def get_frame_bytes(url_path):
+	# Ignore the query string, it's only there to stop the Chromecast from caching frames
+	frame_key= urllib.parse.urlsplit(url_path).path.removeprefix(frame_url_prefix)
+	return g_globals.frame_store.get(frame_key) if g_globals.frame_store is not None else None
+
+# Returns: the MIME type of the frame for a /frame/ URL path, from the file extension at the end of its key
+def get_frame_content_type(url_path):
+	return content_type_dictionary[os.path.splitext(urllib.parse.urlsplit(url_path).path)[1]]
+
+# /thumb/<size>/<image path>
+# Returns: (local image path, thumbnail size), or None if there's no such thumbnail
+def parse_thumbnail_path(url_path):
+	thumbnail_size, _separator, url_path_rel= url_path.removeprefix("/thumb/").partition("/")
+	image_path_rel= parse_image_path_rel(url_path_rel)
+
+	local_image_path= get_local_image_path(image_path_rel)
+	if (local_image_path is None or not thumbnail_size.isdigit() or not int(thumbnail_size) in thumbnails.thumbnail_sizes or
+		g_globals.thumbnail_generator is None):
+		return None
+	return (local_image_path, int(thumbnail_size))
+
+# Returns: the g_globals.state version to start an event stream from, for a browser reconnecting with Last-Event-ID
+def get_state_events_since_version(request_headers):
+	instance_id, _separator, version= request_headers.get("Last-Event-ID", "").partition(":")
+	if instance_id == g_globals.state.instance_id and version.isdigit():
+		return int(version)
+	return 0
+
+def format_state_event(version, changed_values, new_log_lines):
+	event_data= json.dumps({ "state" : changed_values, "log_lines" : new_log_lines })
+	return ("id: %s:%d\ndata: %s\n\n" % (g_globals.state.instance_id, version, event_data)).encode('utf-8')
+
+# Returns: True if the client's cached copy of a file with this etag and modification time is still good
+def is_not_modified(request_headers, etag, mtime_seconds):
+	if_none_match= request_headers.get("If-None-Match")
+	if if_none_match is not None:
+		# If-Modified-Since is ignored when If-None-Match is present
+		return if_none_match.strip() == "*" or etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+
+	if_modified_since= request_headers.get("If-Modified-Since")
+	if if_modified_since is not None:
+		try:
+			return int(mtime_seconds) <= email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+		except (TypeError, ValueError):
+			pass
+	return False
+
+# Work out how to respond to a request for a file. Supports conditional requests (ETag/Last-Modified) so the web UI
+# doesn't download the same image twice, and single Range requests so large images can be resumed or fetched in
+# pieces.
+# Returns: (status, list of (header name, value), offset of the first byte to send, number of bytes to send). Doesn't
+# include Content-Length.
+def get_file_response(request_headers, stat_result, content_type):
+	file_size= stat_result.st_size
+	etag= '"%x-%x"' % (stat_result.st_mtime_ns, file_size)
+	last_modified= email.utils.formatdate(stat_result.st_mtime, usegmt= True)
+
+	if is_not_modified(request_headers, etag, stat_result.st_mtime):
+		return (http.HTTPStatus.NOT_MODIFIED, [('ETag', etag), ('Last-Modified', last_modified)], 0, 0)
+
+	byte_range= None
+	range_header= request_headers.get("Range")
+	if_range= request_headers.get("If-Range")
+	# Only send part of the file if the client's partial copy is of the same version of the file
+	if range_header is not None and (if_range is None or if_range.strip() in (etag, last_modified)):
+		try:
+			byte_range= parse_byte_range(range_header, file_size)
+		except ValueError:
+			return (http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE, [('Content-Range', "bytes */%d" % file_size)], 0, 0)
+
+	headers= [
+		('Content-type', content_type),
+		('Accept-Ranges', "bytes"),
+		('ETag', etag),
+		('Last-Modified', last_modified)]
+
+	if byte_range is None:
+		return (http.HTTPStatus.OK, headers, 0, file_size)
+
+	headers.append(('Content-Range', "bytes %d-%d/%d" % (byte_range[0], byte_range[1], file_size)))
+	return (http.HTTPStatus.PARTIAL_CONTENT, headers, byte_range[0], byte_range[1] - byte_range[0] + 1)
+
+# Let the image servers know that something they wait on changed (pausing, the slideshow duration, quitting)
+def wake_image_servers():
+	for image_server in g_globals.image_servers:
+		image_server.wake()
+
+# Handle a /command POST from the website. Called on web server threads (or the asyncio server's executor), so
+# commands are run one at a time.
+# Returns: (status, message)
+def execute_command(post_data_string):
+	global g_globals
+	global g_config
+
+	status= http.HTTPStatus.OK
+	message= "POST request for /command"
+
+	with g_globals.command_lock:
+		post_data_json= json.loads(post_data_string)
+		command_name= post_data_json["name"]
+		command_parameters= post_data_json["parameters"]
+
+		if (command_name == "exit"):
+			log("Received 'exit' command, quitting.")
+			g_globals.exit_event.set()
+			wake_image_servers()
+		elif (command_name == "pause"):
+			g_globals.paused= not g_globals.paused
+			g_globals.state.update({ "is_paused" : g_globals.paused })
+			log("Received 'pause' command, toggling pause '%s'." % ("On" if g_globals.paused else "Off"))
+			wake_image_servers()
+		elif (command_name == "next" or command_name == "previous"):
+			log("Received '%s' command, showing the %s image." % (command_name, command_name))
+			for image_server in g_globals.image_servers:
+				image_server.send_command(command_name, None)
+		elif (command_name == "jump_to_index"):
+			# An index into the playlist shown on the website, i.e. the first Chromecast's
+			try:
+				image_index= int(command_parameters)
+			except (TypeError, ValueError):
+				image_index= -1
+			if image_index < 0:
+				message= command_name + ": Invalid index '%s'" % (command_parameters)
+				status= http.HTTPStatus.BAD_REQUEST
+			else:
+				log("Received '%s' command, showing image [%d]." % (command_name, image_index))
+				for image_server in g_globals.image_servers:
+					if image_server.playlist is g_globals.playlist:
+						image_server.send_command(command_name, image_index)
+		elif (command_name == "reload"):
+			log("Received 'reload' command, restarting.")
+			g_globals.reload_event.set()
+			g_globals.exit_event.set()
+			wake_image_servers()
+		elif (command_name == "duration_update"):
+			duration_seconds= float(command_parameters)
+			if duration_seconds <= 0:
+				message= command_name + ": Invalid duration '%s'" % (command_parameters)
+				status= http.HTTPStatus.BAD_REQUEST
+			else:
+				log("Received '%s' command, updating duration (%f) -> (%f)" % (command_name, g_config.slideshow_duration_seconds, duration_seconds))
+				g_config.slideshow_duration_seconds= duration_seconds
+				g_globals.state.update({ "slideshow_duration_seconds" : g_config.slideshow_duration_seconds })
+				wake_image_servers()
+
+				config_file_path= get_config_file_path()
+
+				if not os.path.exists(config_file_path):
+					log("No config file '%s', unable to save change to slideshow duration" % config_file_path)
+				else:
+					with open(config_file_path) as config_file_read:
+						yaml_read_writer= ruamel.yaml.YAML() # round-trip loader preserves comments
+						yaml_read_writer.preserve_quotes= True
+						config_yaml= yaml_read_writer.load(config_file_read)
+						config_yaml["slideshow_duration_seconds"]= g_config.slideshow_duration_seconds
+
+						config_file_read.close()
+
+						# Safety dance - make sure we don't do a partial write of the config file
+						config_file_path_new= config_file_path + ".new"
+						config_file_path_old= config_file_path + ".old"
+						with open(config_file_path_new, "w+") as config_file_write:
+							yaml_read_writer.dump(config_yaml, config_file_write)
+							config_file_write.close()
+							
+							# If os.replace is atomic and safe then we could do: os.replace(config_file_path, config_file_path_new)
+							if os.path.exists(config_file_path_old):
+								os.remove(config_file_path_old)
+							os.rename(config_file_path, config_file_path_old)
+							os.rename(config_file_path_new, config_file_path)
+							os.remove(config_file_path_old)
+							
+		else:
+			message= "Received unknown command '%s'" % (str(command_name))
+			log(message)
+			status= http.HTTPStatus.BAD_REQUEST
 
-		g_globals.recent_logs_lock.release()
+	return (status, message)
 
 # Custom class in order to serve up a specific subdirectory
 class HTTPHandler(http.server.SimpleHTTPRequestHandler):
 	def __init__(self, *args, **kwargs):
 		super().__init__(*args, directory=g_config.local_temp_path, **kwargs)
 
+	# Every request the Chromecast and the website make would otherwise be printed
+	def log_message(self, format, *args):
+		log("%s %s" % (self.address_string(), format % args), level= log_buffer.LogLevel.Debug, component= "web_server")
+
 	def _set_response(self, status):
 		self.send_response(status)
 		self.send_header('Content-type', 'text/html')
@@ -159,135 +689,290 @@ class HTTPHandler(http.server.SimpleHTTPRequestHandler):
 		global g_globals
 
 		if (self.path == "/state"):
-			g_globals.image_reference_lock.acquire()
-			g_globals.recent_logs_lock.acquire()
-
-			status= http.HTTPStatus.OK
-			message= "GET request for {}".format(self.path)
-			image_index_min= max(g_globals.current_image_reference_index - 4, 0)
-			image_index_max= min(g_globals.current_image_reference_index + 10, len(g_globals.image_references) - 1)
-			image_subset= g_globals.image_references[image_index_min:image_index_max]
-
-			state_data= {
-				"chromecast_name" : g_config.chromecast_friendly_name,
-				"is_paused" : g_globals.paused,
-				"slideshow_duration_seconds" : g_config.slideshow_duration_seconds,
-				"image_path" : g_config.local_images_path,
-				"images" : [os.path.relpath(image_reference.local_image_path, g_config.local_images_path) for image_reference in image_subset],
-				"current_image_index" : g_globals.current_image_reference_index,
-				"images_min_index" : image_index_min,
-				"image_count" : len(g_globals.image_references),
-				"log_lines" : g_globals.recent_logs
-			}
-			message= json.dumps(state_data)
-			g_globals.recent_logs_lock.release()
-			g_globals.image_reference_lock.release()
+			self._set_response(http.HTTPStatus.OK)
+			self.wfile.write(get_state_message().encode('utf-8'))
+		elif (self.path == "/metrics"):
+			self.send_response(http.HTTPStatus.OK)
+			self.send_header('Content-type', metrics_content_type)
+			self.end_headers()
+			self.wfile.write(metrics.registry.format_text().encode('utf-8'))
+		elif (self.path == "/events"):
+			self.send_state_events()
+		elif (urllib.parse.urlsplit(self.path).path == "/logs"):
+			try:
+				message= get_logs_message(urllib.parse.urlsplit(self.path).query)
+			except ValueError as e:
+				self.send_error(http.HTTPStatus.BAD_REQUEST,"Error: '%s'" % e)
+				return
 
-			self._set_response(status)
+			self.send_response(http.HTTPStatus.OK)
+			self.send_header('Content-type', "application/json")
+			self.end_headers()
 			self.wfile.write(message.encode('utf-8'))
+		elif (self.path.startswith(frame_url_prefix)):
+			frame_bytes= get_frame_bytes(self.path)
+
+			if frame_bytes is None:
+				self.send_error(http.HTTPStatus.NOT_FOUND,"Frame Not Found: '%s'" % (self.path))
+			else:
+				self.send_response(http.HTTPStatus.OK)
+				self.send_header('Content-type', get_frame_content_type(self.path))
+				self.send_header('Content-Length', str(len(frame_bytes)))
+				self.end_headers()
+				self.wfile.write(frame_bytes)
 		elif (self.path.startswith("/image/")):
-			g_globals.image_reference_lock.acquire()
-			image_path_rel= self.path.removeprefix("/image/").replace("%20", " ")
+			image_path_rel= parse_image_path_rel(self.path.removeprefix("/image/"))
 
 			try:
-				# Make sure the requested image path is within the local image path - no extracurricular explorations!
-				local_image_path_abs= os.path.abspath(g_config.local_images_path)
-				image_path_abs= os.path.abspath(os.path.join(local_image_path_abs, image_path_rel))
-
-				if os.path.commonpath([local_image_path_abs]) == os.path.commonpath([local_image_path_abs, image_path_abs]):
-					with open(os.path.join(g_config.local_images_path, image_path_rel), "rb") as image_file:
-						#note that this potentially makes every file on your computer readable by the internet
-						self.send_response(http.HTTPStatus.OK)
-						extension= os.path.splitext(image_path_rel)[1].lower()
-						content_type= content_type_dictionary[extension]
-						self.send_header('Content-type', content_type)
-						self.end_headers()
-						self.wfile.write(image_file.read())
+				local_image_path= get_local_image_path(image_path_rel)
+				if local_image_path is not None:
+					#note that this potentially makes every file on your computer readable by the internet
+					extension= os.path.splitext(image_path_rel)[1].lower()
+					self.send_file(local_image_path, content_type_dictionary[extension])
 				else:
 					self.send_error(http.HTTPStatus.NOT_FOUND,"File Not Found: '%s'" % (image_path_rel))
 			except IOError as e:
 				self.send_error(http.HTTPStatus.NOT_FOUND,"File Not Found: '%s': '%s'" % (image_path_rel, e))
 			except Exception as e:
 				self.send_error(http.HTTPStatus.BAD_REQUEST,"Error: '%s'" % e)
-			finally:
-				g_globals.image_reference_lock.release()
+		elif (self.path.startswith("/thumb/")):
+			try:
+				thumbnail_request= parse_thumbnail_path(self.path)
+				if thumbnail_request is None:
+					self.send_error(http.HTTPStatus.NOT_FOUND,"Thumbnail Not Found: '%s'" % (self.path))
+				else:
+					thumbnail_bytes= g_globals.thumbnail_generator.submit(*thumbnail_request).result()
+					self.send_response(http.HTTPStatus.OK)
+					self.send_header('Content-type', content_type_dictionary[thumbnails.thumbnail_file_extension])
+					self.send_header('Content-Length', str(len(thumbnail_bytes)))
+					self.end_headers()
+					self.wfile.write(thumbnail_bytes)
+			except IOError as e:
+				self.send_error(http.HTTPStatus.NOT_FOUND,"File Not Found: '%s': '%s'" % (self.path, e))
+			except Exception as e:
+				self.send_error(http.HTTPStatus.BAD_REQUEST,"Error: '%s'" % e)
 		else:
 			super().do_GET()
 
-	def do_POST(self):
-		global g_globals
-		global g_config
+	# Server-sent events: push changes to g_globals.state to the web UI as they happen, instead of it polling /state.
+	# Each event's data is {"state": changed values, "log_lines": new log lines}. The first event has everything. The
+	# event id lets the browser pick up where it left off when it reconnects.
+	def send_state_events(self):
+		state= g_globals.state
+		since_version= get_state_events_since_version(self.headers)
+
+		self.send_response(http.HTTPStatus.OK)
+		self.send_header('Content-type', "text/event-stream")
+		self.send_header('Cache-Control', "no-cache")
+		self.end_headers()
+		# No Content-Length, the end of the stream is the end of the connection
+		self.close_connection= True
 
+		try:
+			while not state.closed:
+				version, changed_values, new_log_lines= state.wait_for_changes(since_version, 15.0)
+				if version == since_version:
+					# Nothing happened, send a comment so that we find out if the browser has gone away
+					self.wfile.write(b": keep-alive\n\n")
+				else:
+					since_version= version
+					self.wfile.write(format_state_event(version, changed_values, new_log_lines))
+		except ConnectionError:
+			pass # The page was closed
+
+	# Send a file without reading it into memory, using sendfile where possible
+	def send_file(self, file_path, content_type):
+		with open(file_path, "rb") as file:
+			status, headers, offset, count= get_file_response(self.headers, os.fstat(file.fileno()), content_type)
+
+			self.send_response(status)
+			for header_name, header_value in headers:
+				self.send_header(header_name, header_value)
+			if status != http.HTTPStatus.NOT_MODIFIED:
+				self.send_header('Content-Length', str(count))
+			self.end_headers()
+
+			if count == 0:
+				return
+
+			try:
+				# Falls back to reading and sending chunks if sendfile isn't available
+				self.connection.sendfile(file, offset, count)
+			except ConnectionError:
+				# The browser went away, e.g. the user clicked on a different image, nothing we can do about it
+				self.close_connection= True
+
+	def do_POST(self):
 		content_length = int(self.headers['Content-Length']) # <--- Gets the size of data
 		post_data = self.rfile.read(content_length) # <--- Gets the data itself
 		post_data_string= post_data.decode('utf-8')
 		# log("POST request,\nPath: %s\nHeaders:\n%s\n\nBody:\n%s\n" % (str(self.path), str(self.headers), post_data_string))
-		status= http.HTTPStatus.OK
-		message= "POST request for {}".format(self.path)
 
 		if (self.path == "/command"):
-			post_data_json= json.loads(post_data_string)
-			command_name= post_data_json["name"]
-			command_parameters= post_data_json["parameters"]
-
-			if (command_name == "exit"):
-				log("Received 'exit' command, quitting.")
-				g_globals.exit_event.set()
-			elif (command_name == "pause"):
-				g_globals.paused= not g_globals.paused
-				log("Received 'pause' command, toggling pause '%s'." % ("On" if g_globals.paused else "Off"))
-			elif (command_name == "reload"):
-				log("Received 'reload' command, restarting.")
-				g_globals.reload_event.set()
-				g_globals.exit_event.set()
-			elif (command_name == "duration_update"):
-				duration_seconds= float(command_parameters)
-				if duration_seconds <= 0:
-					message= command_name + ": Invalid duration '%s'" % (command_parameters)
-					status= http.HTTPStatus.BAD_REQUEST
-				else:
-					log("Received '%s' command, updating duration (%f) -> (%f)" % (command_name, g_config.slideshow_duration_seconds, duration_seconds))
-					g_config.slideshow_duration_seconds= duration_seconds
+			status, message= execute_command(post_data_string)
+
+			self._set_response(status)
+			self.wfile.write(message.encode('utf-8'))
 
-					config_file_path= get_config_file_path()
+# Serves the same routes as HTTPHandler, for AsyncWebServerThread. Anything that might block (opening images on the
+# NAS, commands that write the config file, waiting for thumbnails) is done on the event loop's executor or awaited,
+# so that one slow request doesn't hold up every other connection.
+class AsyncHTTPHandler:
+	async def handle_request(self, request):
+		log("%s %s" % (request.method, request.path), level= log_buffer.LogLevel.Debug, component= "web_server")
 
-					if not os.path.exists(config_file_path):
-						log("No config file '%s', unable to save change to slideshow duration" % config_file_path)
-					else:
-						with open(config_file_path) as config_file_read:
-							yaml_read_writer= ruamel.yaml.YAML() # round-trip loader preserves comments
-							yaml_read_writer.preserve_quotes= True
-							config_yaml= yaml_read_writer.load(config_file_read)
-							config_yaml["slideshow_duration_seconds"]= g_config.slideshow_duration_seconds
-
-							config_file_read.close()
-
-							# Safety dance - make sure we don't do a partial write of the config file
-							config_file_path_new= config_file_path + ".new"
-							config_file_path_old= config_file_path + ".old"
-							with open(config_file_path_new, "w+") as config_file_write:
-								yaml_read_writer.dump(config_yaml, config_file_write)
-								config_file_write.close()
-								
-								# If os.replace is atomic and safe then we could do: os.replace(config_file_path, config_file_path_new)
-								if os.path.exists(config_file_path_old):
-									os.remove(config_file_path_old)
-								os.rename(config_file_path, config_file_path_old)
-								os.rename(config_file_path_new, config_file_path)
-								os.remove(config_file_path_old)
-								
+		loop= asyncio.get_running_loop()
+		url_path= urllib.parse.urlsplit(request.path).path
+
+		try:
+			if request.method == "POST" and request.path == "/command":
+				# Commands touch the same globals as the other threads, run them the same way the threaded server does
+				status, message= await loop.run_in_executor(None, execute_command, request.body.decode('utf-8'))
+				return async_http_server.HTTPResponse(status, [('Content-type', 'text/html')], message.encode('utf-8'))
+			elif request.method != "GET":
+				return self.error_response(http.HTTPStatus.NOT_IMPLEMENTED, "Unsupported method '%s'" % request.method)
+			elif (request.path == "/state"):
+				return async_http_server.HTTPResponse(http.HTTPStatus.OK, [('Content-type', 'text/html')], get_state_message().encode('utf-8'))
+			elif (request.path == "/metrics"):
+				return async_http_server.HTTPResponse(http.HTTPStatus.OK, [('Content-type', metrics_content_type)],
+					metrics.registry.format_text().encode('utf-8'))
+			elif (request.path == "/events"):
+				return async_http_server.HTTPResponse(http.HTTPStatus.OK,
+					[('Content-type', "text/event-stream"), ('Cache-Control', "no-cache")],
+					stream= self.state_events(get_state_events_since_version(request.headers)))
+			elif (url_path == "/logs"):
+				try:
+					message= get_logs_message(urllib.parse.urlsplit(request.path).query)
+				except ValueError as e:
+					return self.error_response(http.HTTPStatus.BAD_REQUEST, "Error: '%s'" % e)
+				return async_http_server.HTTPResponse(http.HTTPStatus.OK, [('Content-type', "application/json")], message.encode('utf-8'))
+			elif (request.path.startswith(frame_url_prefix)):
+				frame_bytes= get_frame_bytes(request.path)
+				if frame_bytes is None:
+					return self.error_response(http.HTTPStatus.NOT_FOUND, "Frame Not Found: '%s'" % (request.path))
+				return async_http_server.HTTPResponse(http.HTTPStatus.OK,
+					[('Content-type', get_frame_content_type(request.path))], frame_bytes)
+			elif (request.path.startswith("/image/")):
+				image_path_rel= parse_image_path_rel(request.path.removeprefix("/image/"))
+				local_image_path= get_local_image_path(image_path_rel)
+				if local_image_path is None:
+					return self.error_response(http.HTTPStatus.NOT_FOUND, "File Not Found: '%s'" % (image_path_rel))
+				#note that this potentially makes every file on your computer readable by the internet
+				extension= os.path.splitext(image_path_rel)[1].lower()
+				return await self.file_response(request, local_image_path, content_type_dictionary[extension])
+			elif (request.path.startswith("/thumb/")):
+				thumbnail_request= parse_thumbnail_path(request.path)
+				if thumbnail_request is None:
+					return self.error_response(http.HTTPStatus.NOT_FOUND, "Thumbnail Not Found: '%s'" % (request.path))
+				# submit() stats the image, which may be on the NAS
+				thumbnail_future= await loop.run_in_executor(None, g_globals.thumbnail_generator.submit, *thumbnail_request)
+				thumbnail_bytes= await asyncio.wrap_future(thumbnail_future)
+				return async_http_server.HTTPResponse(http.HTTPStatus.OK,
+					[('Content-type', content_type_dictionary[thumbnails.thumbnail_file_extension])], thumbnail_bytes)
 			else:
-				message= "Received unknown command '%s'" % (str(command_name))
-				log(message)
-				status= http.HTTPStatus.BAD_REQUEST
+				# Everything else is a file in local_temp_path, like SimpleHTTPRequestHandler
+				file_path= self.get_static_file_path(url_path)
+				if file_path is None:
+					return self.error_response(http.HTTPStatus.NOT_FOUND, "File Not Found: '%s'" % (url_path))
+				content_type= mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+				return await self.file_response(request, file_path, content_type)
+		except OSError as e:
+			return self.error_response(http.HTTPStatus.NOT_FOUND, "File Not Found: '%s': '%s'" % (request.path, e))
+		except Exception as e:
+			return self.error_response(http.HTTPStatus.BAD_REQUEST, "Error: '%s'" % e)
+
+	def error_response(self, status, message):
+		return async_http_server.HTTPResponse(status, [('Content-type', 'text/plain')], message.encode('utf-8'))
+
+	# Returns: path of the file in local_temp_path for url_path (index.html for directories), or None if url_path would
+	# escape local_temp_path
+	def get_static_file_path(self, url_path):
+		temp_path_abs= os.path.abspath(g_config.local_temp_path)
+		file_path_abs= os.path.abspath(os.path.join(temp_path_abs, urllib.parse.unquote(url_path).lstrip("/")))
+		if os.path.commonpath([temp_path_abs, file_path_abs]) != temp_path_abs:
+			return None
+		if url_path.endswith("/"):
+			file_path_abs= os.path.join(file_path_abs, "index.html")
+		return file_path_abs
+
+	async def file_response(self, request, file_path, content_type):
+		file= await asyncio.get_running_loop().run_in_executor(None, open, file_path, "rb")
+		try:
+			status, headers, offset, count= get_file_response(request.headers, os.fstat(file.fileno()), content_type)
+		except:
+			file.close()
+			raise
+
+		if count == 0:
+			file.close()
+			return async_http_server.HTTPResponse(status, headers)
+		return async_http_server.HTTPResponse(status, headers, file= file, offset= offset, count= count)
+
+	# Same events as HTTPHandler.send_state_events, but waits for changes without tying up a thread
+	async def state_events(self, since_version):
+		state= g_globals.state
+		loop= asyncio.get_running_loop()
+		changed_event= asyncio.Event()
+
+		def state_changed():
+			try:
+				loop.call_soon_threadsafe(changed_event.set)
+			except RuntimeError:
+				pass # The event loop has already shut down
 
-			self._set_response(status)
-			self.wfile.write(message.encode('utf-8'))
+		state.add_listener(state_changed)
+		try:
+			while not state.closed:
+				# Clear before looking, so that a change made while we're looking isn't missed
+				changed_event.clear()
+				version, changed_values, new_log_lines= state.get_changes(since_version)
+				if version != since_version:
+					since_version= version
+					yield format_state_event(version, changed_values, new_log_lines)
+					continue
+
+				try:
+					await asyncio.wait_for(changed_event.wait(), 15.0)
+				except asyncio.TimeoutError:
+					# Nothing happened, send a comment so that we find out if the browser has gone away
+					yield b": keep-alive\n\n"
+		finally:
+			state.remove_listener(state_changed)
 
+# Runs the website and serves images to the Chromecast from an asyncio event loop on this thread, instead of a thread
+# per connection. Limits the number of connections and keeps connections alive between requests.
+class AsyncWebServerThread(threading.Thread):
+	def __init__(self):
+		threading.Thread.__init__(self, daemon=True, name="web_server")
+		self.loop= None
+		self.stop_event= None
+
+	def run(self):
+		try:
+			asyncio.run(self.serve())
+		except Exception as e:
+			log("ERROR: Failed to start web server: '%s'" % e)
+			global g_globals
+			g_globals.exit_event.set()
+
+	async def serve(self):
+		self.stop_event= asyncio.Event()
+		http_server= async_http_server.AsyncHTTPServer(AsyncHTTPHandler().handle_request,
+			g_config.http_server_max_connections, g_config.http_server_keep_alive_seconds)
+		await http_server.start("", g_config.http_server_port)
+		self.loop= asyncio.get_running_loop()
+		log("serving at port [%d] (asyncio)" % g_config.http_server_port)
+
+		await self.stop_event.wait()
+		await http_server.close()
+
+	def shutdown(self):
+		if self.loop:
+			self.loop.call_soon_threadsafe(self.stop_event.set)
 
 class WebServerThread(threading.Thread):
 	def __init__(self):
-		threading.Thread.__init__(self, daemon=True)
+		threading.Thread.__init__(self, daemon=True, name="web_server")
 		self.http_server= None
 
 	def run(self):
@@ -305,209 +990,766 @@ class WebServerThread(threading.Thread):
 			self.http_server.shutdown()
 
 
+# Finds portrait images to splice together without searching the playlist (and opening images) when a portrait comes
+# up. Keeps a heap of the playlist indices of known portraits that haven't been planned yet, and walks ahead through
+# the playlist in the background classifying images that the image scanner hasn't got to yet. Heap entries aren't
+# updated when images move or are shown, instead they're checked when they reach the top of the heap.
+class PortraitPairingScheduler:
+	def __init__(self, image_playlist, classified_callback):
+		self.playlist= image_playlist
+		# Called (on another thread) when an image has been classified, so that we carry on scanning ahead
+		self.classified_callback= classified_callback
+		# Dictionary: layout (one of portrait_image_layouts) -> heap of playlist indices, so that looking for one layout
+		# doesn't have to go through the others
+		self.portrait_image_indices= { image_layout : [] for image_layout in portrait_image_layouts }
+		# Every image before scan_image_index has been looked at: it's either not a portrait, in the heap, or being
+		# classified
+		self.scan_image_index= 0
+		self.classify_executor= concurrent.futures.ThreadPoolExecutor(max_workers= 2)
+		self.classifying= {} # Future -> (playlist index, ImageReference)
+		# Unknown images waiting for a classify task, earliest in the playlist first: heap of playlist indices, and
+		# playlist index -> ImageReference
+		self.waiting_image_indices= []
+		self.waiting_image_references= {}
+		# Most images being classified at once, so that a big merge doesn't queue up thousands of image opens. Also
+		# limits how far ahead we get of the images we've actually been able to classify.
+		self.max_classifying_count= 16
+
+	def shutdown(self):
+		self.classify_executor.shutdown(wait= True, cancel_futures= True)
+
+	# Start again from start_image_index, after the playlist was rearranged or planning was rewound
+	def reset(self, start_image_index):
+		self.portrait_image_indices= { image_layout : [] for image_layout in portrait_image_layouts }
+		self.waiting_image_indices= []
+		self.waiting_image_references= {}
+		self.scan_image_index= start_image_index
+
+	# Called after the items at changed_image_indices (from Playlist.insert_shuffled) changed
+	def images_changed(self, changed_image_indices):
+		for image_index in changed_image_indices:
+			if image_index < self.scan_image_index:
+				self.examine_image(image_index)
+
+	# Returns: False if the image is still being classified
+	def examine_image(self, image_index):
+		image_reference= self.playlist[image_index]
+
+		if image_reference.image_layout in portrait_image_layouts:
+			heapq.heappush(self.portrait_image_indices[image_reference.image_layout], image_index)
+		elif image_reference.image_layout == ImageLayout.Unknown:
+			if not image_index in self.waiting_image_references:
+				heapq.heappush(self.waiting_image_indices, image_index)
+			self.waiting_image_references[image_index]= image_reference
+			self.start_classifying()
+			return False
+
+		return True
+
+	# Start classifying waiting images, up to max_classifying_count at a time
+	def start_classifying(self):
+		while len(self.classifying) < self.max_classifying_count and len(self.waiting_image_indices) > 0:
+			image_index= heapq.heappop(self.waiting_image_indices)
+			image_reference= self.waiting_image_references.pop(image_index)
+
+			def classify(image_reference= image_reference):
+				# The image scanner classifies every new image too, it may have beaten us to it
+				if image_reference.image_layout == ImageLayout.Unknown:
+					classify_image_reference(image_reference)
+			future= self.classify_executor.submit(classify)
+			self.classifying[future]= (image_index, image_reference)
+			future.add_done_callback(lambda _future: self.classified_callback())
+
+	def collect_classified_images(self):
+		for future in [future for future in self.classifying.keys() if future.done()]:
+			image_index, image_reference= self.classifying.pop(future)
+			if future.exception() is not None:
+				log("ERROR: Unable to classify image '%s': '%s'" % (image_reference.local_image_path, future.exception()))
+			# Only if it hasn't been moved or removed since. If it was moved then it's been looked at again.
+			elif image_index < len(self.playlist) and self.playlist[image_index] is image_reference:
+				self.images_changed([image_index])
+
+		self.start_classifying()
+
+	# Walk ahead through the playlist, up to max_image_count images, without waiting for any to be classified
+	def scan_ahead(self, max_image_count):
+		self.collect_classified_images()
+
+		image_count= len(self.playlist)
+		while self.scan_image_index < image_count and max_image_count > 0:
+			if (self.playlist[self.scan_image_index].image_layout == ImageLayout.Unknown and
+				len(self.classifying) + len(self.waiting_image_references) >= self.max_classifying_count):
+				break
+			self.examine_image(self.scan_image_index)
+			self.scan_image_index= self.scan_image_index + 1
+			max_image_count= max_image_count - 1
+
+	# Take the earliest portrait in the playlist, of any of image_layouts, off the heaps.
+	# Returns: its playlist index, or None if the heaps for image_layouts are empty
+	def pop_portrait(self, image_layouts):
+		portrait_image_heaps= [self.portrait_image_indices[image_layout] for image_layout in image_layouts]
+		portrait_image_heaps= [portrait_image_heap for portrait_image_heap in portrait_image_heaps if len(portrait_image_heap) > 0]
+		if len(portrait_image_heaps) == 0:
+			return None
+		return heapq.heappop(min(portrait_image_heaps, key= lambda portrait_image_heap: portrait_image_heap[0]))
+
+	# Returns: ImageReferences of the first partner_count known portraits after image_index that aren't in
+	# skip_image_names and whose layout is in partner_layouts, or None if we don't know of that many yet. Never waits
+	# for images to be classified. Only takes portraits of partner_layouts off the heaps.
+	def find_partners(self, image_index, skip_image_names, partner_count, partner_layouts):
+		self.scan_image_index= max(self.scan_image_index, image_index + 1)
+		partner_image_indices= []
+
+		while len(partner_image_indices) < partner_count:
+			portrait_image_index= self.pop_portrait(partner_layouts)
+			if portrait_image_index is None:
+				# Not enough in the heaps, see if there are any portraits in the images we haven't looked at yet (this
+				# is all in memory, it doesn't open any images)
+				previous_scan_image_index= self.scan_image_index
+				self.scan_ahead(1000)
+				if self.scan_image_index == previous_scan_image_index:
+					break
+				continue
+
+			# Drop anything that's been shown, used already, or moved or removed from the playlist since it was
+			# examined (if it was moved, the image now at the index has been examined again)
+			if (portrait_image_index <= image_index or portrait_image_index >= len(self.playlist) or
+				portrait_image_index in partner_image_indices):
+				continue
+			portrait_image_reference= self.playlist[portrait_image_index]
+			if (not portrait_image_reference.image_layout in partner_layouts or
+				portrait_image_reference.local_image_path in skip_image_names):
+				continue
+
+			partner_image_indices.append(portrait_image_index)
+
+		if len(partner_image_indices) < partner_count:
+			# Leave them for a frame that needs fewer
+			for portrait_image_index in partner_image_indices:
+				heapq.heappush(self.portrait_image_indices[self.playlist[portrait_image_index].image_layout], portrait_image_index)
+			return None
+		return [self.playlist[portrait_image_index] for portrait_image_index in partner_image_indices]
+
+# A frame that the image server has picked to show soon, and is rendering ahead of time
+class RenderAheadFrame:
+	def __init__(self, image_index, image_reference, splice_image_references, frame_key, future, skip_portait_image_names,
+		replan_skip_portait_image_names):
+		self.image_index= image_index # Index into ImageServerThread.playlist of image_reference
+		self.image_reference= image_reference
+		self.splice_image_references= splice_image_references # Portraits spliced with image_reference, if any
+		self.frame_key= frame_key # Key of the rendered frame, pinned until the frame is done with
+		self.future= future # Result of render_engine.render_frame(), already complete (None) if the frame was cached. None once shown.
+		# ImageServerThread.skip_portait_image_names right after this frame was planned, so that we can rewind to it
+		self.skip_portait_image_names= skip_portait_image_names
+		# ImageServerThread.skip_portait_image_names right before this frame was planned, so that we can plan it again
+		# (see rewind_to)
+		self.replan_skip_portait_image_names= replan_skip_portait_image_names
+		self.cast_url= None # Where the Chromecast fetches the frame from, once it's rendered and stored (see prepare_frame_to_cast)
+
+# Returns: True if any of the images in frame (a RenderAheadFrame) are in local_image_paths
+def frame_uses_any_image(frame, local_image_paths):
+	return (frame.image_reference.local_image_path in local_image_paths or
+		any(splice_image_reference.local_image_path in local_image_paths for splice_image_reference in frame.splice_image_references))
+
+# How to fill a frame that starts with a portrait of image_layout, best first: (how many other images to splice it
+# with, the layouts they need to have). See image_processing.splice_layouts.
+def get_splice_options(image_layout):
+	splice_options= []
+	if image_layout == ImageLayout.Tall:
+		splice_options.append((2, (ImageLayout.Tall,)))
+	if g_config.portraits_per_frame == 4:
+		splice_options.append((3, portrait_image_layouts))
+	splice_options.append((1, portrait_image_layouts))
+	return splice_options
+
+# Frames kept for going back with the 'previous' command
+max_shown_frame_count= 50
+
 class ImageServerThread(threading.Thread):
-	def __init__(self, caster, temp_image_list_file, temp_image_file_names):
-		threading.Thread.__init__(self, daemon=True)
+	def __init__(self, device_config, caster, image_playlist, render_engine, render_cache, frame_store):
+		threading.Thread.__init__(self, daemon=True, name= get_device_thread_name("image_server", device_config.friendly_name))
 		
 		# Synchronization: internal events, use start_serving and stop_serving_and_wait
 		self.should_serve= threading.Event()
 		self.not_serving= threading.Event()
 		self.not_serving.set()
-
+		# Woken (see wake) whenever something that the slideshow waits on changes, rather than checking every so often
+		self.wake_condition= threading.Condition()
+		self.wake_requested= False
+		# Commands from the website: (command name, parameter), see send_command
+		self.pending_commands= queue.SimpleQueue()
+
+		# The Chromecast we're casting to. Every Chromecast gets its own ImageServerThread and playlist, sharing the
+		# render engine and caches, so Chromecasts with the same max_image_height_pixels share rendered frames.
+		self.device_config= device_config
 		self.caster= caster
-		self.image_references= []
-		self.pending_new_image_references= None # 
-		random.shuffle(self.image_references)
-		self.temp_image_list_file= temp_image_list_file
-		self.temp_image_file_names= temp_image_file_names
-
-		self.previous_image_index= 0
+		self.playlist= image_playlist
+		# Changes from the Image Scanner, in the order they were made: (new image references, None) or
+		# (None, removed image paths). Applied between frames by merge_pending_image_references.
+		self.pending_changes= queue.SimpleQueue()
+
+		# Frames are rendered on render_engine ahead of time, up to render_ahead_frames in advance, so that they're
+		# ready to cast as soon as the current frame's time is up. Rendered frames are served to the Chromecast from
+		# frame_store (in memory), or from render_cache (on disk) if frame_store is disabled (None). Frames are also
+		# kept in render_cache so images that come up again don't need to be rendered again.
+		self.render_engine= render_engine
+		self.render_cache= render_cache
+		self.frame_store= frame_store
+		# Keys of frames that have been sent to the Chromecast, oldest first
+		self.served_frame_keys= []
+		self.render_ahead_frames= collections.deque() # RenderAheadFrame, in the order they will be shown
+		# Frames that have been shown, oldest first, for going back with the 'previous' command
+		self.shown_frames= collections.deque(maxlen= max_shown_frame_count)
+
+		# Index of the first image in playlist that hasn't been shown yet
+		self.next_image_index= 0
+		# Index of the first image in playlist that hasn't been planned into a render ahead frame yet
+		self.plan_image_index= 0
 		# When we splice one portrait image with the next one in the list, we don't want to display that image
 		# when we encounter it so we remember its name to skip when we encounter it.
 		# It's possible if we merge in new portait images ahead of the skipped portait that we might need to track
 		# more than one portrait image to skip, so make this a set.
 		self.skip_portait_image_names= set()
+		# skip_portait_image_names as of the last frame that was shown, for when we throw away render ahead frames
+		self.shown_skip_portait_image_names= frozenset()
+		self.portrait_scheduler= PortraitPairingScheduler(image_playlist, self.wake)
+
+		device_labels= { "device" : device_config.friendly_name }
+		metrics.registry.gauge("pycastblaster_pending_changes", "Batches of new or deleted images waiting to be merged into the playlist",
+			device_labels, function= self.pending_changes.qsize)
+		metrics.registry.gauge("pycastblaster_render_ahead_frames", "Frames planned to be shown next",
+			device_labels, function= lambda: len(self.render_ahead_frames))
+		metrics.registry.gauge("pycastblaster_rendering_frames", "Frames planned to be shown next that are still rendering",
+			device_labels, function= lambda: sum(1 for frame in list(self.render_ahead_frames) if not frame.future.done()))
+		metrics.registry.gauge("pycastblaster_playlist_images", "Images in the playlist",
+			device_labels, function= lambda: len(self.playlist))
+		# NaN until the first frame is shown
+		self.time_to_first_frame_gauge= metrics.registry.gauge("pycastblaster_time_to_first_frame_seconds",
+			"Time from starting up (or reloading settings) until the Chromecast showed its first frame", device_labels)
+		self.time_to_first_frame_gauge.set(math.nan)
+		self.first_frame_shown= False
+		self.serving_start_time= None # When we were last told to start serving, for logging time to first frame
 
 	def run(self):
-		while not g_globals.exit_event.is_set():
-			self.should_serve.wait()
+		while True:
 			self.not_serving.clear()
-			while self.should_serve.is_set() and not g_globals.exit_event.is_set():
+			# Checked after clearing not_serving, so that once we've been asked to quit and stop_serving_and_wait()
+			# has returned, we don't touch anything that's being shut down
+			if g_globals.exit_event.is_set():
+				self.not_serving.set()
+				break
+
+			if self.should_serve.is_set():
+				while self.should_serve.is_set() and not g_globals.exit_event.is_set():
+					self.merge_pending_image_references()
+					self.serve_images()
+				self.not_serving.set()
+			else:
+				# Get the first frame ready while we wait for the Chromecast (discovering it, connecting and launching
+				# the receiver app take a few seconds), so that it can be shown as soon as the Chromecast is ready.
+				# Only the one frame, so that it has the render workers to itself.
 				self.merge_pending_image_references()
-				self.serve_images()              
-			self.not_serving.set()
+				self.fill_render_ahead_queue(1)
+				self.not_serving.set()
+				self.wait_for_wake(None)
 
 	def start_serving(self):
+		# Commands were meant for whatever was on screen before we stopped
+		while not self.pending_commands.empty():
+			self.pending_commands.get_nowait()
+		self.serving_start_time= time.monotonic()
 		self.should_serve.set()
+		self.wake()
 
-	def stop_serving_and_wait(self):
+	def stop_serving(self):
 		self.should_serve.clear()
+		self.wake()
+
+	def stop_serving_and_wait(self):
+		self.stop_serving()
 		return self.not_serving.wait()
-	
+
+	# Called from any thread, never blocks
+	def wake(self):
+		with self.wake_condition:
+			self.wake_requested= True
+			self.wake_condition.notify_all()
+
+	# Wait until wake() is called, or for timeout_seconds (None for as long as it takes). Returns straight away if
+	# wake() was called since we last waited, so nothing is missed while we're busy.
+	def wait_for_wake(self, timeout_seconds):
+		with self.wake_condition:
+			if not self.wake_requested:
+				self.wake_condition.wait(timeout_seconds)
+			self.wake_requested= False
+
+	# Called from web server threads, never blocks. command_name is "next", "previous" or "jump_to_index" (with the
+	# playlist index as parameter).
+	def send_command(self, command_name, parameter):
+		self.pending_commands.put((command_name, parameter))
+		self.wake()
+
+	# Called from the Image Scanner thread, never blocks
 	def add_image_references(self, new_image_references):
-		# Image Server thread is may be consuming pending_new_image_references, wait until it's done
-		while(self.pending_new_image_references is not None):
-			time.sleep(0.5)
-		self.pending_new_image_references= new_image_references
+		self.pending_changes.put((new_image_references, None))
+		self.wake()
 
-	def merge_pending_image_references(self):
-		if not self.pending_new_image_references is None:
-			# Merge in the new images so that we don't replay images we've already served.
-			log("Merging in [%d] new images." % (len(self.pending_new_image_references)))
+	# Called from the Image Scanner thread, never blocks
+	def remove_image_references(self, removed_image_paths):
+		self.pending_changes.put((None, set(removed_image_paths)))
+		self.wake()
 
-			# First, shuffle the new images with the images that haven't been served yet
-			shuffled_image_references= self.image_references[self.previous_image_index:]
-			shuffled_image_references= shuffled_image_references + self.pending_new_image_references
-			random.shuffle(shuffled_image_references)
+	def remove_pending_image_references(self, removed_image_paths):
+		log("Removing [%d] deleted images." % len(removed_image_paths))
 
-			# Then, prepend the images that have already been served
-			merged_image_references= self.image_references[:max(self.previous_image_index - 1, 0)] + shuffled_image_references
+		# Don't try to show frames of images that no longer exist
+		for frame in self.render_ahead_frames:
+			if frame_uses_any_image(frame, removed_image_paths):
+				self.cancel_render_ahead()
+				break
 
-			# Finally, swap the merged image list into place
-			self.image_references= merged_image_references
+		removed_image_indices= self.playlist.remove(lambda image_reference: image_reference.local_image_path in removed_image_paths)
+
+		# Shift the indices we're tracking to account for removed images before them
+		self.next_image_index= playlist.get_shifted_index(self.next_image_index, removed_image_indices)
+		self.plan_image_index= playlist.get_shifted_index(self.plan_image_index, removed_image_indices)
+		for frame in self.render_ahead_frames:
+			frame.image_index= playlist.get_shifted_index(frame.image_index, removed_image_indices)
+		# Can't go back to frames of images that no longer exist
+		self.shown_frames= collections.deque((frame for frame in self.shown_frames if not frame_uses_any_image(frame, removed_image_paths)),
+			maxlen= max_shown_frame_count)
+		for frame in self.shown_frames:
+			frame.image_index= playlist.get_shifted_index(frame.image_index, removed_image_indices)
+		self.skip_portait_image_names.difference_update(removed_image_paths)
+		self.shown_skip_portait_image_names= self.shown_skip_portait_image_names.difference(removed_image_paths)
+		self.portrait_scheduler.reset(self.plan_image_index)
+
+	# The web UI shows the playlist of the first Chromecast (g_globals.playlist)
+	def publish_playlist_state(self):
+		if self.playlist is g_globals.playlist:
+			publish_playlist_state()
 
-			# Keep the global list of image references up to date
-			global g_globals
-			g_globals.image_reference_lock.acquire()
-			g_globals.image_references= self.image_references
-			g_globals.image_reference_lock.release()
+	def merge_pending_image_references(self):
+		merged= False
 
-			# Invalidate self.pending_new_image_references once we're done to signal that we're ready to accept
-			# more new images from the Image Scanner.
-			self.pending_new_image_references= None
+		while True:
+			try:
+				new_image_references, removed_image_paths= self.pending_changes.get_nowait()
+			except queue.Empty:
+				break
 
-	def serve_images(self):
-		image_count= len(self.image_references)
-		start_index= max(0, min(image_count - 1, self.previous_image_index - 1))
-		interrupted= False
+			merged= True
+			if removed_image_paths is not None:
+				self.remove_pending_image_references(removed_image_paths)
+				continue
 
-		for image_index, image_reference in enumerate(self.image_references[start_index:], start_index):
-			global g_globals
-			g_globals.image_reference_lock.acquire()
-			g_globals.current_image_reference_index= image_index
-			g_globals.image_reference_lock.release()
+			# Merge in the new images so that we don't replay images we've already served.
+			log("Merging in [%d] new images." % (len(new_image_references)))
 
-			# Lazily evaluate IsPortrait rather than on startup because it's slow (need to open image file and
-			# potentially transpose it)
-			if image_reference.image_layout == ImageLayout.Unknown:
-				image_reference.image_layout= ImageLayout.Portrait if image_processing.image_is_portait(image_reference.local_image_path) else ImageLayout.Landscape
-				self.image_references[image_index]= image_reference # Update list of images so we don't need to evaluate this image again
+			# Shuffle the new images in with the images that haven't been served yet. Leave the images that are already
+			# being rendered ahead alone, so that we don't have to throw those frames away.
+			changed_image_indices= self.playlist.insert_shuffled(new_image_references, self.plan_image_index)
+			self.portrait_scheduler.images_changed(changed_image_indices)
 
-			processed_image= False
+		if merged:
+			self.publish_playlist_state()
+
+	# Pick the next frame to show, starting at plan_image_index, and start rendering it.
+	# Returns: RenderAheadFrame, or None if we've planned every image in the list.
+	def plan_next_frame(self):
+		image_count= len(self.playlist)
+
+		while self.plan_image_index < image_count:
+			image_index= self.plan_image_index
+			image_reference= self.playlist[image_index]
+			self.plan_image_index= image_index + 1
 
 			if image_reference.local_image_path in self.skip_portait_image_names:
 				# If this image is a portait we've already displayed then, skip it
 				self.skip_portait_image_names.remove(image_reference.local_image_path)
 				continue
-			elif image_reference.image_layout == ImageLayout.Portrait:
-				# Find the next portait image in images to splice with
-				# If there is one then set skip_next_portait, splice it with this one, and replace image
-				for search_image_index in range(image_index + 1, image_count):
-					search_image= self.image_references[search_image_index]
-
-					# Lazily evaluate IsPortrait rather than on startup because it's slow (need to open image file and
-					# potentially transpose it)
-					if search_image.image_layout == ImageLayout.Unknown:
-						search_image.image_layout= ImageLayout.Portrait if image_processing.image_is_portait(search_image.local_image_path) else ImageLayout.Landscape
-						# Update list of images so we don't need to evaluate this image again
-						self.image_references[search_image_index]= search_image
-
-					if (search_image.image_layout == ImageLayout.Portrait and
-						not search_image.local_image_path in self.skip_portait_image_names):
-						self.skip_portait_image_names.add(search_image.local_image_path)
-						# Select a temporary file name for the spliced image (generate a unique ID since chromecast caches images
-						# if we reuse file names)
-						spliced_image_file_name= os.path.join(g_config.local_temp_path, str(uuid.uuid4())) + ".jpg"
-						self.temp_image_file_names.append(spliced_image_file_name)
-						log("Splicing '%s' + '%s' into '%s'" % (image_reference.local_image_path, search_image.local_image_path, spliced_image_file_name))
-						# create temporary spliced image
-						image_processing.splice_images(image_reference.local_image_path, search_image.local_image_path, spliced_image_file_name)
-						# generate a temporary image reference to the spliced image that now has a landscape layout
-						image_reference= ImageReference(spliced_image_file_name, local_image_file_path_to_url(spliced_image_file_name), ImageLayout.Landscape)
-						processed_image= True
+
+			try:
+				# Lazily evaluate IsPortrait rather than on startup because it's slow (need to open image file)
+				if image_reference.image_layout == ImageLayout.Unknown:
+					classify_image_reference(image_reference)
+			except Exception as e:
+				log("ERROR: Unable to classify image '%s', skipping: '%s'" % (image_reference.local_image_path, e))
+				continue
+
+			replan_skip_portait_image_names= frozenset(self.skip_portait_image_names)
+			splice_image_references= []
+
+			if image_reference.image_layout in portrait_image_layouts:
+				# Splice with the next portait images that we know of, if there are enough for one of the layouts, and
+				# skip them when we get to them
+				for partner_count, partner_layouts in get_splice_options(image_reference.image_layout):
+					partner_image_references= self.portrait_scheduler.find_partners(image_index, self.skip_portait_image_names,
+						partner_count, partner_layouts)
+					if partner_image_references is not None:
+						splice_image_references= partner_image_references
 						break
 
-			if not processed_image:
-				# Process image on the fly, generate a temporary file to store the processed image
-				temp_image_file_name= os.path.join(g_config.local_temp_path, str(uuid.uuid4())) + ".jpg"
-				# Update temp_image_file_name in case process_image renamed it
-				temp_image_file_name= image_processing.process_image_file(image_reference.local_image_path, temp_image_file_name)
-				self.temp_image_file_names.append(temp_image_file_name)
-				# generate a temporary image reference to the processed image
-				image_reference= ImageReference(temp_image_file_name, local_image_file_path_to_url(temp_image_file_name), ImageLayout.Landscape)
-				processed_image= True
-
-			# clean up temporary spliced images, leave a few around in-case they're still being served
-			if len(self.temp_image_file_names) > 2:
-				to_delete= self.temp_image_file_names.pop(0)
-				if os.path.exists(to_delete):
-					log("Purging temporary image '%s'" % to_delete)
-					os.remove(to_delete)
-
-			# update list of temporary image files
-			self.temp_image_list_file.seek(0)
-			self.temp_image_list_file.truncate()
-			for temp_image_file_name in self.temp_image_file_names:
-				self.temp_image_list_file.write(temp_image_file_name + "\n")
-			self.temp_image_list_file.flush()
-
-			if not self.caster.try_to_play_media(image_reference.url_path):
-				# If we failed to play media, the Chromecast probably disconnected, so stop trying to serve images
-				# before we trigger some exception in the pychromecast library
-				self.should_serve.clear()
-				interrupted= True
-				log("Stopping Image Server thread because we failed to play media (timed out?).")
-				break
+			try:
+				source_identities= [image_reference.get_identity()]
+			except OSError as e:
+				log("ERROR: Unable to stat image '%s', skipping: '%s'" % (image_reference.local_image_path, e))
+				continue
 
-			initial_duration_seconds= g_config.slideshow_duration_seconds
-			sleep_time_remaining= initial_duration_seconds
-			while (sleep_time_remaining > 0.0):
-				### Handle Exit Conditions
-				# The casting thread signaled that we should stop, e.g. the Chromecast was removed (turned off?)
-				if not self.should_serve.is_set():
-					interrupted= True # This will cause us to break out of the image loop
+			for splice_image_reference in splice_image_references:
+				try:
+					source_identities.append(splice_image_reference.get_identity())
+				except OSError as e:
+					# Deleted? The image scanner will catch up, show this one on its own
+					log("ERROR: Unable to stat image '%s', not splicing it: '%s'" % (splice_image_reference.local_image_path, e))
+					source_identities= source_identities[:1]
+					splice_image_references= []
 					break
 
-				# This should be redundant with the above, but avoid any race conditions where the ChromecastPoller resets
-				# should_serve by explicitly checking g_globals.exit_event as well.
-				if g_globals.exit_event.is_set():
-					interrupted= True # This will cause us to break out of the image loop
-					break
+			# Now that they're definitely in this frame, skip the partners when we get to them
+			for splice_image_reference in splice_image_references:
+				self.skip_portait_image_names.add(splice_image_reference.local_image_path)
 
-				# There are new pending images to merge with our list, stop serving for a moment.
-				# NOTE: Do this *after* we sleep because this should be pretty quick, so if we didn't sleep then
-				# we'd skip the image(s) we just prepared
-				if self.pending_new_image_references is not None:
-					interrupted= True # This will cause us to break out of the image loop
-					break
+			local_image_paths= [image_reference.local_image_path] + [splice_image_reference.local_image_path
+				for splice_image_reference in splice_image_references]
+
+			frame_key= render_engine.get_frame_key(source_identities, self.device_config.max_image_height_pixels,
+				self.device_config.encoder_settings)
+			# Pin the frame so it isn't evicted before we're done casting it
+			self.pin_frame(frame_key)
+
+			if self.load_frame(frame_key):
+				future= concurrent.futures.Future()
+				future.set_result(None)
+			else:
+				if len(splice_image_references) > 0:
+					log("Splicing '%s'" % "' + '".join(local_image_paths), level= log_buffer.LogLevel.Debug)
+
+				future= self.render_engine.submit_frame(
+					local_image_paths,
+					self.device_config.max_image_height_pixels,
+					self.device_config.encoder_settings)
+
+			return RenderAheadFrame(image_index, image_reference, splice_image_references, frame_key, future,
+				frozenset(self.skip_portait_image_names), replan_skip_portait_image_names)
+
+		return None
+
+	def pin_frame(self, frame_key):
+		if self.frame_store is not None:
+			self.frame_store.pin(frame_key)
+		else:
+			self.render_cache.pin(frame_key)
+
+	def unpin_frame(self, frame_key):
+		if self.frame_store is not None:
+			self.frame_store.unpin(frame_key)
+		else:
+			self.render_cache.unpin(frame_key)
+
+	# Make a previously rendered frame ready to serve, if we have one.
+	# Returns: True if the frame doesn't need to be rendered
+	def load_frame(self, frame_key):
+		if self.frame_store is None:
+			if self.render_cache.lookup(frame_key):
+				frame_cache_disk_counter.inc()
+				return True
+			frame_cache_miss_counter.inc()
+			return False
+
+		if self.frame_store.get(frame_key) is not None:
+			frame_cache_memory_counter.inc()
+			return True
+
+		frame_bytes= self.render_cache.read(frame_key)
+		if frame_bytes is None:
+			frame_cache_miss_counter.inc()
+			return False
+
+		frame_cache_disk_counter.inc()
+		self.frame_store.put(frame_key, frame_bytes)
+		return True
+
+	def store_frame(self, frame_key, frame_bytes):
+		if self.frame_store is not None:
+			self.frame_store.put(frame_key, frame_bytes)
+
+		# Don't touch the disk at all if the render cache is disabled, unless we need it to serve the frame
+		if self.frame_store is None or self.render_cache.max_bytes > 0:
+			try:
+				self.render_cache.store(frame_key, frame_bytes)
+			except OSError as e:
+				log("ERROR: Unable to store frame in render cache: '%s'" % e)
+
+	# Make a rendered frame available to the web server, and pick the URL the Chromecast will fetch it from
+	def prepare_frame_to_cast(self, frame, render_result):
+		if render_result is not None:
+			self.store_frame(frame.frame_key, render_result[0])
+
+		# Generate a unique URL each time, since chromecast caches images if we reuse URLs, even though we may be
+		# casting the same cached frame again
+		frame.cast_url= self.get_frame_url(frame.frame_key) + "?" + uuid.uuid4().hex
+
+	# With the queue transport, send the next frame to the Chromecast as soon as it's rendered, so that it has already
+	# fetched it by the time it's due
+	def preload_next_frame(self):
+		if g_config.cast_transport != "queue" or len(self.render_ahead_frames) == 0:
+			return
+
+		frame= self.render_ahead_frames[0]
+		if frame.cast_url is not None or not frame.future.done():
+			return
+
+		try:
+			render_result= frame.future.result()
+		except Exception:
+			return # Reported when it's due
+
+		self.prepare_frame_to_cast(frame, render_result)
+		self.caster.preload_media(frame.cast_url)
+
+	def get_frame_url(self, frame_key):
+		if self.frame_store is not None:
+			return g_config.server_url + frame_url_prefix + frame_key
+		else:
+			return local_image_file_path_to_url(self.render_cache.get_file_path(frame_key))
+
+	# Plan frames until there are max_frame_count of them in the queue (or we run out of images)
+	def fill_render_ahead_queue(self, max_frame_count):
+		while len(self.render_ahead_frames) < max_frame_count:
+			frame= self.plan_next_frame()
+			if frame is None:
+				break
+			self.render_ahead_frames.append(frame)
+			# So that the frame can be preloaded as soon as it's rendered
+			frame.future.add_done_callback(lambda _future: self.wake())
+
+	# Throw away frames that have been planned but not shown, and rewind planning to the first image that hasn't been
+	# shown yet. Frames that are already rendering are left to finish, and stored for next time.
+	def cancel_render_ahead(self):
+		if len(self.render_ahead_frames) > 0:
+			log("Cancelling [%d] render ahead frames." % len(self.render_ahead_frames))
+
+		for frame in self.render_ahead_frames:
+			self.discard_render_ahead_frame(frame)
+
+		self.render_ahead_frames.clear()
+		self.plan_image_index= self.next_image_index
+		self.skip_portait_image_names= set(self.shown_skip_portait_image_names)
+		self.portrait_scheduler.reset(self.plan_image_index)
+
+	# Let go of a frame that won't be shown after all. If it's already rendering it's left to finish, and stored for
+	# next time.
+	def discard_render_ahead_frame(self, frame):
+		if not frame.future.cancel():
+			def store_cancelled_frame(future, frame_key= frame.frame_key):
+				if future.exception() is None and future.result() is not None:
+					self.store_frame(frame_key, future.result()[0])
+			frame.future.add_done_callback(store_cancelled_frame)
+		self.unpin_frame(frame.frame_key)
+
+	# Throw away the frames rendered ahead and carry on from image_index instead, with skip_portait_image_names as
+	# they were when we last got there
+	def rewind_to(self, image_index, skip_portait_image_names):
+		self.cancel_render_ahead()
+		self.next_image_index= image_index
+		self.plan_image_index= image_index
+		self.skip_portait_image_names= set(skip_portait_image_names)
+		self.shown_skip_portait_image_names= frozenset(skip_portait_image_names)
+		self.portrait_scheduler.reset(image_index)
+
+	# Act on the oldest command from the website, if there is one.
+	# Returns: True if the next frame in render_ahead_frames (or planned next) should be shown straight away
+	def run_pending_command(self):
+		try:
+			command_name, parameter= self.pending_commands.get_nowait()
+		except queue.Empty:
+			return False
+
+		if command_name == "next":
+			# Usually already rendered ahead
+			return True
+
+		if command_name == "previous":
+			# The last frame shown is the one on screen, go back to the one before it. It's usually still pinned in
+			# the frame store, or in the render cache.
+			if len(self.shown_frames) < 2:
+				log("No previous image to go back to on '%s'." % self.device_config.friendly_name, level= log_buffer.LogLevel.Warning)
+				return False
+			self.shown_frames.pop()
+			frame= self.shown_frames.pop()
+			self.rewind_to(frame.image_index, frame.replan_skip_portait_image_names)
+			return True
+
+		if command_name == "jump_to_index":
+			if parameter >= len(self.playlist):
+				log("ERROR: Unable to show image [%d], there are only [%d] images." % (parameter, len(self.playlist)))
+				return False
+
+			# Keep what's already rendered if the image is coming up soon anyway
+			if any(frame.image_index == parameter for frame in self.render_ahead_frames):
+				while self.render_ahead_frames[0].image_index != parameter:
+					self.discard_render_ahead_frame(self.render_ahead_frames.popleft())
+			else:
+				# Images we jump back to might have been spliced with a portrait before, show them anyway
+				self.rewind_to(parameter, frozenset())
+			return True
+
+		log("ERROR: Unknown image server command '%s'" % command_name)
+		return False
+
+	def mark_frame_shown(self, frame):
+		self.next_image_index= frame.image_index + 1
+		self.shown_skip_portait_image_names= frame.skip_portait_image_names
 
-				### Manage Timer
-				# Somebody updated the duration from the website, adjust the current timer
-				if (g_config.slideshow_duration_seconds != initial_duration_seconds):
-					delta_time= g_config.slideshow_duration_seconds - initial_duration_seconds
-					initial_duration_seconds= g_config.slideshow_duration_seconds
-					sleep_time_remaining= max(sleep_time_remaining + delta_time, 0.0)
+	def serve_images(self):
+		interrupted= False
+		served_image_count= 0
+		# When the frame being rendered should be shown, for measuring how late it is, None for the first frame
+		frame_due_time= None
+
+		while not interrupted:
+			self.merge_pending_image_references()
+			# Until the first frame is on screen, don't hold it up by rendering the ones after it
+			self.fill_render_ahead_queue(max(g_config.render_ahead_frames, 1) if served_image_count > 0 else 1)
+
+			if len(self.render_ahead_frames) == 0:
+				break
 
-				sleep_duration= min(sleep_time_remaining, 1.0) # Sleep in one second increments
+			frame= self.render_ahead_frames.popleft()
 
-				if not g_globals.paused:
-					sleep_time_remaining= sleep_time_remaining - sleep_duration
+			self.playlist.set_current_index(frame.image_index)
+			self.publish_playlist_state()
+
+			try:
+				# Usually already rendered while the previous frame was on screen
+				with render_wait_seconds_histogram.time():
+					render_result= frame.future.result()
+			except Exception as e:
+				log("ERROR: Unable to render image '%s', skipping: '%s'" % (frame.image_reference.local_image_path, e))
+				self.unpin_frame(frame.frame_key)
+				self.mark_frame_shown(frame)
+				continue
 
-				time.sleep(sleep_duration)
+			if frame.cast_url is None:
+				self.prepare_frame_to_cast(frame, render_result)
 
-			if interrupted:
+			self.served_frame_keys.append(frame.frame_key)
+
+			# allow older frames to be evicted, leave a few pinned in-case they're still being served
+			while len(self.served_frame_keys) > 2:
+				self.unpin_frame(self.served_frame_keys.pop(0))
+
+			if not self.caster.try_to_play_media(frame.cast_url):
+				# If we failed to play media, the Chromecast probably disconnected, so stop trying to serve images
+				# before we trigger some exception in the pychromecast library
+				self.should_serve.clear()
+				interrupted= True
+				log("Stopping Image Server thread for '%s' because we failed to play media (timed out?)." % self.device_config.friendly_name)
 				break
 
-			self.previous_image_index= image_index
+			frame_shown_time= time.monotonic()
+			if frame_due_time is not None:
+				frame_lateness_seconds_histogram.observe(max(frame_shown_time - frame_due_time, 0.0))
+			frames_shown_counter.inc()
+
+			if not self.first_frame_shown:
+				self.first_frame_shown= True
+				time_to_first_frame_seconds= frame_shown_time - g_globals.start_time
+				self.time_to_first_frame_gauge.set(time_to_first_frame_seconds)
+				log("First frame shown on '%s' [%.1f] seconds after starting up, [%.1f] seconds after the Chromecast was ready." % (
+					self.device_config.friendly_name, time_to_first_frame_seconds, frame_shown_time - self.serving_start_time))
+
+			self.mark_frame_shown(frame)
+			# shown_frames only needs to know what was shown, don't keep the rendered frame alive
+			frame.future= None
+			self.shown_frames.append(frame)
+			served_image_count= served_image_count + 1
+
+			# Start rendering the next few frames while this one is on screen
+			self.fill_render_ahead_queue(max(g_config.render_ahead_frames, 1))
+
+			# Time this frame from when it was due rather than when it was shown, so that the time taken to render and
+			# send frames doesn't add up over the slideshow. Unless we've fallen a whole frame behind (e.g. the
+			# Chromecast was slow to respond), then start again from now rather than rushing through frames to catch up.
+			frame_start_time= frame_shown_time
+			if frame_due_time is not None and frame_shown_time - frame_due_time < g_config.slideshow_duration_seconds:
+				frame_start_time= frame_due_time
+
+			frame_due_time= self.wait_for_next_frame(frame_start_time)
+			if frame_due_time is None:
+				interrupted= True
 
-		# If we finished looping over our images without interruption then shuffle them and start at the beginning.
-		# It's not quite trivial to compare previous_image_index against the number of images because we might skip
-		# the last image without incrementing previous_image_index.
-		if not interrupted:
+		if interrupted:
+			# The Chromecast went away or we're quitting, don't leave frames rendering for a playlist position that we
+			# may never get back to.
+			self.cancel_render_ahead()
+		else:
+			# If we finished looping over our images without interruption then shuffle them and start at the beginning.
 			log("Image list complete, shuffling and restarting")
-			random.shuffle(self.image_references)
-			self.previous_image_index= 0
+			self.playlist.shuffle()
+			self.next_image_index= 0
+			self.plan_image_index= 0
 			self.skip_portait_image_names.clear()
+			self.shown_skip_portait_image_names= frozenset()
+			self.portrait_scheduler.reset(0)
+			self.shown_frames.clear()
+
+			if served_image_count == 0:
+				# Nothing to show (yet?), don't spin. Woken when there are new images, or we need to stop.
+				self.wait_for_wake(None)
+
+	# Wait while the frame on screen is shown for slideshow_duration_seconds, not counting time paused. Sleeps until
+	# the frame is due or wake() is called, so that pausing, updating the duration, new or deleted images, commands
+	# from the website and stopping all take effect straight away. Does background work whenever it wakes up.
+	# Returns: when the next frame is due (now for a command), or None if we should stop serving images
+	def wait_for_next_frame(self, frame_start_time):
+		initial_duration_seconds= g_config.slideshow_duration_seconds
+		paused_seconds= 0.0
+		paused_time= None # When we were paused, if we are
+
+		while True:
+			### Handle Exit Conditions
+			# The casting thread signaled that we should stop, e.g. the Chromecast was removed (turned off?), or we're
+			# quitting
+			if not self.should_serve.is_set() or g_globals.exit_event.is_set():
+				return None
+
+			self.merge_pending_image_references()
+			if self.run_pending_command():
+				return time.monotonic()
+
+			self.preload_next_frame()
+			# Look for portraits to pair up while we're waiting anyway
+			self.portrait_scheduler.scan_ahead(1000)
+
+			### Manage Timer
+			now= time.monotonic()
+			if g_globals.paused:
+				if paused_time is None:
+					paused_time= now
+				self.wait_for_wake(None)
+				continue
+
+			if paused_time is not None:
+				paused_seconds= paused_seconds + (now - paused_time)
+				paused_time= None
+
+			# Somebody may have updated the duration from the website
+			duration_seconds= g_config.slideshow_duration_seconds
+			due_time= frame_start_time + duration_seconds + paused_seconds
+			if now >= due_time:
+				if duration_seconds != initial_duration_seconds:
+					# Shortened to before now, the next frame isn't late
+					return now
+				return due_time
+
+			self.wait_for_wake(due_time - now)
+
+# Queued frames that failed to show in a row before giving up on the queue transport for a Chromecast
+max_queue_failure_count= 3
+# How long to wait for a discovered Chromecast to connect, get_chromecast_from_cast_info() tries twice
+connect_timeout_seconds= 30
 
 class CanCastResult(enum.IntEnum):
 	Success= 0
@@ -516,51 +1758,139 @@ class CanCastResult(enum.IntEnum):
 	FailExpectedActived= 3
 	FailInUse= 4
 
-class ChromeCastPoller:
-	def __init__(self, chromecast_friendly_name):
-		def add_callback(uuid, _service):
-			log("Chromecast added %s (%s)" % (self.browser.devices[uuid].friendly_name, uuid))
-			
-			if (self.browser.devices[uuid].friendly_name == self.friendly_name):
-				if self.cast_lock.acquire():
-					# Clean up any lingering image serving thread first
-					if self.image_serving_thread and self.image_serving_thread.is_alive():
-						self.stop_image_server()
+# Finds Chromecasts on the network for every ChromeCastPoller, with one browser (and one zeroconf instance) shared
+# between them, and tells each poller when its Chromecast turns up or goes away
+class ChromecastDiscovery:
+	def __init__(self):
+		self.browser= pychromecast.discovery.CastBrowser(pychromecast.discovery.SimpleCastListener(self.add_callback, self.remove_callback), zeroconf.Zeroconf())
+		self.pollers= {} # Dictionary: friendly_name -> ChromeCastPoller
+
+	# Must be called before start()
+	def add_poller(self, chromecast_poller):
+		self.pollers[chromecast_poller.friendly_name]= chromecast_poller
 
-					self.chromecast= pychromecast.get_chromecast_from_cast_info(self.browser.devices[uuid], zconf=self.browser.zc, tries= 2, retry_wait= 2.0, timeout= 5.0)
-					self.chromecast.wait() # Wait to connect before releasing self.cast_lock and allowing wait_for_idle to start the image server
-					self.cast_lock.release()
+	def add_callback(self, uuid, _service):
+		cast_info= self.browser.devices[uuid]
+		log("Chromecast added %s (%s)" % (cast_info.friendly_name, uuid))
 
-		def remove_callback(uuid, _service, cast_info):
-			log("Chromecast removed %s (%s)" % (self.browser.devices[uuid].friendly_name, uuid))
+		chromecast_poller= self.pollers.get(cast_info.friendly_name)
+		if chromecast_poller:
+			chromecast_poller.chromecast_added(cast_info, self.browser.zc)
 
-			def get_chromecast_from_uuid(uuid):
-				return pychromecast.get_chromecast_from_cast_info(self.browser.devices[uuid], zconf=self.browser.zc)
+	def remove_callback(self, uuid, _service, cast_info):
+		friendly_name= self.browser.devices[uuid].friendly_name
+		log("Chromecast removed %s (%s)" % (friendly_name, uuid))
 
-			if (self.browser.devices[uuid].friendly_name == self.friendly_name):
-				if self.cast_lock.acquire():
-					self.stop_image_server()
-					self.chromecast= None
+		chromecast_poller= self.pollers.get(friendly_name)
+		if chromecast_poller:
+			chromecast_poller.chromecast_removed()
 
-					self.cast_lock.release()
+	def start(self):
+		self.browser.start_discovery()
 
+	# Call after stopping the pollers. We can create a deadlock if a poller holds its cast_lock while we're blocked on
+	# stop_discovery() waiting for the zeroconf thread to terminate, while the zeroconf thread has triggered
+	# remove_callback() and is waiting on that poller's cast_lock
+	def stop(self):
+		self.browser.stop_discovery()
 
-		self.browser= pychromecast.discovery.CastBrowser(pychromecast.discovery.SimpleCastListener(add_callback, remove_callback), zeroconf.Zeroconf())
+class ChromeCastPoller:
+	def __init__(self, chromecast_friendly_name):
 		self.friendly_name= chromecast_friendly_name
 		self.cast_lock= threading.RLock() # making this a reentrant lock so that can_cast() can take the lock, to make sure it's always thread-safe to use
 		self.chromecast= None
+		# Sends frames through the Chromecast's queue if cast_transport is "queue", None otherwise or if the queue
+		# isn't working (see try_to_play_queued_media)
+		self.queue_controller= None
+		self.queue_failure_count= 0
+
+		# Discovery callbacks come from the zeroconf thread that's shared by every Chromecast, so they just hand over
+		# to our own thread (wait_for_idle) to connect, rather than holding up discovering the other Chromecasts
+		self.discovery_lock= threading.Lock()
+		self.discovered_cast_info= None # (cast_info, zeroconf) to connect to, if our Chromecast turned up
+		self.discovery_generation= 0 # Counts discovery changes, to notice if one comes in while we're connecting
+		self.discovery_event= threading.Event() # Set when discovered_cast_info is set
 
 		self.image_serving_thread= None
 
 	def __del__(self):
 		self.stop()
 
+	# Called by ChromecastDiscovery, from the zeroconf thread, when our Chromecast turns up on the network. Doesn't
+	# block, wait_for_idle connects to it.
+	def chromecast_added(self, cast_info, zconf):
+		with self.discovery_lock:
+			self.discovered_cast_info= (cast_info, zconf)
+			self.discovery_generation= self.discovery_generation + 1
+			self.discovery_event.set()
+
+		# Stop casting to the old connection (if any) so that wait_for_idle gets round to the new one
+		if self.image_serving_thread:
+			self.image_serving_thread.stop_serving()
+
+	# Runs on the wait_for_idle thread: connect to our Chromecast if it has turned up since we last looked
+	# Returns: True if we tried to connect
+	def connect_discovered_chromecast(self):
+		with self.discovery_lock:
+			self.discovery_event.clear()
+			if self.discovered_cast_info is None:
+				return False
+			cast_info, zconf= self.discovered_cast_info
+			self.discovered_cast_info= None
+			discovery_generation= self.discovery_generation
+
+		# Clean up any lingering image serving first
+		self.stop_image_server()
+
+		queue_controller= None
+		try:
+			chromecast= pychromecast.get_chromecast_from_cast_info(cast_info, zconf= zconf, tries= 2, retry_wait= 2.0, timeout= 5.0)
+			chromecast.wait(connect_timeout_seconds) # Wait to connect before letting wait_for_idle start the image server
+			connected= chromecast.socket_client.is_connected
+			if connected and g_config.cast_transport == "queue":
+				queue_controller= cast_queue.QueueController()
+				chromecast.register_handler(queue_controller)
+		except pychromecast.error.PyChromecastError as e:
+			chromecast= None
+			connected= False
+			log("ERROR: Unable to connect to '%s': '%s'" % (self.friendly_name, e))
+
+		with self.cast_lock, self.discovery_lock:
+			if discovery_generation != self.discovery_generation:
+				# Removed or added again while we were connecting, go with whatever discovery says now
+				connected= False
+			elif not connected:
+				# Try again next time round, unless discovery has something newer by then
+				if chromecast is not None:
+					log("ERROR: Timed out connecting to '%s'" % self.friendly_name)
+				self.discovered_cast_info= (cast_info, zconf)
+			else:
+				self.chromecast= chromecast
+				self.queue_controller= queue_controller
+				self.queue_failure_count= 0
+
+		if not connected and chromecast is not None:
+			chromecast.disconnect(timeout= 1.0)
+		return True
+
+	# Called by ChromecastDiscovery, from the zeroconf thread, when our Chromecast goes away
+	def chromecast_removed(self):
+		with self.discovery_lock:
+			self.discovered_cast_info= None
+			self.discovery_generation= self.discovery_generation + 1
+
+		if self.cast_lock.acquire():
+			self.stop_image_server()
+			self.chromecast= None
+			self.queue_controller= None
+
+			self.cast_lock.release()
+
 	def start(self):
 		# Start a separate thread to wait for the Chromecast to be idle rather than blocking this one
-		self.wait_for_idle_thread= threading.Thread(target= self.wait_for_idle, daemon= True)
+		self.wait_for_idle_thread= threading.Thread(target= self.wait_for_idle, daemon= True,
+			name= get_device_thread_name("chromecast_poller", self.friendly_name))
 		self.wait_for_idle_thread.start()
-		
-		self.browser.start_discovery()
 
 		log("Chrome Cast poller started, looking for '%s'" % self.friendly_name)
 
@@ -569,11 +1899,6 @@ class ChromeCastPoller:
 			if self.chromecast:
 				self.chromecast.quit_app()
 			self.cast_lock.release()
-		
-		# Discovery and the browser are distinct from the Chromecast. Additionally, we can create a deadlock here
-		# where we have self.cast_lock and are blocked on stop_discovery() waiting for the zeroconf thread to terminate,
-		# while the zeroconf thread has triggered our remove_callback() and is waiting on self.cast_lock
-		self.browser.stop_discovery()
 
 	def stop_image_server(self):
 		self.image_serving_thread.stop_serving_and_wait()
@@ -607,7 +1932,10 @@ class ChromeCastPoller:
 		was_active= False
 		while not g_globals.exit_event.is_set():
 			self.image_serving_thread.not_serving.wait()
-			
+
+			if self.connect_discovered_chromecast():
+				was_active= False # Stopped to switch connections, not interrupted
+
 			if was_active and not g_globals.exit_event.is_set():
 				log("Bonus interruption idle (%f s): We got interrupted, so maybe something else is trying to start" % g_config.interruption_idle_seconds)
 				time.sleep(g_config.interruption_idle_seconds)
@@ -616,13 +1944,18 @@ class ChromeCastPoller:
 			if can_cast == CanCastResult.Success:
 				self.chromecast.media_controller.launch()
 				self.chromecast.media_controller.block_until_active(10)
+				with self.cast_lock:
+					# Anything we queued before was lost when our app was interrupted
+					if self.queue_controller is not None:
+						self.queue_controller.reset()
 				self.image_serving_thread.start_serving()
 				was_active= True
 			else:
 				was_active= False
-				log("Blocking for idle, reason: %s" % reason)
+				log("Blocking for idle on '%s', reason: %s" % (self.friendly_name, reason))
 
-			time.sleep(5)
+			# Don't wait around if our Chromecast turns up in the meantime
+			self.discovery_event.wait(5)
 
 	def try_to_play_media(self, url):
 		success= False
@@ -631,61 +1964,106 @@ class ChromeCastPoller:
 		if self.cast_lock.acquire(timeout= 1):
 			can_cast, reason= self.can_cast(must_be_active=True)
 			if can_cast == CanCastResult.Success:
-				extension= os.path.splitext(url)[1].lower()
-				content_type= content_type_dictionary[extension]
-				log("Serving '%s'" % url)
-				try:
-					self.chromecast.media_controller.play_media(url, content_type)
-					self.chromecast.media_controller.block_until_active(timeout=1.0)
-					success= self.chromecast.media_controller.session_active_event.is_set()
-				except pychromecast.error.NotConnected:
-					log("Couldn't play media, Chromecast not connected")
-				except pychromecast.error.ControllerNotRegistered:
-					log("Couldn't play media, Controller not registered")
+				content_type= get_media_content_type(url)
+				log("Serving '%s'" % url, level= log_buffer.LogLevel.Debug)
+				if self.queue_controller is not None:
+					success= self.try_to_play_queued_media(url, content_type)
+
+				if not success:
+					try:
+						with play_media_seconds_histogram.time():
+							self.chromecast.media_controller.play_media(url, content_type)
+						with block_until_active_seconds_histogram.time():
+							self.chromecast.media_controller.block_until_active(timeout=1.0)
+						success= self.chromecast.media_controller.session_active_event.is_set()
+						if success:
+							frames_sent_load_counter.inc()
+					except pychromecast.error.NotConnected:
+						log("Couldn't play media, Chromecast not connected")
+					except pychromecast.error.ControllerNotRegistered:
+						log("Couldn't play media, Controller not registered")
 			else:
-				log("Couldn't play media, reason: %s" % reason)
+				log("Couldn't play media on '%s', reason: %s" % (self.friendly_name, reason))
 
 			self.cast_lock.release()
-		
+
+		if not success:
+			play_media_failures_counter.inc()
 		return success
 
+	# Must hold self.cast_lock.
+	# Returns: True if the frame is on screen, False to fall back to loading it on its own
+	def try_to_play_queued_media(self, url, content_type):
+		with play_media_seconds_histogram.time():
+			success, was_preloaded= self.queue_controller.show(url, content_type, 1.0)
+
+		if success:
+			self.queue_failure_count= 0
+			if was_preloaded:
+				frames_sent_queue_next_counter.inc()
+			else:
+				frames_sent_queue_load_counter.inc()
+			return True
+
+		# Some receivers may not support queueing images, stop trying until we reconnect
+		self.queue_failure_count= self.queue_failure_count + 1
+		if self.queue_failure_count >= max_queue_failure_count:
+			log("Chromecast '%s' isn't accepting frames through its queue, loading each frame on its own instead" % self.friendly_name,
+				level= log_buffer.LogLevel.Warning)
+			self.chromecast.unregister_handler(self.queue_controller)
+			self.queue_controller= None
+		return False
+
+	# Get a frame onto the Chromecast ahead of time, to be shown by try_to_play_media(url) when it's due. Only does
+	# anything with the queue transport.
+	def preload_media(self, url):
+		# Don't block for long, like try_to_play_media
+		if self.cast_lock.acquire(timeout= 1):
+			can_cast, _reason= self.can_cast(must_be_active= True)
+			if self.queue_controller is not None and can_cast == CanCastResult.Success:
+				log("Preloading '%s'" % url, level= log_buffer.LogLevel.Debug)
+				self.queue_controller.preload(url, get_media_content_type(url), 1.0)
+
+			self.cast_lock.release()
+
 class ImageScanningThread(threading.Thread):
-	def __init__(self, image_server):
-		threading.Thread.__init__(self, daemon= True)
+	def __init__(self, image_servers):
+		threading.Thread.__init__(self, daemon= True, name= "image_scanner")
 		self.local_image_paths= set() # Set: local_file_path
-		self.image_server= image_server
+		# The same images, by directory: directory path -> set of local_file_path
+		self.directory_image_paths= {}
+		# Images seeded from the image index by a warm start that the first full scan hasn't checked yet
+		self.seeded_image_paths= set()
+		self.image_servers= image_servers # One ImageServerThread per Chromecast, each gets every change
+		# Tells us which directories changed between scans, if inotify is available
+		self.directory_watcher= None
 		self.daemon= True
 
+	def add_image_references(self, new_image_references):
+		for image_server in self.image_servers:
+			image_server.add_image_references(new_image_references)
+
+	def remove_image_references(self, deleted_image_paths):
+		for image_server in self.image_servers:
+			image_server.remove_image_references(deleted_image_paths)
+
 	def run(self):
-		scan_interrupt_seconds= 10
+		if g_config.image_scanning_use_inotify:
+			try:
+				self.directory_watcher= directory_watcher.DirectoryWatcher()
+			except OSError as e:
+				log("Unable to watch for new images, only rescanning every [%d] minutes: '%s'" % (g_config.image_scanning_frequency_seconds / 60, e))
 
-		while(not g_globals.exit_event.is_set()):
-			scan_interrupt_timestamp_seconds= time.monotonic() + scan_interrupt_seconds
+		if g_config.image_scanning_warm_start:
+			self.seed_from_image_index()
+
+		# Until there are some images to show, pass on what we've found so far every so often during the scan
+		scan_interrupt_seconds= 10 if len(self.local_image_paths) == 0 else -1
 
-			# Walk local_images_path scanning for supported image files. If we aren't already tracking them in
-			# self.local_image_paths then add it to the list of new images to update the image server with.
-			new_local_image_paths= []
+		while(not g_globals.exit_event.is_set()):
 			if (os.path.exists(g_config.local_images_path)):
-				for dirpath, dirnames, filenames in os.walk(g_config.local_images_path, followlinks=True):
-					for filename in filenames:
-						if filename.lower().endswith(image_processing.supported_image_extensions) and not filename.startswith("._"):
-							image_path= os.path.join(dirpath, filename)
-
-							# skip temp images and images we've already processed
-							if (not image_path.startswith(g_config.local_temp_path) and
-							not image_path in self.local_image_paths):
-								new_local_image_paths.append(image_path)
-								self.local_image_paths.add(image_path)
-
-						if scan_interrupt_seconds >= 0:
-							# Update the image server periodically so that churning through a massive list of images doesn't block the image server
-							# when starting up.
-							new_time= time.monotonic()
-							if new_time >= scan_interrupt_timestamp_seconds:
-								scan_interrupt_timestamp_seconds= new_time + scan_interrupt_seconds
-								self.update_image_server_blocking(new_local_image_paths)
-								# Make sure to clear out the list of new images so they don't get added again.
-								new_local_image_paths.clear()
+				# Full scans stat every image, directories that inotify tells us about in the meantime are only listed
+				self.scan_directory_tree(g_config.local_images_path, scan_interrupt_seconds, verify_images= True)
 			else:
 				log("ERROR: Image Path '%s' does not exist" % (g_config.local_images_path))
 			
@@ -694,34 +2072,358 @@ class ImageScanningThread(threading.Thread):
 			if len(self.local_image_paths) > 0:
 				scan_interrupt_seconds= -1
 
-			if (len(new_local_image_paths) > 0):
-				self.update_image_server_blocking(new_local_image_paths)
+			self.wait_for_next_scan()
+
+		if self.directory_watcher:
+			self.directory_watcher.close()
 
-			sleep_time_remaining_seconds= g_config.image_scanning_frequency_seconds
-			while sleep_time_remaining_seconds > 0 and not g_globals.exit_event.is_set():
-				sleep_step_seconds= min(sleep_time_remaining_seconds, 5.0)
-				sleep_time_remaining_seconds= sleep_time_remaining_seconds - sleep_step_seconds
+	# Give the image servers the images found by the last scan, as remembered by the directory snapshots in the image
+	# index, so that casting can start straight away instead of waiting for the first scan to walk the library. Doesn't
+	# touch the disk. The first full scan then stats every seeded image, and replaces or removes the ones that were
+	# changed or deleted while we weren't running. Images that were never classified are left for the scan to find.
+	def seed_from_image_index(self):
+		seed_start_time= time.perf_counter()
+		seed_image_references= []
+
+		for directory_path in g_globals.image_index.get_directory_paths():
+			# Snapshots from a different images_path, before the scan gets round to deleting them
+			if not is_path_within(directory_path, g_config.local_images_path):
+				continue
+
+			image_paths= set()
+			for image_file_name in g_globals.image_index.get_directory(directory_path).image_file_names:
+				image_path= os.path.join(directory_path, image_file_name)
+				if g_globals.image_index.get_unverified(image_path) is None:
+					continue
+				seed_image_references.append(load_image_reference(image_path, verify= False))
+				image_paths.add(image_path)
+
+			self.directory_image_paths[directory_path]= image_paths
+			self.local_image_paths.update(image_paths)
+			self.seeded_image_paths.update(image_paths)
+
+		if len(seed_image_references) > 0:
+			log("Warm start: [%d] images from the last scan in [%.2f] seconds, scanning for changes in the background." % (
+				len(seed_image_references), time.perf_counter() - seed_start_time))
+			self.add_image_references(seed_image_references)
+
+	# Wait until it's time for the next full scan, scanning any directories that inotify tells us have changed in the
+	# meantime.
+	def wait_for_next_scan(self):
+		next_scan_time_seconds= time.monotonic() + g_config.image_scanning_frequency_seconds
+
+		while not g_globals.exit_event.is_set():
+			sleep_time_remaining_seconds= next_scan_time_seconds - time.monotonic()
+			if sleep_time_remaining_seconds <= 0:
+				break
+
+			sleep_step_seconds= min(sleep_time_remaining_seconds, 5.0)
+
+			if self.directory_watcher is None:
 				time.sleep(sleep_step_seconds)
+				continue
 
-	def update_image_server_blocking(self, new_local_image_paths):
-		image_references= [ImageReference(image_path, "", ImageLayout.Unknown)
-			for image_path in new_local_image_paths]
+			changed_directory_paths= self.directory_watcher.wait_for_changes(sleep_step_seconds)
+			if changed_directory_paths is not None and len(changed_directory_paths) > 0:
+				# Give whatever is copying images a moment to finish, and pick up the rest of the changes with it
+				time.sleep(1.0)
+				more_changed_directory_paths= self.directory_watcher.wait_for_changes(0)
+				if more_changed_directory_paths is not None:
+					changed_directory_paths.update(more_changed_directory_paths)
+				else:
+					changed_directory_paths= None
 
-		self.image_server.add_image_references(image_references)
+			if changed_directory_paths is None:
+				log("Missed some changes to images, rescanning everything.")
+				break
 
-	def get_images_from_local_path(local_image_path):
-		images= []
-		if (os.path.exists(local_image_path)):
-			for dirpath, dirnames, filenames in os.walk(local_image_path, followlinks=True):
-				images= images + [
-					os.path.join(dirpath, filename)
-					for filename in filenames
-						if filename.lower().endswith(image_processing.supported_image_extensions) and not filename.startswith("._")]
-		return images
+			for directory_path in sorted(changed_directory_paths):
+				self.scan_directory_tree(directory_path, -1, force_list_directory_path= directory_path)
+
+	# Start watching a directory for changes, if we can
+	def watch_directory(self, directory_path):
+		if self.directory_watcher and not self.directory_watcher.is_watching(directory_path):
+			try:
+				self.directory_watcher.watch(directory_path)
+			except OSError as e:
+				# Most likely we've hit fs.inotify.max_user_watches, watching some directories and not others would
+				# just be confusing
+				log("Unable to watch for new images, only rescanning every [%d] minutes: '%s'" % (g_config.image_scanning_frequency_seconds / 60, e))
+				self.directory_watcher.close()
+				self.directory_watcher= None
+
+	# Returns: (DirectorySnapshot of the images and subdirectories in directory_path,
+	# dictionary: image file name -> os.stat_result)
+	def list_directory(self, directory_path, mtime_ns, known_image_paths):
+		subdirectory_names= []
+		image_file_names= []
+		image_stat_results= {}
+
+		with os.scandir(directory_path) as directory_entries:
+			for directory_entry in directory_entries:
+				# Follows symlinks, like os.walk(followlinks=True)
+				if directory_entry.is_dir():
+					subdirectory_names.append(directory_entry.name)
+				elif directory_entry.name.lower().endswith(image_processing.supported_image_extensions) and not directory_entry.name.startswith("._"):
+					image_file_names.append(directory_entry.name)
+					# Images we already know about aren't looked at again, don't spend a round trip to the NAS on them
+					if os.path.join(directory_path, directory_entry.name) in known_image_paths:
+						continue
+					try:
+						# Stat new images while we're here, on this thread, rather than one at a time on the scanning thread
+						image_stat_results[directory_entry.name]= directory_entry.stat()
+					except OSError:
+						pass # load_image_reference will try again and report the error
+
+		return (image_index.DirectorySnapshot(mtime_ns, sorted(subdirectory_names), sorted(image_file_names)), image_stat_results)
+
+	# Returns: dictionary: image file name -> os.stat_result, for the image_file_names in directory_path that could be
+	# stat'ed
+	def stat_images(self, directory_path, image_file_names):
+		image_stat_results= {}
+		for image_file_name in image_file_names:
+			try:
+				image_stat_results[image_file_name]= os.stat(os.path.join(directory_path, image_file_name))
+			except OSError:
+				pass # load_image_reference will try again and report the error
+		return image_stat_results
+
+	# Runs on the scanning thread pool. Lists directory_path if it has changed since the last scan (according to the
+	# snapshot in the image index), or if force_list. known_image_paths are the images we're already tracking in the
+	# directory, which don't need to be stat'ed unless verify_images. ancestor_directory_ids are the (st_dev, st_ino)
+	# of the directories above this one.
+	# Returns: ((st_dev, st_ino), DirectorySnapshot, True if the directory was listed, dictionary: image file name ->
+	# os.stat_result for every image if verify_images, otherwise for the images that aren't in known_image_paths if the
+	# directory was listed), or None if the directory is one of its own ancestors (a symlink loop)
+	def read_directory(self, directory_path, force_list, known_image_paths, ancestor_directory_ids, verify_images):
+		# stat before listing, so that if it changes while we're listing it we'll list it again next time
+		stat_result= os.stat(directory_path)
+		directory_id= (stat_result.st_dev, stat_result.st_ino)
+		if directory_id in ancestor_directory_ids:
+			return None
+		mtime_ns= stat_result.st_mtime_ns
+
+		snapshot= g_globals.image_index.get_directory(directory_path)
+		if snapshot is not None and snapshot.mtime_ns == mtime_ns and not force_list:
+			# Overwriting an image doesn't change its directory's modification time, so look at each one
+			image_stat_results= self.stat_images(directory_path, snapshot.image_file_names) if verify_images else {}
+			return (directory_id, snapshot, False, image_stat_results)
+
+		snapshot, image_stat_results= self.list_directory(directory_path, mtime_ns, frozenset() if verify_images else known_image_paths)
+		return (directory_id, snapshot, True, image_stat_results)
+
+	# Scan root_directory_path and everything below it for images that have been added or deleted since the last scan,
+	# and update the image server. Only directories whose modification time has changed since the last scan (according
+	# to the snapshots in the image index) are listed, plus force_list_directory_path if given. If verify_images then
+	# every image is stat'ed too, to find images that were overwritten in place.
+	# Directories are read image_scanning_concurrency at a time, since on network drives reading a directory is mostly
+	# waiting for a round trip to the server.
+	def scan_directory_tree(self, root_directory_path, scan_interrupt_seconds, force_list_directory_path= None, verify_images= False):
+		scan_start_time= time.perf_counter()
+		scan_interrupt_timestamp_seconds= time.monotonic() + scan_interrupt_seconds
+		temp_path_abs= os.path.abspath(g_config.local_temp_path)
+
+		# If we aren't already tracking images in self.local_image_paths then add them to the list of new images to
+		# update the image server with.
+		new_image_references= []
+		# New images that aren't in the image index yet, we'll probe them once we're done walking
+		unclassified_image_references= []
+		deleted_image_paths= []
+		# Images that have been overwritten since we last looked at them, replaced with new image references
+		changed_image_references= []
+		submitted_directory_paths= set()
+		visited_directory_paths= set()
+		listed_directory_count= 0
+
+		with concurrent.futures.ThreadPoolExecutor(max_workers= max(g_config.image_scanning_concurrency, 1)) as executor:
+			pending_directory_paths= {} # Future -> (directory path, (st_dev, st_ino) of the directories above it)
+
+			# Symlink loops are caught by read_directory(), from the directories' (st_dev, st_ino) rather than their
+			# paths, since every trip round a loop makes a new path
+			def submit_directory(directory_path, ancestor_directory_ids):
+				# skip temp images
+				if os.path.abspath(directory_path) == temp_path_abs or directory_path in submitted_directory_paths:
+					return
+				submitted_directory_paths.add(directory_path)
+				# The set is replaced rather than changed once the directory is read, so the worker can safely look at it
+				future= executor.submit(self.read_directory, directory_path, directory_path == force_list_directory_path,
+					self.directory_image_paths.get(directory_path, frozenset()), ancestor_directory_ids, verify_images)
+				pending_directory_paths[future]= (directory_path, ancestor_directory_ids)
+
+			submit_directory(root_directory_path, frozenset())
+
+			while len(pending_directory_paths) > 0:
+				if g_globals.exit_event.is_set():
+					executor.shutdown(wait= False, cancel_futures= True)
+					return
+
+				done_futures, _not_done_futures= concurrent.futures.wait(pending_directory_paths.keys(), timeout= 1.0,
+					return_when= concurrent.futures.FIRST_COMPLETED)
+
+				for future in done_futures:
+					directory_path, ancestor_directory_ids= pending_directory_paths.pop(future)
+
+					try:
+						directory_result= future.result()
+					except FileNotFoundError:
+						continue # deleted, along with everything we knew about in it
+					except OSError as e:
+						log("ERROR: Unable to read directory '%s', skipping: '%s'" % (directory_path, e))
+						# Don't forget about the images we already know about under here just because of a network hiccup
+						visited_directory_paths.update(path for path in self.directory_image_paths.keys() if is_path_within(path, directory_path))
+						continue
+
+					if directory_result is None:
+						log("Skipping '%s', it's a symlink back to a directory above it." % directory_path, level= log_buffer.LogLevel.Warning)
+						continue
+
+					directory_id, snapshot, listed, image_stat_results= directory_result
+					visited_directory_paths.add(directory_path)
+					self.watch_directory(directory_path)
+					scanned_images_counter.inc(len(snapshot.image_file_names))
+
+					if listed:
+						g_globals.image_index.put_directory(directory_path, snapshot)
+						listed_directory_count= listed_directory_count + 1
+
+					image_paths= set(os.path.join(directory_path, image_file_name) for image_file_name in snapshot.image_file_names)
+					previous_image_paths= self.directory_image_paths.get(directory_path, set())
+
+					for image_path in image_paths - previous_image_paths:
+						stat_result= image_stat_results.get(os.path.basename(image_path))
+						try:
+							if stat_result is None and not listed and not verify_images:
+								# The directory hasn't changed, so we trust that the images in it haven't either
+								image_reference= load_image_reference(image_path, verify= False)
+							else:
+								image_reference= load_image_reference(image_path, stat_result= stat_result)
+						except OSError as e:
+							log("ERROR: Unable to stat image '%s': '%s'" % (image_path, e))
+							continue
+
+						new_image_references.append(image_reference)
+						self.local_image_paths.add(image_path)
+
+						if image_reference.image_layout == ImageLayout.Unknown:
+							unclassified_image_references.append(image_reference)
+
+					for image_path in previous_image_paths - image_paths:
+						deleted_image_paths.append(image_path)
+						self.local_image_paths.discard(image_path)
+
+					if verify_images and not listed:
+						# Gone without changing the directory's modification time, e.g. on a file system with coarse
+						# timestamps. Forget the snapshot too, so the next scan lists the directory rather than trusting it.
+						missing_image_paths= set(image_path for image_path in image_paths & previous_image_paths
+							if not os.path.basename(image_path) in image_stat_results)
+						if len(missing_image_paths) > 0:
+							deleted_image_paths.extend(missing_image_paths)
+							self.local_image_paths.difference_update(missing_image_paths)
+							g_globals.image_index.remove_directories([directory_path])
+
+					# Images we already know about, if we stat'ed them: replace any that have changed since they were
+					# put in the image index
+					for image_file_name, stat_result in image_stat_results.items():
+						image_path= os.path.join(directory_path, image_file_name)
+						if not image_path in previous_image_paths:
+							continue
+						metadata= g_globals.image_index.get_unverified(image_path)
+						if metadata is None or (metadata.size == stat_result.st_size and metadata.mtime_ns == stat_result.st_mtime_ns):
+							continue
+
+						image_reference= load_image_reference(image_path, stat_result= stat_result)
+						changed_image_references.append(image_reference)
+						if image_reference.image_layout == ImageLayout.Unknown:
+							unclassified_image_references.append(image_reference)
+
+					self.directory_image_paths[directory_path]= image_paths & self.local_image_paths
+
+					for subdirectory_name in snapshot.subdirectory_names:
+						submit_directory(os.path.join(directory_path, subdirectory_name), ancestor_directory_ids | { directory_id })
+
+				if scan_interrupt_seconds >= 0 and len(new_image_references) > 0:
+					# Update the image server periodically so that churning through a massive list of images doesn't block the image server
+					# when starting up.
+					new_time= time.monotonic()
+					if new_time >= scan_interrupt_timestamp_seconds:
+						scan_interrupt_timestamp_seconds= new_time + scan_interrupt_seconds
+						self.add_image_references(new_image_references)
+						# Start a new list of new images so they don't get added again.
+						new_image_references= []
+
+		# Anything we knew about under root_directory_path that we didn't come across has been deleted
+		for directory_path in list(self.directory_image_paths.keys()):
+			if is_path_within(directory_path, root_directory_path) and not directory_path in visited_directory_paths:
+				for image_path in self.directory_image_paths.pop(directory_path):
+					deleted_image_paths.append(image_path)
+					self.local_image_paths.discard(image_path)
+
+		g_globals.image_index.remove_directories([directory_path for directory_path in g_globals.image_index.get_directory_paths()
+			if is_path_within(directory_path, root_directory_path) and not directory_path in visited_directory_paths])
+
+		if len(deleted_image_paths) > 0:
+			log("Removing [%d] deleted images." % len(deleted_image_paths))
+			g_globals.image_index.remove(deleted_image_paths)
+
+		if len(changed_image_references) > 0:
+			log("Reloading [%d] images that have changed." % len(changed_image_references))
+
+		# Changed images are removed and added again, in that order, so that the image servers forget everything about
+		# the old versions, e.g. their rendered frames
+		removed_image_paths= deleted_image_paths + [image_reference.local_image_path for image_reference in changed_image_references]
+		if len(removed_image_paths) > 0:
+			self.remove_image_references(removed_image_paths)
+
+		new_image_references.extend(changed_image_references)
+		if (len(new_image_references) > 0):
+			self.add_image_references(new_image_references)
+
+		if listed_directory_count > 0:
+			log("Scanned '%s': listed [%d] of [%d] directories, [%d] images." % (root_directory_path, listed_directory_count, len(visited_directory_paths), len(self.local_image_paths)))
+
+		if verify_images and len(self.seeded_image_paths) > 0:
+			log("Warm start: checked [%d] images from the last scan, [%d] changed and [%d] deleted." % (len(self.seeded_image_paths),
+				len(self.seeded_image_paths.intersection(image_reference.local_image_path for image_reference in changed_image_references)),
+				len(self.seeded_image_paths.intersection(deleted_image_paths))))
+			self.seeded_image_paths= set()
+
+		scan_seconds_histogram= directory_scan_seconds_histogram if force_list_directory_path else full_scan_seconds_histogram
+		scan_seconds_histogram.observe(time.perf_counter() - scan_start_time)
+
+		self.classify_image_references(unclassified_image_references)
+
+	# Probe images the image index doesn't know about yet, so that the image server rarely has to open images to
+	# find portraits, and the next startup doesn't have to open them at all. The image references are shared with the
+	# image server so it sees the results immediately.
+	def classify_image_references(self, image_references):
+		if len(image_references) > 0:
+			log("Classifying [%d] new images." % len(image_references))
+
+		image_reference_dictionary= { image_reference.local_image_path : image_reference for image_reference in image_references }
+		for image_path, probe, error in image_processing.probe_images(image_reference_dictionary.keys()):
+			if g_globals.exit_event.is_set():
+				break
+
+			if error:
+				log("ERROR: Unable to classify image '%s': '%s'" % (image_path, error))
+			else:
+				apply_image_probe(image_reference_dictionary[image_path], probe)
+
+		g_globals.image_index.flush()
 
 def main():
 	random.seed()
 
+	if g_config.log_file_path:
+		g_globals.log_buffer.open_file(g_config.log_file_path, g_config.log_file_bytes, g_config.log_file_count, g_config.log_level)
+
+	g_globals.state.update({
+		"chromecast_name" : ", ".join(device_config.friendly_name for device_config in g_config.get_devices()),
+		"is_paused" : g_globals.paused,
+		"slideshow_duration_seconds" : g_config.slideshow_duration_seconds,
+		"image_path" : g_config.local_images_path })
+	publish_playlist_state()
+
 	log("Serving local directory '%s' and spinning up HTTP server '%s'" % (
 		g_config.local_images_path,
 		g_config.server_url))
@@ -731,70 +2433,114 @@ def main():
 	if not os.path.exists(g_config.local_temp_path):
 		os.makedirs(g_config.local_temp_path)
 
+	g_globals.image_index= image_index.ImageIndex(g_config.local_image_index_file_path)
+	log("Loaded [%d] entries from image index '%s'" % (len(g_globals.image_index), g_config.local_image_index_file_path))
+
 	# Copy HTML index to temp path
 	shutil.copy("index.html", g_config.local_temp_path)
 
    # Spin up a separate thread to run a web server. The server exposes images in local_images_path to the Chromecast
-	web_server= WebServerThread()
+	web_server= AsyncWebServerThread() if g_config.http_server_mode == "asyncio" else WebServerThread()
 	web_server.start()
 
-	# delete any temp files we created from a previous run (by tracking a list of files)
-	# if the list file doesn't exist yet then create it now to track temp files created this run
+	# Rendered frames used to be temp files tracked by a list file, delete any left over from a previous version
 	if os.path.exists(g_config.local_temp_image_list_file_path):
-		temp_image_list_file= open(g_config.local_temp_image_list_file_path, "r+")
-		for line in temp_image_list_file:
-			# make sure to strip out any file path from file names so that any file we delete must be contained
-			# in the directory we expect
-			file_name_to_delete= os.path.join(g_config.local_temp_path, os.path.basename(line.strip()))
-			if os.path.exists(file_name_to_delete):
-				log("Purging temporary image '%s' from '%s'" % (file_name_to_delete, g_config.local_temp_image_list_file_path))
-				os.remove(file_name_to_delete)
-		
-		temp_image_list_file.seek(0)
-		temp_image_list_file.truncate()
-	else:
-		temp_image_list_file= open(g_config.local_temp_image_list_file_path, "w+")
-
-	temp_image_file_names= []
+		with open(g_config.local_temp_image_list_file_path, "r") as temp_image_list_file:
+			for line in temp_image_list_file:
+				# make sure to strip out any file path from file names so that any file we delete must be contained
+				# in the directory we expect
+				file_name_to_delete= os.path.join(g_config.local_temp_path, os.path.basename(line.strip()))
+				if os.path.exists(file_name_to_delete):
+					log("Purging temporary image '%s' from '%s'" % (file_name_to_delete, g_config.local_temp_image_list_file_path), level= log_buffer.LogLevel.Debug)
+					os.remove(file_name_to_delete)
+		os.remove(g_config.local_temp_image_list_file_path)
+
+	# Rendered frames are kept between runs, trimmed down to the configured size (evicting everything from the last run
+	# if the cache is disabled)
+	frame_render_cache= render_cache.RenderCache(g_config.local_render_cache_path, g_config.render_cache_bytes)
+	log("Loaded [%d] frames from render cache '%s'" % (len(frame_render_cache), g_config.local_render_cache_path))
+
+	# Serve frames from memory rather than writing them to disk just so that the web server can read them back
+	if g_config.frame_store_bytes > 0:
+		g_globals.frame_store= frame_store.FrameStore(g_config.frame_store_bytes)
+
+	thumbnail_cache= render_cache.RenderCache(g_config.local_thumbnail_cache_path, g_config.thumbnail_cache_bytes)
+	g_globals.thumbnail_generator= thumbnails.ThumbnailGenerator(thumbnail_cache)
+
+	# Frames are rendered in the background, in worker processes, while the current frame is on screen
+	frame_render_engine= render_engine.RenderEngine(g_config.render_worker_count)
+	log("Rendering with [%d] worker processes" % frame_render_engine.worker_count)
 	
-	# Three pieces:
+	# Three pieces, for each Chromecast:
 	# 1. Chromecast Poller: Waits for the Chromecast to be available
 	# 2. Image Server: Serves images to Chromecast when told by the Chromecast Poller.
-	# 3. Image Scanner: Periodically scans for new images and merges them into the list of the Image Server
-	chromecast_poller= ChromeCastPoller(g_config.chromecast_friendly_name)
-	image_serving_thread= ImageServerThread(chromecast_poller, temp_image_list_file, temp_image_file_names)
-	image_scanning_thread= ImageScanningThread(image_serving_thread)
-
-	chromecast_poller.image_serving_thread= image_serving_thread
-
-	# Start the image server first which will block until the Chromecast poller tells it to serve
-	image_serving_thread.start() # Will block on image_serving_thread.should_serve
-	# Then start the image scanner to begin populating the image server
+	# 3. Image Scanner: Periodically scans for new images and merges them into the list of every Image Server (there's
+	# only one of these)
+	chromecast_discovery= ChromecastDiscovery()
+	chromecast_pollers= []
+	image_serving_threads= []
+	for device_config in g_config.get_devices():
+		chromecast_poller= ChromeCastPoller(device_config.friendly_name)
+		# The first Chromecast's playlist is the one shown in the web UI, the others are shuffled separately
+		image_playlist= g_globals.playlist if len(image_serving_threads) == 0 else playlist.Playlist()
+		image_serving_thread= ImageServerThread(device_config, chromecast_poller, image_playlist, frame_render_engine,
+			frame_render_cache, g_globals.frame_store)
+		chromecast_poller.image_serving_thread= image_serving_thread
+		chromecast_discovery.add_poller(chromecast_poller)
+
+		chromecast_pollers.append(chromecast_poller)
+		image_serving_threads.append(image_serving_thread)
+	image_scanning_thread= ImageScanningThread(image_serving_threads)
+	g_globals.image_servers= image_serving_threads
+
+	# Start the image servers first which will block until their Chromecast poller tells them to serve
+	for image_serving_thread in image_serving_threads:
+		image_serving_thread.start() # Will block on image_serving_thread.should_serve
+	# Then start the image scanner to begin populating the image servers
 	image_scanning_thread.start()
-	# Finally start the chromecast poller to look for chromecasts, now that the server is ready to serve (and will have some images soon)
-	chromecast_poller.start()
+	# Finally start the chromecast pollers and look for chromecasts, now that the servers are ready to serve (and will
+	# have some images soon)
+	for chromecast_poller in chromecast_pollers:
+		chromecast_poller.start()
+	chromecast_discovery.start()
 
 	# Just blocking to keep program alive
 	g_globals.exit_event.wait()
 
-	# Notify and wait for the image serving thread specifically, since it is using temp_image_list_file, before closing the file.
-	image_serving_thread.should_serve.clear()
-	image_serving_thread.not_serving.wait()
+	# Let the web UI's event streams finish, it'll reconnect if we're reloading
+	g_globals.state.close()
+
+	# Notify and wait for the image serving threads specifically, since they're using the render engine, before shutting it down.
+	for image_serving_thread in image_serving_threads:
+		image_serving_thread.stop_serving()
+	for image_serving_thread in image_serving_threads:
+		image_serving_thread.not_serving.wait()
+		image_serving_thread.portrait_scheduler.shutdown()
+	g_globals.thumbnail_generator.shutdown()
 
-	temp_image_list_file.close()
+	log("Waiting for render workers to shut down...")
+	frame_render_engine.shutdown()
 
-	# Stop the Chromecast Poller (disconnect from the Chromecast) after the image serving thread is done serving
-	chromecast_poller.stop()
+	# Stop the Chromecast Pollers (disconnect from the Chromecasts) after the image serving threads are done serving,
+	# then stop looking for Chromecasts
+	for chromecast_poller in chromecast_pollers:
+		chromecast_poller.stop()
+	chromecast_discovery.stop()
 
 	web_server.shutdown()
 	log("Waiting for web server to shut down...")
 	web_server.join()
-	log("Waiting for image server to shut down...")
-	image_serving_thread.join()
+	log("Waiting for image servers to shut down...")
+	for image_serving_thread in image_serving_threads:
+		image_serving_thread.join()
 	log("Waiting for image scanner to shut down...")
 	image_scanning_thread.join()
-	log("Waiting for Chromecast Poller to shut down...")
-	chromecast_poller.wait_for_idle_thread.join()
+	log("Waiting for Chromecast Pollers to shut down...")
+	for chromecast_poller in chromecast_pollers:
+		chromecast_poller.wait_for_idle_thread.join()
+
+	g_globals.image_index.close()
+	g_globals.log_buffer.close()
 
 def initialize():
 	global g_config
@@ -804,9 +2550,20 @@ def initialize():
 	g_globals= Globals()
 	load_config()
 
-while True:
-	initialize()
-	main()
-
-	if (not g_globals.reload_event.is_set()):
-		break
\ No newline at end of file
+	# Modules that don't know about log() use the logging module instead, pass their messages on to log()
+	for logger_name in ("image_processing", "render_engine"):
+		module_logger= logging.getLogger(logger_name)
+		if len(module_logger.handlers) == 0:
+			module_logger.addHandler(log_buffer.LogFunctionHandler(
+				lambda level, component, message: log(message, level= level, component= component)))
+			module_logger.setLevel(logging.DEBUG)
+			module_logger.propagate= False
+
+# Render worker processes import this module, only start up when run as a program
+if __name__ == "__main__":
+	while True:
+		initialize()
+		main()
+
+		if (not g_globals.reload_event.is_set()):
+			break
\ No newline at end of file
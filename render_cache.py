@@ -0,0 +1,118 @@
+import collections
+import os
+import threading
+import uuid
+
+# Entries are stored in files named by their key, which ends with one of these
+frame_file_extensions= (".jpg", ".webp")
+temp_file_prefix= "storing-"
+
+# Rendered frames on disk, named by a key that identifies the source image(s) and everything that affects how they're
+# rendered (see render_engine.get_frame_key). When an image comes up again in the shuffle we can cast the frame we
+# already rendered. The least recently used frames are deleted once the cache grows beyond max_bytes.
+# Frames that are about to be cast or were just cast are pinned, so they're never deleted out from under the
+# Chromecast, even if max_bytes is 0.
+class RenderCache:
+	def __init__(self, cache_path, max_bytes):
+		self.cache_path= cache_path
+		self.max_bytes= max_bytes
+		self.lock= threading.Lock()
+		self.entries= collections.OrderedDict() # key -> size in bytes, least recently used first
+		self.total_bytes= 0
+		self.pin_counts= {} # key -> number of times pinned
+
+		if not os.path.exists(self.cache_path):
+			os.makedirs(self.cache_path)
+
+		# Rebuild the LRU order from file modification times, which we update on every hit
+		cached_files= []
+		for dir_entry in os.scandir(self.cache_path):
+			if dir_entry.name.startswith(temp_file_prefix):
+				# Left over from a frame that was still being written when we quit
+				os.remove(dir_entry.path)
+			elif dir_entry.name.endswith(frame_file_extensions):
+				stat_result= dir_entry.stat()
+				cached_files.append((stat_result.st_mtime_ns, dir_entry.name, stat_result.st_size))
+
+		for _mtime_ns, key, size in sorted(cached_files):
+			self.entries[key]= size
+			self.total_bytes= self.total_bytes + size
+
+		with self.lock:
+			self.evict()
+
+	def __len__(self):
+		return len(self.entries)
+
+	def get_file_path(self, key):
+		return os.path.join(self.cache_path, key)
+
+	# Returns: True if the frame for key is cached, marking it as most recently used
+	def lookup(self, key):
+		with self.lock:
+			if not key in self.entries:
+				return False
+
+			self.entries.move_to_end(key)
+			try:
+				os.utime(self.get_file_path(key))
+			except OSError:
+				# Deleted from under us?
+				self.total_bytes= self.total_bytes - self.entries.pop(key)
+				return False
+			return True
+
+	# Returns: the cached frame's bytes, or None if it isn't cached
+	def read(self, key):
+		if not self.lookup(key):
+			return None
+
+		try:
+			with open(self.get_file_path(key), "rb") as frame_file:
+				return frame_file.read()
+		except OSError:
+			return None
+
+	# Write a rendered frame to the cache. It's written to a temporary file first and then moved into place, so that
+	# a partially written frame is never mistaken for a cached one.
+	def store(self, key, frame_bytes):
+		# Unique, in case the same frame is stored twice at the same time
+		temp_file_path= os.path.join(self.cache_path, temp_file_prefix + uuid.uuid4().hex + "-" + key)
+		with open(temp_file_path, "wb") as temp_file:
+			temp_file.write(frame_bytes)
+		os.replace(temp_file_path, self.get_file_path(key))
+
+		with self.lock:
+			self.total_bytes= self.total_bytes - self.entries.pop(key, 0) + len(frame_bytes)
+			self.entries[key]= len(frame_bytes)
+			self.evict()
+
+	def pin(self, key):
+		with self.lock:
+			self.pin_counts[key]= self.pin_counts.get(key, 0) + 1
+
+	def unpin(self, key):
+		with self.lock:
+			pin_count= self.pin_counts[key] - 1
+			if pin_count > 0:
+				self.pin_counts[key]= pin_count
+			else:
+				del self.pin_counts[key]
+			self.evict()
+
+	# Must hold self.lock
+	def evict(self):
+		if self.total_bytes <= self.max_bytes:
+			return
+
+		for key in list(self.entries.keys()):
+			if self.total_bytes <= self.max_bytes:
+				break
+			if key in self.pin_counts:
+				continue
+
+			self.total_bytes= self.total_bytes - self.entries.pop(key)
+			try:
+				os.remove(self.get_file_path(key))
+			except OSError:
+				pass
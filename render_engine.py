@@ -0,0 +1,117 @@
+import concurrent.futures
+import concurrent.futures.process
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+import image_processing
+import metrics
+
+logger= logging.getLogger(__name__)
+
+# Bump whenever rendering changes in a way that should invalidate previously cached frames
+render_version= 2
+
+frame_bytes_histogram= metrics.registry.histogram("pycastblaster_frame_bytes", "Size of each rendered frame",
+	buckets= (25000, 50000, 100000, 150000, 200000, 300000, 400000, 600000, 800000, 1000000, 2000000))
+
+# Identifies a rendered frame: the source image(s), as they were on disk, plus every setting that affects how they're
+# rendered. source_identities is a list of (path, size, mtime_ns), one per image in the frame.
+# Returns: the key, which is also the frame's file name, ending with the file extension of its format
+def get_frame_key(source_identities, max_image_height_pixels, encoder_settings):
+	key_data= repr((
+		render_version,
+		tuple(source_identities),
+		max_image_height_pixels,
+		int(image_processing.landscape_processing_mode),
+		int(image_processing.portrait_processing_mode),
+		image_processing.blur_radius_pixels,
+		encoder_settings.get_key_data()))
+	return hashlib.sha1(key_data.encode("utf-8")).hexdigest() + encoder_settings.get_file_extension()
+
+# Runs in a render worker process.
+# Returns: (the rendered frame, encoded with encoder_settings, dictionary: stage name -> seconds spent on it)
+def render_frame(local_image_paths, max_image_height_pixels, encoder_settings):
+	start_time= time.perf_counter()
+	# Worker processes are shared between frames (and eventually devices), so apply the settings for each job
+	image_processing.set_max_image_height(max_image_height_pixels)
+	image_processing.stage_timer= metrics.StageTimer()
+
+	if len(local_image_paths) == 1:
+		image= image_processing.load_processed_image(local_image_paths[0])
+	else:
+		image= image_processing.compose_images(local_image_paths)
+
+	frame_bytes= image_processing.encode_image(image, encoder_settings)
+
+	stage_seconds= image_processing.stage_timer.stage_seconds
+	stage_seconds["total"]= time.perf_counter() - start_time
+	return (frame_bytes, stage_seconds)
+
+# Record how long each stage of rendering a frame took, and how big it came out, once it's done
+def observe_render_stages(future):
+	if future.cancelled() or future.exception() is not None:
+		return
+
+	frame_bytes, stage_seconds= future.result()
+	frame_bytes_histogram.observe(len(frame_bytes))
+	for stage_name, seconds in stage_seconds.items():
+		metrics.registry.histogram("pycastblaster_render_stage_seconds", "Time spent on each stage of rendering a frame",
+			{ "stage" : stage_name }).observe(seconds)
+
+# Renders frames on a pool of worker processes, so that decoding, blurring and encoding isn't limited to one core
+# by the GIL.
+class RenderEngine:
+	def __init__(self, worker_count):
+		self.worker_count= worker_count if worker_count > 0 else (os.cpu_count() or 1)
+		self.lock= threading.Lock()
+		self.executor= self.create_executor()
+
+	def create_executor(self):
+		# Don't fork this process, the other threads (zeroconf, the web server...) may be holding locks that the
+		# workers would inherit. The forkserver starts workers from a clean process instead.
+		return concurrent.futures.ProcessPoolExecutor(
+			max_workers= self.worker_count,
+			mp_context= multiprocessing.get_context("forkserver"))
+
+	# If a worker dies (e.g. killed for running out of memory on a huge image) the pool is broken for good, every frame
+	# that was rendering fails and nothing more can be submitted to it. Start a new pool, unless that's already been
+	# done.
+	def replace_broken_executor(self, broken_executor):
+		with self.lock:
+			if self.executor is not broken_executor:
+				return
+			logger.error("A render worker died, starting new render workers")
+			self.executor= self.create_executor()
+		# Don't wait, this may be called from the broken pool's own management thread
+		broken_executor.shutdown(wait= False, cancel_futures= True)
+
+	# Render a single image, or several portrait images spliced into one frame (see image_processing.splice_layouts).
+	# If a worker dies while rendering the frame, the future fails with BrokenProcessPool, like any other render failure.
+	# Returns: concurrent.futures.Future for the result of render_frame()
+	def submit_frame(self, local_image_paths, max_image_height_pixels, encoder_settings):
+		executor= self.executor
+		try:
+			future= executor.submit(render_frame, local_image_paths, max_image_height_pixels, encoder_settings)
+		except concurrent.futures.process.BrokenProcessPool:
+			# Broke since the last frame was done
+			self.replace_broken_executor(executor)
+			executor= self.executor
+			future= executor.submit(render_frame, local_image_paths, max_image_height_pixels, encoder_settings)
+
+		def replace_if_broken(future, executor= executor):
+			if not future.cancelled() and isinstance(future.exception(), concurrent.futures.process.BrokenProcessPool):
+				self.replace_broken_executor(executor)
+
+		future.add_done_callback(observe_render_stages)
+		future.add_done_callback(replace_if_broken)
+		return future
+
+	# Stop the worker processes, abandoning any frames that haven't started rendering yet
+	def shutdown(self):
+		with self.lock:
+			executor= self.executor
+		executor.shutdown(wait= True, cancel_futures= True)
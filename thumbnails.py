@@ -0,0 +1,91 @@
+import concurrent.futures
+import hashlib
+import os
+import threading
+
+import image_processing
+
+# Bump whenever thumbnail generation changes in a way that should invalidate previously cached thumbnails
+thumbnail_version= 1
+# Thumbnails are only generated at these sizes (longest side, in pixels), so that the cache isn't filled with copies of
+# the same image at every size a browser might ask for
+thumbnail_sizes= (160, 400, 800)
+# The size the web UI's image preview uses
+preview_thumbnail_size= 400
+# Thumbnails are always jpegs (see image_processing.load_thumbnail)
+thumbnail_file_extension= ".jpg"
+
+# Identifies a thumbnail: the source image as it was on disk, as (path, size, mtime_ns), plus the thumbnail size.
+# Returns: the key, which is also the thumbnail's file name in the cache
+def get_thumbnail_key(image_identity, thumbnail_size):
+	key_data= repr((thumbnail_version, tuple(image_identity), thumbnail_size))
+	return hashlib.sha1(key_data.encode("utf-8")).hexdigest() + thumbnail_file_extension
+
+# Generates thumbnails for the web UI on a few background threads and keeps them in thumbnail_cache (a
+# render_cache.RenderCache), so that browsing previews doesn't download full resolution originals or open them on the
+# NAS again. Requests for a thumbnail that's already being generated share the same result.
+class ThumbnailGenerator:
+	def __init__(self, thumbnail_cache, worker_count= 2):
+		self.thumbnail_cache= thumbnail_cache
+		self.executor= concurrent.futures.ThreadPoolExecutor(max_workers= worker_count)
+		self.lock= threading.Lock()
+		self.generating= {} # key -> Future
+
+	def shutdown(self):
+		self.executor.shutdown(wait= True, cancel_futures= True)
+
+	# image_identity is (path, size, mtime_ns), as from pycastblaster.ImageReference.get_identity(); if it's None the
+	# image is stat'ed.
+	# Returns: concurrent.futures.Future for the thumbnail's jpeg bytes
+	def submit(self, local_image_path, thumbnail_size, image_identity= None):
+		key= self.get_key(local_image_path, thumbnail_size, image_identity)
+
+		with self.lock:
+			future= self.generating.get(key)
+			if future is not None:
+				return future
+
+		thumbnail_bytes= self.thumbnail_cache.read(key)
+		if thumbnail_bytes is not None:
+			future= concurrent.futures.Future()
+			future.set_result(thumbnail_bytes)
+			return future
+
+		return self.start_generating(local_image_path, thumbnail_size, key)
+
+	# Generate the thumbnail in the background if it isn't cached already, for when nobody is waiting for it. Unlike
+	# submit() a cached thumbnail isn't read.
+	def prefetch(self, local_image_path, thumbnail_size, image_identity= None):
+		key= self.get_key(local_image_path, thumbnail_size, image_identity)
+
+		with self.lock:
+			if key in self.generating:
+				return
+
+		if not self.thumbnail_cache.lookup(key):
+			self.start_generating(local_image_path, thumbnail_size, key)
+
+	def get_key(self, local_image_path, thumbnail_size, image_identity):
+		if image_identity is None:
+			stat_result= os.stat(local_image_path)
+			image_identity= (local_image_path, stat_result.st_size, stat_result.st_mtime_ns)
+		return get_thumbnail_key(image_identity, thumbnail_size)
+
+	# Returns: concurrent.futures.Future for the thumbnail's jpeg bytes, shared with anybody else waiting for it
+	def start_generating(self, local_image_path, thumbnail_size, key):
+		with self.lock:
+			future= self.generating.get(key)
+			if future is None:
+				future= self.executor.submit(self.generate, local_image_path, thumbnail_size, key)
+				self.generating[key]= future
+			return future
+
+	# Runs on the thumbnail threads
+	def generate(self, local_image_path, thumbnail_size, key):
+		try:
+			thumbnail_bytes= image_processing.load_thumbnail(local_image_path, thumbnail_size)
+			self.thumbnail_cache.store(key, thumbnail_bytes)
+			return thumbnail_bytes
+		finally:
+			with self.lock:
+				del self.generating[key]
@@ -0,0 +1,86 @@
+import collections
+import threading
+import uuid
+
+# State shown by the web UI (current image, pause, duration, recent logs...), versioned so that clients can ask for
+# just what changed since the version they last saw, and wait for changes without polling. Every change bumps the
+# version, and each value and log line remembers the version it was set at.
+class VersionedState:
+	def __init__(self, max_log_lines= 200):
+		self.condition= threading.Condition()
+		# Versions restart from 0 every time we start, so clients also need to check that they're talking to the same
+		# instance before trusting a version they got earlier
+		self.instance_id= uuid.uuid4().hex[:8]
+		self.version= 0
+		self.values= {} # name -> value
+		self.value_versions= {} # name -> version the value was last changed at
+		self.log_lines= collections.deque(maxlen= max_log_lines) # (version, line), oldest first
+		self.closed= False
+		# Functions called (with no arguments, while holding the lock, so they must be quick) after every change, for
+		# waiting for changes without a thread per waiter
+		self.listeners= []
+
+	# Set several values at once, so that nobody sees some of them changed without the others.
+	# values: dictionary of name -> value, values that are the same as before don't count as changes
+	def update(self, values):
+		with self.condition:
+			changed_values= { name : value for name, value in values.items() if not name in self.values or self.values[name] != value }
+			if len(changed_values) == 0:
+				return
+
+			self.version= self.version + 1
+			for name, value in changed_values.items():
+				self.values[name]= value
+				self.value_versions[name]= self.version
+			self.notify_all()
+
+	def append_log(self, line):
+		with self.condition:
+			self.version= self.version + 1
+			self.log_lines.append((self.version, line))
+			self.notify_all()
+
+	def add_listener(self, listener):
+		with self.condition:
+			self.listeners.append(listener)
+
+	def remove_listener(self, listener):
+		with self.condition:
+			self.listeners.remove(listener)
+
+	# Must hold self.condition
+	def notify_all(self):
+		self.condition.notify_all()
+		for listener in self.listeners:
+			listener()
+
+	# Wake up everybody waiting for changes, for shutting down
+	def close(self):
+		with self.condition:
+			self.closed= True
+			self.notify_all()
+
+	# Returns: (version, dictionary of values changed after since_version, list of log lines added after since_version)
+	# Everything is returned if since_version is 0 (or from a different instance, or the future).
+	def get_changes(self, since_version):
+		with self.condition:
+			if since_version > self.version:
+				since_version= 0
+
+			changed_values= { name : value for name, value in self.values.items() if self.value_versions[name] > since_version }
+
+			new_log_lines= []
+			for line_version, line in reversed(self.log_lines):
+				if line_version <= since_version:
+					break
+				new_log_lines.append(line)
+			new_log_lines.reverse()
+
+			return (self.version, changed_values, new_log_lines)
+
+	# Wait up to timeout_seconds for a version newer than since_version.
+	# Returns: same as get_changes(); nothing changed if the version is still since_version
+	def wait_for_changes(self, since_version, timeout_seconds):
+		with self.condition:
+			self.condition.wait_for(lambda: self.version != since_version or self.closed, timeout_seconds)
+			return self.get_changes(since_version)